@@ -24,6 +24,11 @@ poetry lock --check
 echo "Installing runtime dependencies"
 poetry install --no-root --only main --sync
 
+if [ -f compile_templates.py ]; then
+  echo "Precompiling templates"
+  poetry run python compile_templates.py
+fi
+
 echo "Uninstalling pip and setuptools to exclude from output"
 VENV=$(poetry env info --path)
 "$VENV/bin/pip" uninstall -y setuptools pip || echo "Pip already uninstalled"
@@ -0,0 +1,227 @@
+"""Benchmark for the data_in_forwarder validation of imported CSV files
+
+Generates synthetic CSV files for every combination of the given sizes, widths,
+encodings and failure positions and runs them through _validate_imported_object,
+reporting rows/s, MB/s, peak RSS and the time taken to reject a failing file.
+
+Objects are served by a file-backed stand-in for the S3 client rather than moto, as
+moto holds whole objects in memory and would hide the memory used by validation.
+Each scenario runs in a fresh process so peak RSS isn't carried over between them.
+
+Usage (from src/aws-lambda/data_in_forwarder):
+    poetry run python benchmarks/benchmark_validation.py --rows 10000 100000 --cols 10 200
+    poetry run python benchmarks/benchmark_validation.py --fail-at 0 0.5 1 --json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+sys.path[:0] = [str(PROJECT_DIR), str(PROJECT_DIR / "data_in_forwarder")]
+
+BENCHMARK_BUCKET_NAME = "benchmark-import-bucket"  # Buckets are directories locally
+BENCHMARK_PENDING_BUCKET_NAME = "benchmark-pending-bucket"
+BENCHMARK_KEY_PREFIX = "dsa-000000-benchmark/user@email.com"
+# Cells cycle through these, so files in other encodings differ from UTF-8 and go
+# through detection and decoding as that encoding. Each is in Windows-1252 and Latin-1
+CELL_VALUES = ("value", "café", "£12.50", "Zoë", "naïve")
+
+
+@dataclass(frozen=True)
+class Scenario:
+    """A single synthetic file to validate"""
+
+    rows: int
+    cols: int
+    encoding: str
+    # Fraction of the way through the file of a row with a missing column, or None
+    fail_at: Optional[float]
+
+
+@dataclass
+class ScenarioResult:
+    """Measurements for a single scenario"""
+
+    scenario: Scenario
+    size_mb: float
+    seconds: float
+    rows_per_second: float
+    mb_per_second: float
+    peak_rss_mb: float
+    time_to_rejection_seconds: Optional[float]
+    accepted: bool
+    reason: Optional[str]
+
+
+def generate_csv(scenario: Scenario, path: Path) -> int:
+    """Write the synthetic CSV for a scenario to path, returning its size in bytes"""
+    header = ",".join(f"column_{col}" for col in range(scenario.cols))
+    row = ",".join(itertools.islice(itertools.cycle(CELL_VALUES), scenario.cols))
+    bad_row = ",".join(
+        itertools.islice(itertools.cycle(CELL_VALUES), max(scenario.cols - 1, 1))
+    )
+    fail_row = (
+        None
+        if scenario.fail_at is None
+        else min(int(scenario.rows * scenario.fail_at), scenario.rows - 1)
+    )
+    with open(path, "w", encoding=scenario.encoding, newline="") as csv_file:
+        csv_file.write(header + "\r\n")
+        for row_number in range(scenario.rows):
+            csv_file.write((bad_row if row_number == fail_row else row) + "\r\n")
+    return path.stat().st_size
+
+
+class _RangeReader:
+    """Reads at most length bytes from an open file"""
+
+    def __init__(self, file: BinaryIO, length: int) -> None:
+        self._file = file
+        self._remaining = length
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        amt = self._remaining if amt is None else min(amt, self._remaining)
+        data = self._file.read(amt)
+        self._remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class LocalS3Client:
+    """File-backed stand-in for the S3 client calls made during validation"""
+
+    def __init__(self, root: Path) -> None:
+        self._root = root
+
+    def list_objects_v2(self, Bucket: str, Prefix: str, MaxKeys: int) -> dict:
+        path = self._root / Bucket / Prefix
+        return {"Contents": [{"Key": Prefix}] if path.exists() else []}
+
+    def get_object(self, Bucket: str, Key: str, Range: str = "bytes=0-") -> dict:
+        path = self._root / Bucket / Key
+        size = path.stat().st_size
+        first_byte, _, last_byte = Range[len("bytes=") :].partition("-")
+        start = int(first_byte)
+        if start >= size:
+            raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+        end = min(int(last_byte) + 1, size) if last_byte else size
+        file = open(path, "rb")
+        file.seek(start)
+        return {"Body": StreamingBody(_RangeReader(file, end - start), end - start)}
+
+
+def run_scenario(scenario: Scenario) -> ScenarioResult:
+    """Time the validation of a scenario's file served from a local S3 stand-in"""
+    import data_in_forwarder.data_in_forwarder as forwarder
+    from data_in_forwarder.utils.data import S3ObjectInfo
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        key = f"{BENCHMARK_KEY_PREFIX}/benchmark.csv"
+        path = root / BENCHMARK_BUCKET_NAME / key
+        path.parent.mkdir(parents=True)
+        size = generate_csv(scenario, path)
+
+        forwarder.s3 = LocalS3Client(root)
+        forwarder.IMPORT_DATA_PENDING_BUCKET_NAME = BENCHMARK_PENDING_BUCKET_NAME
+        forwarder.MAX_DATA_SIZE_IN_BYTES = size
+        forwarder.logger.setLevel("WARNING")
+
+        reason = None
+        start = time.perf_counter()
+        s3_object_info = S3ObjectInfo(BENCHMARK_BUCKET_NAME, key, size)
+        try:
+            forwarder._validate_imported_object(
+                s3_object_info, forwarder._load_checkpoint(s3_object_info)
+            )
+        except forwarder.ObjectValidationException as err:
+            reason = str(err.args[0])
+        seconds = time.perf_counter() - start
+
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    size_mb = size / (1024 * 1024)
+    return ScenarioResult(
+        scenario=scenario,
+        size_mb=round(size_mb, 3),
+        seconds=round(seconds, 4),
+        rows_per_second=round(scenario.rows / seconds) if reason is None else 0,
+        mb_per_second=round(size_mb / seconds, 2) if reason is None else 0,
+        peak_rss_mb=round(peak_rss_mb, 1),
+        time_to_rejection_seconds=None if reason is None else round(seconds, 4),
+        accepted=reason is None,
+        reason=reason,
+    )
+
+
+def _parse_fail_at(value: str) -> Optional[float]:
+    return None if value == "none" else float(value)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--cols", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--encoding", nargs="+", default=["utf-8"])
+    parser.add_argument(
+        "--fail-at",
+        type=_parse_fail_at,
+        nargs="+",
+        default=[None],
+        help="Fractions through the file to add a bad row at, or 'none'",
+    )
+    parser.add_argument("--json", action="store_true", help="Output JSON lines")
+    args = parser.parse_args()
+
+    scenarios = [
+        Scenario(rows, cols, encoding, fail_at)
+        for rows, cols, encoding, fail_at in itertools.product(
+            args.rows, args.cols, args.encoding, args.fail_at
+        )
+    ]
+    # A fresh process per scenario keeps peak RSS measurements independent
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        results = pool.map(run_scenario, scenarios, chunksize=1)
+
+    if args.json:
+        for result in results:
+            print(json.dumps(asdict(result)))
+        return
+
+    columns = (
+        "rows,cols,encoding,fail_at,size_mb,seconds,rows/s,MB/s,peak_rss_mb,result"
+    )
+    print(columns.replace(",", "\t"))
+    for result in results:
+        scenario = result.scenario
+        values = [
+            scenario.rows,
+            scenario.cols,
+            scenario.encoding,
+            scenario.fail_at,
+            result.size_mb,
+            result.seconds,
+            result.rows_per_second,
+            result.mb_per_second,
+            result.peak_rss_mb,
+            "accepted" if result.accepted else f"rejected: {result.reason}",
+        ]
+        print("\t".join(str(value) for value in values))
+
+
+if __name__ == "__main__":
+    main()
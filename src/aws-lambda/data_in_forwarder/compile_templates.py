@@ -0,0 +1,26 @@
+"""Precompile the email templates into Python modules at build time
+
+The lambda loads templates from data_in_forwarder/compiled_templates when it exists,
+which avoids parsing and compiling them during a cold start. Run before packaging:
+    poetry run python compile_templates.py
+"""
+
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+PACKAGE_DIR = Path(__file__).parent / "data_in_forwarder"
+
+
+def main() -> None:
+    env = Environment(
+        loader=FileSystemLoader(PACKAGE_DIR / "templates"),
+        autoescape=select_autoescape(),
+    )
+    env.compile_templates(
+        str(PACKAGE_DIR / "compiled_templates"), zip=None, ignore_errors=False
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,322 @@
 """Lambda function to validate and forward a file being imported into the SDE"""
 
-import codecs
 import csv
+import hashlib
+import io
 import json
+import math
 import os
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import re
 from http import HTTPStatus
-from typing import Union
+from threading import Lock
+from typing import Any, BinaryIO, Optional, Union
 
 import boto3
 from aws_lambda_powertools.logging import Logger
-from aws_lambda_powertools.utilities.data_classes import S3Event
+from aws_lambda_powertools.utilities.data_classes import S3Event, SQSEvent
+from aws_lambda_powertools.utilities.data_classes.s3_event import S3EventRecord
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
 from aws_lambda_powertools.utilities.typing import LambdaContext
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from utils.data import DataInForwarderOutput, S3ObjectInfo
-from utils.exceptions import ObjectValidationException, S3ObjectMoveException
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from utils.data import (
+    DataInForwarderBatchOutput,
+    DataInForwarderOutput,
+    S3ObjectInfo,
+    SQSBatchResponse,
+    ValidationResult,
+)
+from utils.checkpoints import ForwarderStep, ObjectCheckpoint
+from utils.compression import (
+    COMPRESSED_EXTENSIONS,
+    DecompressingReader,
+    detect_compression,
+)
+from utils.content_index import ContentIndex, ContentVerdict
+from utils.dialect import CanonicalCSVReader, detect_csv_format
+from utils.encoding import (
+    UTF8Reader,
+    decode_sample,
+    detect_encoding,
+    needs_transcoding,
+)
+from utils.exceptions import (
+    NotificationException,
+    ObjectValidationException,
+    S3ObjectMoveException,
+    ValidationProblemsException,
+)
+from utils.lazy import Lazy
+from utils.notifications import Notification
+from utils.parquet import ParquetConverter, parquet_available
+from utils.report import REPORT_CONTENT_TYPES, format_validation_report
+from utils.rules import RuleStage, ValidationContext, ValidationProblem
+from utils.s3_reader import S3ObjectReader
+from utils.schema import SchemaRegistry
+from utils.store import create_state_store
+from utils.verdict_cache import CachedVerdict, VerdictCache
+from utils.validation import RowsCallback, validate_csv_rows, validation_rules
+from jinja2 import (
+    BaseLoader,
+    Environment,
+    FileSystemLoader,
+    ModuleLoader,
+    select_autoescape,
+)
 
 IMPORT_DATA_PENDING_BUCKET_NAME = os.getenv("IMPORT_DATA_PENDING_BUCKET_NAME", "")
 IMPORT_DATA_REJECTED_BUCKET_NAME = os.getenv("IMPORT_DATA_REJECTED_BUCKET_NAME", "")
 SOURCE_EMAIL_ADDRESS = os.getenv("SOURCE_EMAIL_ADDRESS", "")
 MAX_DATA_SIZE_IN_BYTES = int(os.getenv("MAX_DATA_SIZE", "1048576"))
 AWS_REGION = os.getenv("AWS_REGION", "eu-west-2")
+# Objects above this size are copied as parallel ranged parts (parts must be at least 5 MiB)
+MULTIPART_COPY_THRESHOLD_IN_BYTES = int(
+    os.getenv("MULTIPART_COPY_THRESHOLD", str(100 * 1024 * 1024))
+)
+MULTIPART_COPY_PART_SIZE_IN_BYTES = int(
+    os.getenv("MULTIPART_COPY_PART_SIZE", str(64 * 1024 * 1024))
+)
+MULTIPART_COPY_MAX_WORKERS = int(os.getenv("MULTIPART_COPY_MAX_WORKERS", "10"))
+MAX_MULTIPART_PARTS = 10000
+# Bytes fetched from the start of an object for the header and first rows to be checked
+HEADER_SAMPLE_SIZE_IN_BYTES = int(os.getenv("HEADER_SAMPLE_SIZE", str(64 * 1024)))
+# Bytes from the start of an object the encoding and CSV dialect are detected from
+ENCODING_SAMPLE_SIZE_IN_BYTES = 8 * 1024
+# Whether files in other CSV dialects, e.g. separated by semicolons, are rewritten with
+# commas when forwarded
+NORMALISE_CSV = os.getenv("NORMALISE_CSV", "false").lower() == "true"
+# Compressed files may decompress to this many times their size, or MAX_DATA_SIZE if
+# larger, before they're rejected as a possible zip bomb
+MAX_DECOMPRESSION_RATIO = int(os.getenv("MAX_DECOMPRESSION_RATIO", "100"))
+# Problems collected in one pass into a report written next to rejected objects, before
+# validation stops. Validation stops at the first problem, without a report, if unset
+VALIDATION_REPORT_MAX_PROBLEMS = int(os.getenv("VALIDATION_REPORT_MAX_PROBLEMS", "0"))
+VALIDATION_REPORT_FORMAT = os.getenv("VALIDATION_REPORT_FORMAT", "json")
+# Bucket holding a schema of the columns expected for each agreement, as
+# <agreement>.json. Column types aren't checked if this isn't set
+SCHEMA_BUCKET_NAME = os.getenv("SCHEMA_BUCKET_NAME", "")
+SCHEMA_CACHE_TTL_IN_SECONDS = int(os.getenv("SCHEMA_CACHE_TTL", "300"))
+# Whether accepted files are also converted to Parquet, written next to them in the
+# pending bucket. Needs pyarrow, e.g. from a layer
+CONVERT_TO_PARQUET = os.getenv("CONVERT_TO_PARQUET", "false").lower() == "true"
+MAX_CONCURRENT_OBJECTS = int(os.getenv("MAX_CONCURRENT_OBJECTS", "8"))
 CHARSET = "UTF-8"
+# Queue notifications are sent through, so SES isn't called while processing objects.
+# Notifications are sent straight away if this isn't set
+NOTIFICATION_QUEUE_URL = os.getenv("NOTIFICATION_QUEUE_URL", "")
+# Delay before a failed notification is redelivered, doubling with each attempt
+NOTIFICATION_RETRY_BASE_DELAY_IN_SECONDS = int(
+    os.getenv("NOTIFICATION_RETRY_BASE_DELAY", "30")
+)
+NOTIFICATION_RETRY_MAX_DELAY_IN_SECONDS = int(
+    os.getenv("NOTIFICATION_RETRY_MAX_DELAY", "900")
+)
+SES_MAX_ATTEMPTS = int(os.getenv("SES_MAX_ATTEMPTS", "5"))
+# SES errors that redelivering a notification would not resolve, e.g. a malformed address
+SES_NON_RETRYABLE_ERROR_CODES = {"MessageRejected", "InvalidParameterValue"}
+# Prefix of the SES templates created from templates/, for sending notifications in bulk.
+# Notifications are rendered and sent one at a time if this isn't set
+SES_TEMPLATE_PREFIX = os.getenv("SES_TEMPLATE_PREFIX", "")
+MAX_BULK_EMAIL_DESTINATIONS = 50
+# DynamoDB table, or sqlite://<path> locally, holding the index of verdicts given to
+# imported content. Identical content isn't validated or forwarded again while indexed
+STATE_TABLE_NAME = os.getenv("STATE_TABLE_NAME", "")
+CONTENT_INDEX_TTL_IN_SECONDS = int(
+    os.getenv("CONTENT_INDEX_TTL", str(30 * 24 * 60 * 60))
+)
+# How long validation verdicts and step checkpoints are kept for retries of the same
+# version of an object
+VERDICT_CACHE_TTL_IN_SECONDS = int(os.getenv("VERDICT_CACHE_TTL", str(24 * 60 * 60)))
+DOWNLOAD_CHUNK_SIZE_IN_BYTES = 1024 * 1024
+
+TEMPLATES_DIR = Path(__file__).parent / "templates"
+# Written by compile_templates.py at build time, so templates needn't be parsed at runtime
+COMPILED_TEMPLATES_DIR = Path(__file__).parent / "compiled_templates"
 
 logger = Logger()
-s3 = boto3.client("s3", region_name=AWS_REGION)
-ses = boto3.client("ses", region_name=AWS_REGION)
+s3 = Lazy(
+    "s3 client",
+    lambda: boto3.client(
+        "s3",
+        region_name=AWS_REGION,
+        config=Config(
+            max_pool_connections=MULTIPART_COPY_MAX_WORKERS * MAX_CONCURRENT_OBJECTS
+        ),
+    ),
+    logger,
+)
+ses = Lazy(
+    "ses client",
+    lambda: boto3.client(
+        "ses",
+        region_name=AWS_REGION,
+        # Adaptive retries back off and rate limit the client when SES throttles
+        config=Config(retries={"max_attempts": SES_MAX_ATTEMPTS, "mode": "adaptive"}),
+    ),
+    logger,
+)
+sqs = Lazy("sqs client", lambda: boto3.client("sqs", region_name=AWS_REGION), logger)
+dynamodb = Lazy(
+    "dynamodb client",
+    lambda: boto3.client("dynamodb", region_name=AWS_REGION),
+    logger,
+)
+state_store = Lazy(
+    "state store", lambda: create_state_store(STATE_TABLE_NAME, dynamodb), logger
+)
+content_index = ContentIndex(state_store, CONTENT_INDEX_TTL_IN_SECONDS)
+verdict_cache = VerdictCache(state_store, VERDICT_CACHE_TTL_IN_SECONDS)
+schema_registry = SchemaRegistry(s3, SCHEMA_BUCKET_NAME, SCHEMA_CACHE_TTL_IN_SECONDS)
+
+
+def _create_template_environment() -> Environment:
+    """Create the Jinja environment, preferring templates precompiled at build time"""
+    if COMPILED_TEMPLATES_DIR.is_dir():
+        loader: BaseLoader = ModuleLoader(str(COMPILED_TEMPLATES_DIR))
+    else:
+        loader = FileSystemLoader(TEMPLATES_DIR)
+    return Environment(loader=loader, autoescape=select_autoescape())
+
 
-env = Environment(
-    loader=FileSystemLoader(Path(__file__).parent / "templates"),
-    autoescape=select_autoescape(),
+env = Lazy("template environment", _create_template_environment, logger)
+validation_success_template = Lazy(
+    "success template", lambda: env.get_template("success.html"), logger
 )
-validation_success_template = env.get_template("success.html")
-validation_failure_template = env.get_template("failure.html")
+validation_duplicate_template = Lazy(
+    "duplicate template", lambda: env.get_template("duplicate.html"), logger
+)
+validation_failure_template = Lazy(
+    "failure template", lambda: env.get_template("failure.html"), logger
+)
+validation_failure_report_template = Lazy(
+    "failure report template", lambda: env.get_template("failure_report.html"), logger
+)
+NOTIFICATION_TEMPLATES = {
+    "success": validation_success_template,
+    "duplicate": validation_duplicate_template,
+    "failure": validation_failure_template,
+    "failure_report": validation_failure_report_template,
+}
+NOTIFICATION_TEMPLATE_VARIABLES = {
+    "success": ("agreement", "file"),
+    "duplicate": ("agreement", "file", "original_file"),
+    "failure": ("agreement", "file", "reason"),
+    "failure_report": ("agreement", "file", "reason", "report_name"),
+}
+# Names of the SES templates created by this lambda, by notification template
+ses_template_names: dict[str, str] = {}
+ses_templates_lock = Lock()
 
 
 @logger.inject_lambda_context(clear_state=True)
-def lambda_handler(event: dict, _: LambdaContext) -> DataInForwarderOutput:
-    """Main lambda handler"""
+def lambda_handler(
+    event: dict, _: LambdaContext
+) -> Union[DataInForwarderBatchOutput, SQSBatchResponse]:
+    """Main lambda handler
+
+    Accepts S3 event notifications directly, or batched through an SQS queue in which case
+    failed messages are reported back for redelivery.
+    """
+    records = event.get("Records") or []
+    if records and records[0].get("eventSource") == "aws:sqs":
+        return _process_sqs_event(SQSEvent(event))
+
+    if not records:
+        message = "Request must contain at least one record"
+        return {
+            "statusCode": HTTPStatus.BAD_REQUEST,
+            "body": json.dumps({"message": message}),
+            "results": [],
+        }
+
+    results = _process_s3_records(list(S3Event(event).records))
+    if len(results) == 1:
+        return {**results[0], "results": results}
+
+    failed = sum(1 for result in results if result["statusCode"] != HTTPStatus.OK)
+    return {
+        "statusCode": HTTPStatus.MULTI_STATUS if failed else HTTPStatus.OK,
+        "body": f"Processed {len(results)} objects, {failed} failed",
+        "results": results,
+    }
+
+
+def _process_sqs_event(sqs_event: SQSEvent) -> SQSBatchResponse:
+    """Helper function for processing S3 event notifications delivered in an SQS batch
+
+    Messages with an object that failed processing are reported as batch item failures.
+    Malformed requests are not retried, as redelivery would not change their outcome.
+    Notifications queued by earlier invocations are delivered from the same batches.
+    """
+    message_ids: list[str] = []
+    s3_records: list[S3EventRecord] = []
+    notification_records: list[tuple[SQSRecord, Notification]] = []
+    for sqs_record in sqs_event.records:
+        try:
+            message = json.loads(sqs_record.body)
+        except json.JSONDecodeError:
+            logger.exception(f"Message {sqs_record.message_id} is not valid JSON")
+            continue
+        notification = Notification.from_message(message)
+        if notification is not None:
+            notification_records.append((sqs_record, notification))
+            continue
+        s3_event = S3Event(message)
+        # S3 sends a test event without records when the notification is first set up
+        if not s3_event.get("Records"):
+            continue
+        for s3_record in s3_event.records:
+            message_ids.append(sqs_record.message_id)
+            s3_records.append(s3_record)
+
+    results = _process_s3_records(s3_records)
+    failed_message_ids = {
+        message_id
+        for message_id, result in zip(message_ids, results)
+        if result["statusCode"] >= HTTPStatus.INTERNAL_SERVER_ERROR
+        and result.get("retryable", True)
+    }
+    failed_message_ids.update(_deliver_queued_notifications(notification_records))
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": sqs_record.message_id}
+            for sqs_record in sqs_event.records
+            if sqs_record.message_id in failed_message_ids
+        ]
+    }
+
+
+def _process_s3_records(records: list[S3EventRecord]) -> list[DataInForwarderOutput]:
+    """Helper function for processing S3 event records concurrently, preserving their order"""
+    if not records:
+        return []
+    max_workers = min(MAX_CONCURRENT_OBJECTS, len(records))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_process_s3_record_safely, records))
+
+
+def _process_s3_record_safely(record: S3EventRecord) -> DataInForwarderOutput:
+    """Helper function so an unexpected error with one object doesn't lose the others' results"""
+    try:
+        return _process_s3_record(record)
+    except Exception:
+        message = "Unexpected error processing imported object"
+        logger.exception(message)
+        return {
+            "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
+            "body": json.dumps({"message": message}),
+        }
+
+
+def _process_s3_record(record: S3EventRecord) -> DataInForwarderOutput:
+    """Helper function for validating and forwarding a single imported object"""
 
     # Validate input event
-    invoke_event = S3Event(event)
     try:
-        bucket = invoke_event.bucket_name
+        bucket = record.s3.bucket.name
     except KeyError:
         message = "Request must contain a bucket"
         return {
@@ -52,7 +324,7 @@ def lambda_handler(event: dict, _: LambdaContext) -> DataInForwarderOutput:
             "body": json.dumps({"message": message}),
         }
     try:
-        key = invoke_event.object_key
+        key = record.s3.get_object.key
     except KeyError:
         message = "Request must contain a key"
         logger.exception(message)
@@ -61,7 +333,7 @@ def lambda_handler(event: dict, _: LambdaContext) -> DataInForwarderOutput:
             "body": json.dumps({"message": message}),
         }
     try:
-        size = invoke_event.record["s3"]["object"]["size"]
+        size = record["s3"]["object"]["size"]
     except KeyError:
         message = "Request must contain a size"
         logger.exception(message)
@@ -70,7 +342,7 @@ def lambda_handler(event: dict, _: LambdaContext) -> DataInForwarderOutput:
             "body": json.dumps({"message": message}),
         }
 
-    import_object = S3ObjectInfo(bucket, key, size)
+    import_object = S3ObjectInfo(bucket, key, size, record["s3"]["object"].get("eTag"))
 
     if not import_object.agreement or not import_object.user:
         message = "Imported object key must have the format <agreement>/<email>/<file>."
@@ -79,24 +351,34 @@ def lambda_handler(event: dict, _: LambdaContext) -> DataInForwarderOutput:
             "body": json.dumps({"message": message}),
         }
 
+    # Steps completed by an earlier delivery of this event are skipped
+    checkpoint = _load_checkpoint(import_object)
+
     # Validate imported object
     try:
-        _validate_imported_object(import_object)
+        validation_result = _validate_imported_object(import_object, checkpoint)
     except ObjectValidationException as err:
         message = f"Imported data {import_object.s3_uri} failed validation"
         logger.exception(message)
+        report_name = (
+            _report_validation_problems(import_object, err.problems, checkpoint)
+            if isinstance(err, ValidationProblemsException)
+            else None
+        )
+        failure_notification = Notification(
+            template="failure_report" if report_name else "failure",
+            destination=[import_object.user],
+            subject=f"There is a technical error with your reference data file {import_object.file}",
+            template_data={
+                "agreement": import_object.agreement,
+                "file": import_object.file,
+                "reason": err.args[0],
+                **({"report_name": report_name} if report_name else {}),
+            },
+        )
         try:
-            _send_email(
-                destination=[import_object.user],
-                subject=f"There is a technical error with your reference data file {import_object.file}",
-                html_message=validation_failure_template.render(
-                    agreement=import_object.agreement,
-                    file=import_object.file,
-                    reason=err.args[0],
-                ),
-                source=SOURCE_EMAIL_ADDRESS,
-            )
-        except ClientError:
+            checkpoint.run(ForwarderStep.NOTIFY, lambda: _notify(failure_notification))
+        except (ClientError, NotificationException):
             message = "Failed to send validation failure notification email to user."
             logger.exception(message)
             return {
@@ -104,7 +386,7 @@ def lambda_handler(event: dict, _: LambdaContext) -> DataInForwarderOutput:
                 "body": json.dumps({"message": message}),
             }
         try:
-            _move_s3_object(import_object, IMPORT_DATA_REJECTED_BUCKET_NAME)
+            _move_s3_object(import_object, IMPORT_DATA_REJECTED_BUCKET_NAME, checkpoint)
         except (ClientError, S3ObjectMoveException):
             message = (
                 f"Failed to move data object {import_object.s3_uri} to rejected bucket"
@@ -117,147 +399,887 @@ def lambda_handler(event: dict, _: LambdaContext) -> DataInForwarderOutput:
         return {
             "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
             "body": json.dumps({"message": message}),
+            "retryable": False,
         }
 
-    # Move the S3 object to the target bucket
-    try:
-        _move_s3_object(import_object, IMPORT_DATA_PENDING_BUCKET_NAME)
-    except (ClientError, S3ObjectMoveException):
-        message = f"Failed to move data object {import_object.s3_uri} to pending bucket"
-        logger.exception(message)
-        return {
-            "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
-            "body": json.dumps({"message": message}),
-        }
+    # Move the S3 object to the target bucket, unless its content has already been forwarded
+    if validation_result.duplicate_of:
+        try:
+            checkpoint.run(
+                ForwarderStep.DELETE_SOURCE, lambda: _delete_s3_object(import_object)
+            )
+        except ClientError:
+            message = f"Failed to remove duplicate data object {import_object.s3_uri}"
+            logger.exception(message)
+            return {
+                "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
+                "body": json.dumps({"message": message}),
+            }
+    else:
+        try:
+            _move_s3_object(
+                import_object,
+                IMPORT_DATA_PENDING_BUCKET_NAME,
+                checkpoint,
+                validation_result,
+            )
+        except (ClientError, S3ObjectMoveException):
+            message = (
+                f"Failed to move data object {import_object.s3_uri} to pending bucket"
+            )
+            logger.exception(message)
+            return {
+                "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
+                "body": json.dumps({"message": message}),
+            }
+        if validation_result.content_hash:
+            _record_content_verdict(
+                import_object,
+                validation_result.content_hash,
+                validation_result.schema_digest,
+                ContentVerdict(
+                    accepted=True,
+                    s3_uri=f"s3://{IMPORT_DATA_PENDING_BUCKET_NAME}/{import_object.key}",
+                ),
+            )
 
     # Notify the user that automated checks have passed
-    try:
-        _send_email(
+    if validation_result.duplicate_of:
+        success_notification = Notification(
+            template="duplicate",
+            destination=[import_object.user],
+            subject=f"Your reference data file {import_object.file} is a duplicate",
+            template_data={
+                "agreement": import_object.agreement,
+                "file": import_object.file,
+                "original_file": validation_result.duplicate_of.split("/")[-1],
+            },
+        )
+    else:
+        success_notification = Notification(
+            template="success",
             destination=[import_object.user],
             subject=f"We have received your reference data file {import_object.file}",
-            html_message=validation_success_template.render(
-                agreement=import_object.agreement, file=import_object.file
-            ),
-            source=SOURCE_EMAIL_ADDRESS,
+            template_data={
+                "agreement": import_object.agreement,
+                "file": import_object.file,
+            },
         )
-    except ClientError:
+    try:
+        checkpoint.run(ForwarderStep.NOTIFY, lambda: _notify(success_notification))
+    except (ClientError, NotificationException):
         message = "Failed to send validation success notification email to user."
         logger.exception(message)
+        # The object has already been moved, so redelivering the event would only find
+        # it again if its completed steps have been checkpointed
         return {
             "statusCode": HTTPStatus.INTERNAL_SERVER_ERROR,
             "body": json.dumps({"message": message}),
+            "retryable": checkpoint.persisted,
         }
 
+    if validation_result.duplicate_of:
+        return {
+            "statusCode": HTTPStatus.OK,
+            "body": f"Object {import_object.s3_uri} is a duplicate of {validation_result.duplicate_of}",
+        }
     return {
         "statusCode": HTTPStatus.OK,
         "body": f"Object {import_object.s3_uri} forwarded successfully",
     }
 
 
-def _validate_imported_object(s3_object_info: S3ObjectInfo) -> None:
-    """Helper function for performing validation of an S3 object"""
-    # Validate object size
-    if s3_object_info.size < 3:  # Allow for single character header and data row
-        raise ObjectValidationException(
-            f"File is too small/empty ({s3_object_info.size} bytes)"
+def _load_checkpoint(s3_object_info: S3ObjectInfo) -> ObjectCheckpoint:
+    """Helper function for loading the steps completed for a version of an object"""
+    persisted = bool(STATE_TABLE_NAME and s3_object_info.etag)
+    return ObjectCheckpoint(
+        state_store if persisted else None,
+        f"checkpoint#{s3_object_info.bucket}#{s3_object_info.key}#{s3_object_info.etag}",
+        VERDICT_CACHE_TTL_IN_SECONDS,
+        logger,
+    )
+
+
+def _validate_imported_object(
+    s3_object_info: S3ObjectInfo, checkpoint: ObjectCheckpoint
+) -> ValidationResult:
+    """Helper function for validating an S3 object, reusing any cached verdict for it
+
+    The Parquet file is written as rows are validated, so an accepted object is
+    validated again if an earlier attempt didn't get as far as uploading it.
+    """
+    use_cache = bool(STATE_TABLE_NAME and s3_object_info.etag)
+    cached_verdict = _get_cached_verdict(s3_object_info) if use_cache else None
+    if (
+        cached_verdict is not None
+        and cached_verdict.accepted
+        and not cached_verdict.duplicate_of
+        and _parquet_upload_pending(checkpoint)
+    ):
+        logger.info("Validating again to convert to Parquet", etag=s3_object_info.etag)
+        cached_verdict = None
+    if cached_verdict is not None:
+        logger.info(
+            "Using cached validation verdict",
+            etag=s3_object_info.etag,
+            accepted=cached_verdict.accepted,
         )
-    if s3_object_info.size > MAX_DATA_SIZE_IN_BYTES:
-        raise ObjectValidationException(
-            f"File is too large ({s3_object_info.size} bytes)"
+        if not cached_verdict.accepted and cached_verdict.problems:
+            raise ValidationProblemsException(
+                str(cached_verdict.reason), cached_verdict.problems
+            )
+        if not cached_verdict.accepted:
+            raise ObjectValidationException(cached_verdict.reason)
+        return ValidationResult(
+            content_hash=cached_verdict.content_hash,
+            schema_digest=cached_verdict.schema_digest,
+            duplicate_of=cached_verdict.duplicate_of,
+            encoding=cached_verdict.encoding,
+            csv_format=cached_verdict.csv_format,
         )
-    # Check file extension
-    if not s3_object_info.key.endswith(".csv"):
-        ext_info = (
-            f" (.{s3_object_info.key.split('.')[-1]})"
-            if "." in s3_object_info.key
-            else ""
+
+    try:
+        validation_result = _run_validation_rules(s3_object_info)
+    except ObjectValidationException as err:
+        if use_cache:
+            _cache_verdict(
+                s3_object_info,
+                CachedVerdict(
+                    accepted=False,
+                    reason=err.args[0],
+                    problems=(
+                        err.problems
+                        if isinstance(err, ValidationProblemsException)
+                        else []
+                    ),
+                ),
+            )
+        raise
+    if use_cache:
+        _cache_verdict(
+            s3_object_info,
+            CachedVerdict(
+                accepted=True,
+                content_hash=validation_result.content_hash,
+                schema_digest=validation_result.schema_digest,
+                duplicate_of=validation_result.duplicate_of,
+                encoding=validation_result.encoding,
+                csv_format=validation_result.csv_format,
+            ),
+        )
+    return validation_result
+
+
+def _run_validation_rules(s3_object_info: S3ObjectInfo) -> ValidationResult:
+    """Helper function for performing validation of an S3 object
+
+    Rules run from the cheapest metadata checks to the checks on the streamed body,
+    stopping at the first failure unless VALIDATION_REPORT_MAX_PROBLEMS is set. The time
+    spent in each rule is logged.
+    """
+    context = ValidationContext(
+        s3_object_info, max_problems=VALIDATION_REPORT_MAX_PROBLEMS
+    )
+    validation_result = ValidationResult()
+    parquet_converter = None
+    try:
+        validation_rules.run(RuleStage.OBJECT, context)
+        parquet_converter = _start_parquet_conversion(context)
+        on_valid_rows = parquet_converter.add_rows if parquet_converter else None
+        try:
+            if STATE_TABLE_NAME:
+                _validate_indexed_object(context, validation_result, on_valid_rows)
+            else:
+                _validate_streamed_object(context, on_valid_rows)
+        except Exception:
+            # The temporary file is released now, rather than whenever it's collected
+            if parquet_converter is not None:
+                parquet_converter.close()
+            raise
+    except ObjectValidationException as err:
+        # A failure that stopped the rows being read, e.g. a malformed row, ends the
+        # problems already collected
+        if context.problems and not isinstance(err, ValidationProblemsException):
+            context.problems.append(ValidationProblem(err.args[0]))
+            raise context.problems_found() from err
+        raise
+    finally:
+        logger.info(
+            "Validation rule timings",
+            rule_timings_ms=context.rule_timings_ms,
+            rows_in_file=context.rows_in_file,
+            s3_requests=context.s3_requests,
+            encoding=context.encoding,
+            csv_format=context.csv_format,
+        )
+    validation_result.encoding = context.encoding
+    validation_result.csv_format = context.csv_format
+    if parquet_converter is not None:
+        validation_result.parquet_file = parquet_converter.finish()
+    return validation_result
+
+
+def _start_parquet_conversion(context: ValidationContext) -> Optional[ParquetConverter]:
+    """Helper function for converting an object's rows to Parquet as they're validated"""
+    if not CONVERT_TO_PARQUET:
+        return None
+    if not parquet_available():
+        logger.warning("Not converting to Parquet, as pyarrow isn't installed")
+        return None
+    return ParquetConverter(tempfile.TemporaryFile(), context.schema)
+
+
+def _parquet_upload_pending(checkpoint: ObjectCheckpoint) -> bool:
+    """Helper function for checking if an object still needs its Parquet file uploaded
+
+    Once the CSV has been copied the object won't be converted again, e.g. when an
+    earlier attempt abandoned the conversion.
+    """
+    return (
+        CONVERT_TO_PARQUET
+        and parquet_available()
+        and ForwarderStep.PARQUET not in checkpoint.completed
+        and ForwarderStep.COPY not in checkpoint.completed
+    )
+
+
+def _get_cached_verdict(s3_object_info: S3ObjectInfo) -> Optional[CachedVerdict]:
+    """Helper function for looking up a cached verdict, treating errors as a miss"""
+    try:
+        return verdict_cache.get(
+            s3_object_info.bucket, s3_object_info.key, str(s3_object_info.etag)
         )
+    except Exception:
+        logger.exception("Unable to look up cached validation verdict")
+        return None
+
+
+def _cache_verdict(s3_object_info: S3ObjectInfo, verdict: CachedVerdict) -> None:
+    """Helper function for caching a verdict, which only loses the chance to reuse it on failure"""
+    try:
+        verdict_cache.put(
+            s3_object_info.bucket, s3_object_info.key, str(s3_object_info.etag), verdict
+        )
+    except Exception:
+        logger.exception("Unable to cache validation verdict")
+
+
+def _validate_streamed_object(
+    context: ValidationContext, on_valid_rows: Optional[RowsCallback] = None
+) -> None:
+    """Helper function for validating the body of an object as it is streamed from S3
+
+    Only a sample from the start is fetched until the header and first rows have passed.
+    """
+    s3_object_info = context.s3_object_info
+    s3_object_reader = S3ObjectReader(
+        s3, s3_object_info.bucket, s3_object_info.key, HEADER_SAMPLE_SIZE_IN_BYTES
+    )
+    try:
+        # The buffer holds the whole sample, so the rows in it can be counted
+        _validate_csv_body(
+            io.BufferedReader(s3_object_reader, HEADER_SAMPLE_SIZE_IN_BYTES),
+            context,
+            on_valid_rows,
+        )
+    except ClientError as err:
+        message = "Unable to read object for validation"
+        logger.exception(message)
+        raise ObjectValidationException(message) from err
+    finally:
+        s3_object_reader.close()
+        context.s3_requests = s3_object_reader.requests_made
+
+
+def _validate_indexed_object(
+    context: ValidationContext,
+    validation_result: ValidationResult,
+    on_valid_rows: Optional[RowsCallback] = None,
+) -> None:
+    """Helper function for validating the body of an object, unless its content is indexed
+
+    The object is downloaded to a temporary file once, hashing it as it's streamed, so
+    the verdict given to identical content can be reused without validating it again.
+    """
+    s3_object_info = context.s3_object_info
+    with tempfile.TemporaryFile() as object_file:
+        try:
+            content_hash = _download_s3_object(s3_object_info, object_file)
+        except ClientError as err:
+            message = "Unable to read object for validation"
+            logger.exception(message)
+            raise ObjectValidationException(message) from err
+        finally:
+            context.s3_requests = 1
+        validation_result.content_hash = content_hash
+        # Verdicts given under another version of the schema aren't reused
+        schema_digest = context.schema.digest if context.schema else None
+        validation_result.schema_digest = schema_digest
+
+        verdict = _get_content_verdict(s3_object_info, content_hash, schema_digest)
+        if verdict is not None:
+            logger.info(
+                "Content has already been validated",
+                content_hash=content_hash,
+                accepted=verdict.accepted,
+                s3_uri=verdict.s3_uri,
+            )
+            if not verdict.accepted:
+                raise ObjectValidationException(verdict.reason)
+            if _forwarded_object_exists(verdict.s3_uri):
+                validation_result.duplicate_of = verdict.s3_uri
+                return
+            logger.info("Content forwarded earlier is gone, forwarding it again")
+
+        object_file.seek(0)
+        try:
+            _validate_csv_body(object_file, context, on_valid_rows)
+        except ObjectValidationException as err:
+            _record_content_verdict(
+                s3_object_info,
+                content_hash,
+                schema_digest,
+                ContentVerdict(
+                    accepted=False,
+                    s3_uri=f"s3://{IMPORT_DATA_REJECTED_BUCKET_NAME}/{s3_object_info.key}",
+                    reason=err.args[0],
+                ),
+            )
+            raise
+
+
+def _validate_csv_body(
+    body: Union[io.BufferedReader, io.BufferedRandom],
+    context: ValidationContext,
+    on_valid_rows: Optional[RowsCallback] = None,
+) -> None:
+    """Helper function for streaming the body of an object through the CSV checks
+
+    Compressed bodies are decompressed as they're streamed. The encoding and CSV dialect
+    are detected from a sample at the start of the (decompressed) body. Batches of rows
+    that pass the checks are passed to on_valid_rows.
+    """
+    s3_object_info = context.s3_object_info
+    compression = detect_compression(s3_object_info.key)
+    if compression is not None:
+        body = io.BufferedReader(
+            DecompressingReader(
+                body,
+                compression,
+                max(
+                    MAX_DATA_SIZE_IN_BYTES,
+                    s3_object_info.size * MAX_DECOMPRESSION_RATIO,
+                ),
+            )
+        )
+    # Peeking returns everything buffered, which for a streamed object is the sample
+    buffered = body.peek(ENCODING_SAMPLE_SIZE_IN_BYTES)
+    sample = buffered[:ENCODING_SAMPLE_SIZE_IN_BYTES]
+    context.encoding = detect_encoding(sample)
+    context.csv_format = detect_csv_format(decode_sample(sample, context.encoding))
+    validate_csv_rows(
+        csv.reader(
+            io.TextIOWrapper(body, encoding=context.encoding, newline=""),
+            **context.csv_format,
+        ),
+        context,
+        on_valid_rows=on_valid_rows,
+        # The lines complete in the buffer are checked before anything more is read, so
+        # a bad row in the sample is rejected without fetching the rest of the object
+        first_batch_size=decode_sample(buffered, context.encoding).count("\n"),
+    )
+
+
+def _download_s3_object(s3_object_info: S3ObjectInfo, file: BinaryIO) -> str:
+    """Helper function for downloading an object to a file, returning its SHA-256 hash"""
+    content_hash = hashlib.sha256()
+    body = s3.get_object(Bucket=s3_object_info.bucket, Key=s3_object_info.key)["Body"]
+    try:
+        for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE_IN_BYTES):
+            content_hash.update(chunk)
+            file.write(chunk)
+    finally:
+        body.close()
+    return content_hash.hexdigest()
+
+
+def _get_content_verdict(
+    s3_object_info: S3ObjectInfo, content_hash: str, schema_digest: Optional[str]
+) -> Optional[ContentVerdict]:
+    """Helper function for looking up content in the index, treating errors as a miss"""
+    try:
+        return content_index.get(
+            str(s3_object_info.agreement), content_hash, schema_digest
+        )
+    except Exception:
+        logger.exception("Unable to look up content in the index")
+        return None
+
+
+def _record_content_verdict(
+    s3_object_info: S3ObjectInfo,
+    content_hash: str,
+    schema_digest: Optional[str],
+    verdict: ContentVerdict,
+) -> None:
+    """Helper function for recording a verdict, which only loses the chance to reuse it on failure"""
+    try:
+        content_index.put(
+            str(s3_object_info.agreement), content_hash, verdict, schema_digest
+        )
+    except Exception:
+        logger.exception("Unable to record content in the index")
+
+
+@validation_rules.register("file_size", RuleStage.OBJECT, cost=0)
+def _check_file_size(context: ValidationContext) -> None:
+    """Validate object size"""
+    size = context.s3_object_info.size
+    if size < 3:  # Allow for single character header and data row
+        raise ObjectValidationException(f"File is too small/empty ({size} bytes)")
+    if size > MAX_DATA_SIZE_IN_BYTES:
+        raise ObjectValidationException(f"File is too large ({size} bytes)")
+
+
+@validation_rules.register("file_extension", RuleStage.OBJECT, cost=1)
+def _check_file_extension(context: ValidationContext) -> None:
+    """Check file extension, which may be for a compressed CSV file"""
+    key = context.s3_object_info.key
+    if not key.endswith(".csv") and detect_compression(key) is None:
+        ext_info = f" (.{key.split('.')[-1]})" if "." in key else ""
         raise ObjectValidationException(
             f"File doesn't have required '.csv' extension{ext_info}"
         )
-    # Validate that an object with the same key doesn't already exist in pending
+
+
+def _forwarded_object_exists(s3_uri: str) -> bool:
+    """Helper function for checking content forwarded earlier is still pending
+
+    Once the earlier object has been picked up from the pending bucket, identical content
+    has to be forwarded again rather than being dropped as a duplicate.
+    """
+    bucket, _, key = s3_uri.removeprefix("s3://").partition("/")
     try:
-        existing_objects_response = s3.list_objects_v2(
-            Bucket=IMPORT_DATA_PENDING_BUCKET_NAME, Prefix=s3_object_info.key
+        return _s3_object_exists(bucket, key)
+    except ClientError:
+        logger.exception(f"Unable to check if {s3_uri} still exists")
+        return False
+
+
+@validation_rules.register("pending_duplicate", RuleStage.OBJECT, cost=100)
+def _check_not_pending(context: ValidationContext) -> None:
+    """Validate that an object with the same key doesn't already exist in pending"""
+    try:
+        exists = _s3_object_exists(
+            IMPORT_DATA_PENDING_BUCKET_NAME, context.s3_object_info.key
         )
     except ClientError as err:
         raise ObjectValidationException(
             "Unable to check if file already exists"
         ) from err
-    existing_objects = [
-        obj["Key"] for obj in existing_objects_response.get("Contents", [])
-    ]
-    if s3_object_info.key in existing_objects:
-        raise ObjectValidationException(
-            "A file with the same name is still being processed.\n\n"
-            "Please email england.sde.input-checks@nhs.net if you would like the new file to replace "
-            "the one being processed."
-        )
-    # Read the object into memory for remaining validation
+    if not exists:
+        return
+    raise ObjectValidationException(
+        "A file with the same name is still being processed.\n\n"
+        "Please email england.sde.input-checks@nhs.net if you would like the new file to replace "
+        "the one being processed."
+    )
+
+
+def _s3_object_exists(bucket: str, key: str) -> bool:
+    """Helper function for checking an object exists, with only s3:ListBucket
+
+    Keys are listed in order, so the key itself comes first of those it prefixes, and a
+    single key is listed however many others share the prefix.
+    """
+    response = s3.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+    return any(obj["Key"] == key for obj in response.get("Contents", []))
+
+
+@validation_rules.register("agreement_schema", RuleStage.OBJECT, cost=200)
+def _load_agreement_schema(context: ValidationContext) -> None:
+    """Load the schema the agreement's files are checked against, if it has one"""
+    agreement = context.s3_object_info.agreement
+    if not SCHEMA_BUCKET_NAME or agreement is None:
+        return
     try:
-        s3_object_get_response = s3.get_object(**s3_object_info.object_location)
-    except ClientError as err:
-        message = "Unable to read object for validation"
+        context.schema = schema_registry.get(agreement)
+    except (ClientError, KeyError, TypeError, ValueError) as err:
+        message = "Unable to load the schema for the agreement"
         logger.exception(message)
         raise ObjectValidationException(message) from err
 
-    s3_object_data = codecs.getreader(CHARSET)(s3_object_get_response["Body"])
-    # Validate valid CSV
 
+def _report_validation_problems(
+    s3_object_info: S3ObjectInfo, problems: list[dict], checkpoint: ObjectCheckpoint
+) -> Optional[str]:
+    """Helper function for writing the report of the problems found with an object
+
+    The report is written next to where the object is moved to in the rejected bucket.
+    It quotes the file's contents, so users are given its name to ask the service for
+    it rather than a link. Returns the name, or None if it couldn't be written.
+    """
+    report_key = f"{s3_object_info.key}.report.{VALIDATION_REPORT_FORMAT}"
+    report = format_validation_report(
+        s3_object_info.file,
+        problems,
+        len(problems) >= VALIDATION_REPORT_MAX_PROBLEMS,
+        VALIDATION_REPORT_FORMAT,
+    )
     try:
-        csv_data = [row for row in csv.reader(s3_object_data) if row]
-    except (csv.Error, UnicodeDecodeError) as err:
-        raise ObjectValidationException("File is not a valid CSV file") from err
-
-    # Check number of rows (expect more than 1)
-    rows_in_file = len(csv_data)
-    if rows_in_file < 2:
-        raise ObjectValidationException(f"File has too few rows ({rows_in_file})")
-
-    # Validate headers match naming convention for dbx
-    for headers in csv_data[0]:
-        if re.search(r"[^a-zA-Z0-9_]", headers):
-            raise ObjectValidationException(
-                "Headers within the file contain spaces or special characters."
-            )
+        checkpoint.run(
+            ForwarderStep.REPORT,
+            lambda: s3.put_object(
+                Bucket=IMPORT_DATA_REJECTED_BUCKET_NAME,
+                Key=report_key,
+                Body=report,
+                ContentType=REPORT_CONTENT_TYPES[VALIDATION_REPORT_FORMAT],
+                ACL="bucket-owner-full-control",
+            ),
+        )
+    except ClientError:
+        # The user is still told the first problem, just without the full report
+        logger.exception(f"Failed to write validation report {report_key}")
+        return None
+    return report_key.split("/")[-1]
 
-    num_header_cols = len(csv_data[0])
-    for row_num, row_data in enumerate(csv_data):
-        # Check each row has the right amount of columns
-        cols = len(row_data)
-        if cols != num_header_cols:
-            raise ObjectValidationException(
-                f"Line {row_num + 1} has {cols} columns, but the header row has {num_header_cols}"
-            )
-    # Checks for line breaks in csv
-    for row_num, row_data in enumerate(csv_data):
-        for col_num, col_data in enumerate(row_data):
-            if "\n" in col_data:
-                raise ObjectValidationException(
-                    "Data within the file contains line break"
-                )
 
-    # validate empty header
-    for header_index, header in enumerate(csv_data[0], start=1):
-        if header == "":
-            raise ObjectValidationException(
-                f"There are {num_header_cols} headers, but the header at column {header_index} is empty."
+def _move_s3_object(
+    s3_object_info: S3ObjectInfo,
+    target_bucket: str,
+    checkpoint: ObjectCheckpoint,
+    validation_result: Optional[ValidationResult] = None,
+) -> None:
+    """Helper function for moving objects in S3, skipping steps that already completed
+
+    Validated objects with an encoding other than UTF-8 are converted to UTF-8 as they
+    are copied. Objects in another CSV dialect are also rewritten as comma separated if
+    NORMALISE_CSV is set. Compressed objects are always forwarded as they were uploaded.
+    Objects converted to Parquet have that uploaded next to them first.
+    """
+    parquet_file = validation_result.parquet_file if validation_result else None
+    if parquet_file is not None:
+        with parquet_file:
+            checkpoint.run(
+                ForwarderStep.PARQUET,
+                lambda: s3.upload_fileobj(
+                    parquet_file,
+                    target_bucket,
+                    _parquet_key(s3_object_info.key),
+                    ExtraArgs={"ACL": "bucket-owner-full-control"},
+                ),
             )
+    encoding = validation_result.encoding if validation_result else None
+    csv_format = validation_result.csv_format if validation_result else {}
+    if detect_compression(s3_object_info.key) is not None:
+        encoding, csv_format = None, {}
+    if (encoding and needs_transcoding(encoding)) or (NORMALISE_CSV and csv_format):
+        checkpoint.run(
+            ForwarderStep.COPY,
+            lambda: _rewrite_s3_object(
+                s3_object_info, target_bucket, encoding or "utf-8", csv_format
+            ),
+        )
+    else:
+        checkpoint.run(
+            ForwarderStep.COPY, lambda: _copy_s3_object(s3_object_info, target_bucket)
+        )
+    checkpoint.run(
+        ForwarderStep.DELETE_SOURCE, lambda: _delete_s3_object(s3_object_info)
+    )
+
+
+def _parquet_key(key: str) -> str:
+    """Helper function for the key of an object's Parquet conversion"""
+    for extension in (".csv", *COMPRESSED_EXTENSIONS):
+        if key.endswith(extension):
+            return f"{key[: -len(extension)]}.parquet"
+    return f"{key}.parquet"
+
+
+def _copy_s3_object(s3_object_info: S3ObjectInfo, target_bucket: str) -> None:
+    """Helper function for copying objects in S3"""
+    if s3_object_info.size > MULTIPART_COPY_THRESHOLD_IN_BYTES:
+        _multipart_copy_s3_object(s3_object_info, target_bucket)
+    else:
+        copy_response = s3.copy_object(
+            Bucket=target_bucket,
+            Key=s3_object_info.key,
+            CopySource=s3_object_info.object_location,
+            ACL="bucket-owner-full-control",
+        )
+        if not copy_response.get("CopyObjectResult", {}).get("ETag"):
+            raise S3ObjectMoveException("Data copy failed due to unknown error.")
+
+
+def _rewrite_s3_object(
+    s3_object_info: S3ObjectInfo,
+    target_bucket: str,
+    encoding: str,
+    csv_format: dict[str, Any],
+) -> None:
+    """Helper function for copying objects in S3 as UTF-8, streaming them through
+
+    Objects in another CSV dialect are also rewritten as comma separated if NORMALISE_CSV
+    is set.
+    """
+    s3_object_reader = S3ObjectReader(
+        s3, s3_object_info.bucket, s3_object_info.key, HEADER_SAMPLE_SIZE_IN_BYTES
+    )
+    decoded = io.TextIOWrapper(
+        io.BufferedReader(s3_object_reader), encoding=encoding, newline=""
+    )
+    text: io.TextIOBase = decoded
+    if NORMALISE_CSV and csv_format:
+        text = CanonicalCSVReader(decoded, csv_format)
+    with UTF8Reader(text) as utf8_reader:
+        s3.upload_fileobj(
+            utf8_reader,
+            target_bucket,
+            s3_object_info.key,
+            ExtraArgs={"ACL": "bucket-owner-full-control"},
+        )
+
+
+def _delete_s3_object(s3_object_info: S3ObjectInfo) -> None:
+    """Helper function for removing objects from their original location"""
+    s3.delete_object(Bucket=s3_object_info.bucket, Key=s3_object_info.key)
 
 
-def _move_s3_object(s3_object_info: S3ObjectInfo, target_bucket: str) -> None:
-    """Helper function for moving objects in S3"""
-    # Copy object to new location
-    copy_response = s3.copy_object(
+def _multipart_copy_s3_object(s3_object_info: S3ObjectInfo, target_bucket: str) -> None:
+    """Helper function for copying large objects as parallel ranged parts
+
+    The multipart upload is aborted if any part fails, so no partial object is left behind.
+    """
+    part_size = max(
+        MULTIPART_COPY_PART_SIZE_IN_BYTES,
+        math.ceil(s3_object_info.size / MAX_MULTIPART_PARTS),
+    )
+    part_ranges = [
+        (part_number, first_byte, min(first_byte + part_size, s3_object_info.size) - 1)
+        for part_number, first_byte in enumerate(
+            range(0, s3_object_info.size, part_size), start=1
+        )
+    ]
+    upload_id = s3.create_multipart_upload(
         Bucket=target_bucket,
         Key=s3_object_info.key,
-        CopySource=s3_object_info.object_location,
         ACL="bucket-owner-full-control",
+    )["UploadId"]
+
+    def copy_part(part_range: tuple[int, int, int]) -> dict:
+        part_number, first_byte, last_byte = part_range
+        part_response = s3.upload_part_copy(
+            Bucket=target_bucket,
+            Key=s3_object_info.key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource=s3_object_info.object_location,
+            CopySourceRange=f"bytes={first_byte}-{last_byte}",
+        )
+        etag = part_response.get("CopyPartResult", {}).get("ETag")
+        if not etag:
+            raise S3ObjectMoveException(
+                f"Data copy of part {part_number} failed due to unknown error."
+            )
+        return {"ETag": etag, "PartNumber": part_number}
+
+    try:
+        with ThreadPoolExecutor(max_workers=MULTIPART_COPY_MAX_WORKERS) as executor:
+            parts = list(executor.map(copy_part, part_ranges))
+        complete_response = s3.complete_multipart_upload(
+            Bucket=target_bucket,
+            Key=s3_object_info.key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        if not complete_response.get("ETag"):
+            raise S3ObjectMoveException("Data copy failed due to unknown error.")
+    except (ClientError, S3ObjectMoveException):
+        logger.exception(f"Multipart copy of {s3_object_info.s3_uri} failed, aborting")
+        try:
+            # Needs s3:AbortMultipartUpload on the target bucket
+            s3.abort_multipart_upload(
+                Bucket=target_bucket, Key=s3_object_info.key, UploadId=upload_id
+            )
+        except ClientError:
+            # The copy's error is raised rather than this one, though the incomplete
+            # upload is left in the bucket until it's aborted
+            logger.exception(f"Failed to abort multipart upload {upload_id}")
+        raise
+
+
+def _notify(notification: Notification) -> None:
+    """Helper function for queueing a notification, or sending it if there is no queue"""
+    if NOTIFICATION_QUEUE_URL:
+        sqs.send_message(
+            QueueUrl=NOTIFICATION_QUEUE_URL, MessageBody=notification.to_message()
+        )
+        return
+    error_code = _deliver_notifications([notification])[0]
+    if error_code is not None:
+        raise NotificationException(f"Notification could not be sent ({error_code})")
+
+
+def _deliver_queued_notifications(
+    notification_records: list[tuple[SQSRecord, Notification]],
+) -> set[str]:
+    """Helper function for sending queued notifications, returning the failed message ids
+
+    Failed notifications are redelivered after a delay that doubles with each attempt, so
+    SES throttling isn't made worse by retrying straight away.
+    """
+    failed_message_ids = set()
+    error_codes = _deliver_notifications(
+        [notification for _, notification in notification_records]
     )
-    if not copy_response.get("CopyObjectResult", {}).get("ETag"):
-        raise S3ObjectMoveException("Data copy failed due to unknown error.")
-    # Remove object from original location
-    s3.delete_object(Bucket=s3_object_info.bucket, Key=s3_object_info.key)
+    for (sqs_record, _), error_code in zip(notification_records, error_codes):
+        if error_code is None:
+            continue
+        if error_code in SES_NON_RETRYABLE_ERROR_CODES:
+            logger.error(
+                f"Notification in message {sqs_record.message_id} was rejected by SES",
+                error_code=error_code,
+            )
+            continue
+        logger.error(
+            f"Failed to send notification in message {sqs_record.message_id}",
+            error_code=error_code,
+        )
+        failed_message_ids.add(sqs_record.message_id)
+        _delay_notification_retry(sqs_record)
+    return failed_message_ids
+
+
+def _delay_notification_retry(sqs_record: SQSRecord) -> None:
+    """Helper function for backing off before a failed notification is redelivered"""
+    attempts = int(sqs_record.attributes.get("ApproximateReceiveCount") or 1)
+    delay = min(
+        NOTIFICATION_RETRY_BASE_DELAY_IN_SECONDS * 2 ** (attempts - 1),
+        NOTIFICATION_RETRY_MAX_DELAY_IN_SECONDS,
+    )
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=NOTIFICATION_QUEUE_URL,
+            ReceiptHandle=sqs_record.receipt_handle,
+            VisibilityTimeout=delay,
+        )
+    except ClientError:
+        # The message is still redelivered, just after the queue's visibility timeout
+        logger.exception(f"Unable to delay retry of message {sqs_record.message_id}")
+
+
+def _deliver_notifications(notifications: list[Notification]) -> list[Optional[str]]:
+    """Helper function for sending notifications, returning an error code for each that failed
+
+    With SES templates, notifications are sent in bulk for each template rather than
+    being rendered and sent one at a time.
+    """
+    error_codes: list[Optional[str]] = [None] * len(notifications)
+    if not SES_TEMPLATE_PREFIX:
+        for index, notification in enumerate(notifications):
+            try:
+                _deliver_notification(notification)
+            except ClientError as err:
+                logger.exception("Failed to send notification email")
+                error_codes[index] = _client_error_code(err)
+        return error_codes
+
+    indexes_by_template: dict[str, list[int]] = defaultdict(list)
+    for index, notification in enumerate(notifications):
+        indexes_by_template[notification.template].append(index)
+    for template, indexes in indexes_by_template.items():
+        for first in range(0, len(indexes), MAX_BULK_EMAIL_DESTINATIONS):
+            batch = indexes[first : first + MAX_BULK_EMAIL_DESTINATIONS]
+            try:
+                statuses = _send_bulk_templated_email(
+                    template, [notifications[index] for index in batch]
+                )
+            except ClientError as err:
+                logger.exception(f"Failed to send {template} notification emails")
+                statuses = [{"Status": _client_error_code(err)}] * len(batch)
+            for index, status in zip(batch, statuses):
+                if status["Status"] != "Success":
+                    error_codes[index] = status["Status"]
+    return error_codes
+
+
+def _deliver_notification(notification: Notification) -> None:
+    """Helper function for rendering and sending a notification email"""
+    _send_email(
+        destination=notification.destination,
+        subject=notification.subject,
+        html_message=NOTIFICATION_TEMPLATES[notification.template].render(
+            **notification.template_data
+        ),
+        source=SOURCE_EMAIL_ADDRESS,
+    )
+
+
+def _send_bulk_templated_email(
+    template: str, notifications: list[Notification]
+) -> list[dict]:
+    """Helper function for sending notifications using the same template in one request"""
+    template_name = _get_ses_template_name(template)
+    response = ses.send_bulk_templated_email(
+        Source=SOURCE_EMAIL_ADDRESS,
+        Template=template_name,
+        DefaultTemplateData="{}",
+        Destinations=[
+            {
+                "Destination": {"ToAddresses": notification.destination},
+                "ReplacementTemplateData": json.dumps(
+                    {**notification.template_data, "subject": notification.subject}
+                ),
+            }
+            for notification in notifications
+        ],
+    )
+    statuses = response["Status"]
+    if any(status["Status"] == "TemplateDoesNotExist" for status in statuses):
+        # Register the template again before the notifications are retried
+        with ses_templates_lock:
+            ses_template_names.pop(template, None)
+    return statuses
+
+
+def _get_ses_template_name(template: str) -> str:
+    """Helper function for getting the SES template for a notification template
+
+    The SES template is derived from the Jinja one by rendering it with Handlebars
+    placeholders, and is created the first time it is used. It is named after a hash of
+    its content, so changing a template creates a new SES template rather than changing
+    the one in use by running lambdas.
+    """
+    with ses_templates_lock:
+        if template in ses_template_names:
+            return ses_template_names[template]
+        html = NOTIFICATION_TEMPLATES[template].render(
+            **{
+                variable: f"{{{{{variable}}}}}"
+                for variable in NOTIFICATION_TEMPLATE_VARIABLES[template]
+            }
+        )
+        digest = hashlib.sha256(html.encode(CHARSET)).hexdigest()[:16]
+        template_name = f"{SES_TEMPLATE_PREFIX}{template}-{digest}"
+        try:
+            ses.create_template(
+                Template={
+                    "TemplateName": template_name,
+                    # Triple braces, as the subject is plain text rather than HTML
+                    "SubjectPart": "{{{subject}}}",
+                    "HtmlPart": html,
+                }
+            )
+        except ClientError as err:
+            if _client_error_code(err) != "AlreadyExists":
+                raise
+        ses_template_names[template] = template_name
+        return template_name
+
+
+def _client_error_code(err: ClientError) -> str:
+    return err.response.get("Error", {}).get("Code") or "Unknown"
 
 
 def _send_email(
@@ -0,0 +1,69 @@
+"""Module to hold the checkpoints of the steps taken to forward an imported object"""
+
+from enum import Enum
+from typing import Any, Callable, Optional
+
+from aws_lambda_powertools.logging import Logger
+
+
+class ForwarderStep(str, Enum):
+    """The steps taken once an object has been validated, in whichever order the outcome needs
+
+    Validation itself is checkpointed by the verdict cache.
+    """
+
+    REPORT = "report"  # Write the report of the problems found to the rejected bucket
+    PARQUET = "parquet"  # Upload the object's Parquet conversion to the pending bucket
+    COPY = "copy"  # Copy the object to the pending or rejected bucket
+    DELETE_SOURCE = "delete_source"  # Remove the object from the landing bucket
+    NOTIFY = "notify"  # Tell the user the outcome
+
+
+class ObjectCheckpoint:
+    """The steps completed for a version of an object, persisted as each one completes
+
+    When an event is redelivered, steps that completed before the failure are skipped
+    rather than repeated, so retries don't copy objects or email users again. Without a
+    store, every step is run.
+    """
+
+    def __init__(
+        self, store: Optional[Any], key: str, ttl_seconds: int, logger: Logger
+    ) -> None:
+        self._store = store
+        self._key = key
+        self._ttl_seconds = ttl_seconds
+        self._logger = logger
+        self.completed: set[ForwarderStep] = set()
+        if store is not None:
+            try:
+                item = store.get(key)
+            except Exception:
+                logger.exception("Unable to load checkpoint, running every step")
+                item = None
+            if item is not None:
+                self.completed = {ForwarderStep(step) for step in item["completed"]}
+
+    @property
+    def persisted(self) -> bool:
+        """Whether completed steps are recorded, so a retry would resume from them"""
+        return self._store is not None
+
+    def run(self, step: ForwarderStep, action: Callable[[], None]) -> None:
+        """Run a step unless it has already completed, recording it once it has"""
+        if step in self.completed:
+            self._logger.info(f"Skipping completed step {step.value}")
+            return
+        action()
+        self.completed.add(step)
+        if self._store is None:
+            return
+        try:
+            self._store.put(
+                self._key,
+                {"completed": sorted(step.value for step in self.completed)},
+                self._ttl_seconds,
+            )
+        except Exception:
+            # The step has still completed, it would just be repeated by a retry
+            self._logger.exception(f"Unable to checkpoint step {step.value}")
@@ -0,0 +1,202 @@
+"""Module to hold the streaming decompression of compressed imported files"""
+
+import io
+import struct
+import zlib
+from typing import Any, BinaryIO, Optional
+
+from utils.exceptions import ObjectValidationException
+
+GZIP = "gzip"
+ZIP = "zip"
+# Extensions of the compressed files accepted, and how each is compressed
+COMPRESSED_EXTENSIONS = {".csv.gz": GZIP, ".zip": ZIP}
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+ZIP_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_FLAG_ENCRYPTED = 0x1
+# The CRC and sizes follow the data, e.g. when the zip was written to a stream
+ZIP_FLAG_DATA_DESCRIPTOR = 0x8
+
+
+def detect_compression(key: str) -> Optional[str]:
+    """How an object is compressed, from the extension of its key"""
+    for extension, compression in COMPRESSED_EXTENSIONS.items():
+        if key.endswith(extension):
+            return compression
+    return None
+
+
+class _StoredDecompressor:
+    """Stands in for a zlib decompressor for zip entries that aren't compressed"""
+
+    def __init__(self, size: int) -> None:
+        self._remaining = size
+        self.eof = size == 0
+        self.unused_data = b""
+        self.unconsumed_tail = b""
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        size = min(len(data), max_length, self._remaining)
+        self._remaining -= size
+        self.eof = self._remaining == 0
+        if self.eof:
+            self.unused_data = data[size:]
+        else:
+            self.unconsumed_tail = data[size:]
+        return data[:size]
+
+
+class DecompressingReader(io.RawIOBase):
+    """Readable binary stream of the content of a gzip file, or a zip file of one CSV
+
+    The compressed stream is only read forwards, so it can be streamed straight from S3,
+    and no more than a chunk is decompressed at a time. Reading fails validation once
+    more than max_size bytes have been decompressed, so a zip bomb is rejected without
+    exhausting memory or time.
+    """
+
+    def __init__(
+        self,
+        compressed: BinaryIO,
+        compression: str,
+        max_size: int,
+        chunk_size: int = 64 * 1024,
+    ) -> None:
+        super().__init__()
+        self._compressed = compressed
+        self._compression = compression
+        self._max_size = max_size
+        self._chunk_size = chunk_size
+        self._input = b""
+        self._output = memoryview(b"")
+        self._decompressor: Optional[Any] = None
+        self._zip_flags = 0
+        self._zip_crc = 0
+        self._crc = 0
+        self._finished = False
+        self.decompressed_size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._output and not self._finished:
+            self._output = memoryview(self._decompress_next())
+        size = min(len(buffer), len(self._output))
+        buffer[:size] = self._output[:size]
+        self._output = self._output[size:]
+        return size
+
+    def close(self) -> None:
+        self._compressed.close()
+        super().close()
+
+    def _decompress_next(self) -> bytes:
+        if self._decompressor is None:
+            self._start_member()
+        decompressor = self._decompressor
+        assert decompressor is not None
+        compressed = self._input or self._compressed.read(self._chunk_size)
+        try:
+            data = decompressor.decompress(compressed, self._chunk_size)
+        except zlib.error as err:
+            raise self._invalid() from err
+        if decompressor.eof:
+            self._input = decompressor.unused_data
+        else:
+            self._input = decompressor.unconsumed_tail
+            if not compressed and not data:
+                raise self._invalid()  # The stream ended part way through
+
+        self.decompressed_size += len(data)
+        if self.decompressed_size > self._max_size:
+            raise ObjectValidationException(
+                f"File is too large once decompressed (over {self._max_size} bytes)"
+            )
+        if self._compression == ZIP:
+            self._crc = zlib.crc32(data, self._crc)
+        if decompressor.eof:
+            self._end_member()
+        return data
+
+    def _start_member(self) -> None:
+        if self._compression == GZIP:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            return
+
+        (
+            signature,
+            _,
+            self._zip_flags,
+            method,
+            _,
+            _,
+            self._zip_crc,
+            compressed_size,
+            _,
+            name_length,
+            extra_length,
+        ) = ZIP_LOCAL_HEADER.unpack(self._read_exact(ZIP_LOCAL_HEADER.size))
+        if signature != ZIP_LOCAL_HEADER_SIGNATURE:
+            raise self._invalid()
+        name = self._read_exact(name_length).decode("utf-8", errors="replace")
+        self._read_exact(extra_length)
+        if not name.endswith(".csv"):
+            raise ObjectValidationException(
+                f"Zip file must contain a single '.csv' file ({name})"
+            )
+        if self._zip_flags & ZIP_FLAG_ENCRYPTED:
+            raise ObjectValidationException("Zip file is encrypted")
+        if method == ZIP_DEFLATED:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == ZIP_STORED and not self._zip_flags & ZIP_FLAG_DATA_DESCRIPTOR:
+            self._decompressor = _StoredDecompressor(compressed_size)
+        else:
+            raise ObjectValidationException(
+                "Zip file uses an unsupported compression method"
+            )
+
+    def _end_member(self) -> None:
+        if self._compression == GZIP:
+            # Concatenated gzip files decompress to their concatenated content
+            self._input = self._input or self._compressed.read(self._chunk_size)
+            self._decompressor = None
+            self._finished = not self._input
+            return
+
+        expected_crc = self._zip_crc
+        if self._zip_flags & ZIP_FLAG_DATA_DESCRIPTOR:
+            descriptor = self._read_exact(4)
+            if descriptor == ZIP_DATA_DESCRIPTOR_SIGNATURE:
+                descriptor = self._read_exact(4)
+            (expected_crc,) = struct.unpack("<L", descriptor)
+            self._read_exact(8)  # The compressed and uncompressed sizes
+        if self._crc != expected_crc:
+            raise self._invalid()
+        # The entry is followed by the central directory, unless there are others
+        signature = self._read_exact(4)
+        if signature == ZIP_LOCAL_HEADER_SIGNATURE:
+            raise ObjectValidationException(
+                "Zip file must contain a single '.csv' file"
+            )
+        if signature != ZIP_CENTRAL_DIRECTORY_SIGNATURE:
+            raise self._invalid()
+        self._finished = True
+
+    def _read_exact(self, size: int) -> bytes:
+        while len(self._input) < size:
+            chunk = self._compressed.read(self._chunk_size)
+            if not chunk:
+                raise self._invalid()
+            self._input += chunk
+        data, self._input = self._input[:size], self._input[size:]
+        return data
+
+    def _invalid(self) -> ObjectValidationException:
+        return ObjectValidationException(
+            f"File is not a valid {self._compression} file"
+        )
@@ -0,0 +1,52 @@
+"""Module to hold the index of verdicts given to imported content"""
+
+from dataclasses import asdict, dataclass
+from typing import Any, Optional
+
+
+@dataclass
+class ContentVerdict:
+    """The outcome of validating a file with a given content"""
+
+    accepted: bool
+    s3_uri: str  # Where the file with this content was forwarded to
+    reason: Optional[str] = None  # Why the content was rejected
+
+
+class ContentIndex:
+    """Index of the verdicts given to imported content, by agreement and SHA-256 hash
+
+    Entries are scoped to the agreement, as the same content imported for a different
+    agreement still needs to be forwarded for it, and to the digest of the agreement's
+    schema, so content is validated again once the schema changes.
+    """
+
+    def __init__(self, store: Any, ttl_seconds: int) -> None:
+        self._store = store
+        self._ttl_seconds = ttl_seconds
+
+    def get(
+        self, agreement: str, content_hash: str, schema_digest: Optional[str] = None
+    ) -> Optional[ContentVerdict]:
+        """The verdict previously given to the content, if there is one"""
+        item = self._store.get(self._key(agreement, content_hash, schema_digest))
+        return ContentVerdict(**item) if item is not None else None
+
+    def put(
+        self,
+        agreement: str,
+        content_hash: str,
+        verdict: ContentVerdict,
+        schema_digest: Optional[str] = None,
+    ) -> None:
+        """Record the verdict given to the content"""
+        self._store.put(
+            self._key(agreement, content_hash, schema_digest),
+            asdict(verdict),
+            self._ttl_seconds,
+        )
+
+    @staticmethod
+    def _key(agreement: str, content_hash: str, schema_digest: Optional[str]) -> str:
+        key = f"content#{agreement}#{content_hash}"
+        return f"{key}#schema#{schema_digest}" if schema_digest else key
@@ -1,17 +1,34 @@
 """Module to hold dataclasses and typing helpers"""
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from http import HTTPStatus
-from typing import TypedDict, Union
+from typing import Any, BinaryIO, Optional, TypedDict, Union
 
 
-class DataInForwarderOutput(TypedDict):
-    """Typing class for function output"""
-
+class _DataInForwarderOutputRequired(TypedDict):
     statusCode: HTTPStatus
     body: str
 
 
+class DataInForwarderOutput(_DataInForwarderOutputRequired, total=False):
+    """Typing class for function output"""
+
+    # Set to False for errors that redelivering the event would not resolve
+    retryable: bool
+
+
+class DataInForwarderBatchOutput(DataInForwarderOutput):
+    """Typing class for function output, with the result for each object in the event"""
+
+    results: list[DataInForwarderOutput]
+
+
+class SQSBatchResponse(TypedDict):
+    """Typing class for reporting partial failures of an SQS batch"""
+
+    batchItemFailures: list[dict[str, str]]
+
+
 @dataclass
 class S3ObjectInfo:
     """Dataclass for holding information about an S3 object"""
@@ -19,6 +36,7 @@ class S3ObjectInfo:
     bucket: str
     key: str
     size: int
+    etag: Optional[str] = None
 
     @property
     def object_location(self) -> dict[str, str]:
@@ -46,3 +64,21 @@ class S3ObjectInfo:
     def file(self) -> str:
         """The file name from the key"""
         return self.key.split("/")[-1]
+
+
+@dataclass
+class ValidationResult:
+    """Dataclass for holding the outcome of validating an object that passed"""
+
+    # SHA-256 hash of the object, when its content was indexed
+    content_hash: Optional[str] = None
+    # Digest of the agreement's schema the object was checked against, if it has one
+    schema_digest: Optional[str] = None
+    # Where identical content that was already accepted was forwarded to
+    duplicate_of: Optional[str] = None
+    # Character encoding of the object, which is converted to UTF-8 when forwarded
+    encoding: Optional[str] = None
+    # csv.reader format parameters for objects not in the default excel dialect
+    csv_format: dict[str, Any] = field(default_factory=dict)
+    # Parquet conversion of the object's rows, to forward alongside it
+    parquet_file: Optional[BinaryIO] = None
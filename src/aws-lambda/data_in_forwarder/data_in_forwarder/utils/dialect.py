@@ -0,0 +1,70 @@
+"""Module to hold the detection and normalisation of the dialect of imported CSV files"""
+
+import csv
+import io
+from typing import Any, Optional, TextIO
+
+# Delimiters that files can be separated by, in order of preference when tied
+DELIMITERS = ",;\t|"
+NORMALISE_BATCH_SIZE = 1000
+
+
+def detect_csv_format(sample: str) -> dict[str, Any]:
+    """Detect the delimiter of CSV data from a sample from its start
+
+    This is returned as the csv.reader format parameters that differ from the default
+    excel dialect, so an empty dict means the data is already in that dialect. The quote
+    character is always '"', as a single quoted cell would make the sniffer choose "'"
+    for a whole file. Only the complete lines in the sample are sniffed, and data that
+    can't be sniffed, e.g. with a single column, is assumed to be in the default dialect.
+    """
+    complete_lines = sample[: sample.rfind("\n") + 1] or sample
+    try:
+        dialect = csv.Sniffer().sniff(complete_lines, delimiters=DELIMITERS)
+    except csv.Error:
+        return {}
+    if dialect.delimiter == csv.excel.delimiter:
+        return {}
+    return {"delimiter": dialect.delimiter}
+
+
+class CanonicalCSVReader(io.TextIOBase):
+    """Readable text stream of CSV data rewritten in the default excel dialect
+
+    Rows are read and rewritten in batches, so only a batch is held in memory at a time.
+    """
+
+    def __init__(self, text: TextIO, csv_format: dict[str, Any]) -> None:
+        super().__init__()
+        self._text = text
+        self._rows = csv.reader(text, **csv_format)
+        self._rewritten = ""
+        self._exhausted = False
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> str:
+        if size is None or size < 0:
+            return "".join(iter(lambda: self.read(NORMALISE_BATCH_SIZE), ""))
+        while not self._rewritten and not self._exhausted:
+            self._rewrite_batch()
+        data, self._rewritten = self._rewritten[:size], self._rewritten[size:]
+        return data
+
+    def close(self) -> None:
+        self._text.close()
+        super().close()
+
+    def _rewrite_batch(self) -> None:
+        buffer = io.StringIO()
+        writer: Any = csv.writer(buffer)
+        rows_written = 0
+        for row in self._rows:
+            writer.writerow(row)
+            rows_written += 1
+            if rows_written == NORMALISE_BATCH_SIZE:
+                break
+        else:
+            self._exhausted = True
+        self._rewritten = buffer.getvalue()
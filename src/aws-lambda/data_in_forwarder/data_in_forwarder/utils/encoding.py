@@ -0,0 +1,101 @@
+"""Module to hold the detection and conversion of the character encoding of imported files"""
+
+import codecs
+import io
+from typing import Any
+
+UTF_8 = "utf-8"
+# Longest BOMs first, as the UTF-32 LE BOM starts with the UTF-16 LE one
+BYTE_ORDER_MARKS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+# Tried in order for samples without a BOM that aren't UTF-8. Excel exports CSV files as
+# Windows-1252 on Windows, and every byte is valid Latin-1
+FALLBACK_ENCODINGS = ("cp1252", "latin-1")
+UTF_16_NUL_RATIO = 10
+# The least share of the bytes on one side that must be NULs for a sample to be UTF-16
+UTF_16_NUL_SHARE = 0.4
+
+
+def detect_encoding(sample: bytes) -> str:
+    """Detect the encoding of a file from a sample from its start
+
+    A BOM is used if there is one. Otherwise NUL bytes in alternating positions mean
+    UTF-16, and a sample that decodes as UTF-8 is taken to be UTF-8, before falling back
+    to the encodings Excel exports in.
+    """
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if sample.startswith(bom):
+            return encoding
+
+    if b"\x00" in sample:
+        # The NULs in UTF-16 text are the high bytes of ASCII characters, so are nearly
+        # all on the same side and make up much of it, unlike a few stray NULs in UTF-8.
+        # Binary files are left to fail validation as UTF-8
+        even_bytes, odd_bytes = sample[0::2], sample[1::2]
+        even_nuls, odd_nuls = even_bytes.count(0), odd_bytes.count(0)
+        if (
+            odd_nuls > UTF_16_NUL_RATIO * even_nuls
+            and odd_nuls >= UTF_16_NUL_SHARE * len(odd_bytes)
+        ):
+            return "utf-16-le"
+        if (
+            even_nuls > UTF_16_NUL_RATIO * odd_nuls
+            and even_nuls >= UTF_16_NUL_SHARE * len(even_bytes)
+        ):
+            return "utf-16-be"
+        return UTF_8
+
+    for encoding in (UTF_8, *FALLBACK_ENCODINGS):
+        try:
+            # The sample may end part way through a character, so it isn't final
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return FALLBACK_ENCODINGS[-1]
+
+
+def decode_sample(sample: bytes, encoding: str) -> str:
+    """Decode a sample from the start of a file, which may end part way through a character"""
+    return codecs.getincrementaldecoder(encoding)(errors="replace").decode(sample)
+
+
+def needs_transcoding(encoding: str) -> bool:
+    """Whether files in an encoding need converting to be forwarded as UTF-8 without a BOM"""
+    return codecs.lookup(encoding).name != UTF_8
+
+
+class UTF8Reader(io.RawIOBase):
+    """Readable binary stream of the text from a text stream, encoded as UTF-8
+
+    This lets a file be converted to UTF-8 as it is streamed, e.g. to upload_fileobj.
+    """
+
+    def __init__(self, text: io.TextIOBase, chunk_size: int = 1024 * 1024) -> None:
+        super().__init__()
+        self._text = text
+        self._chunk_size = chunk_size
+        self._encoded = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._encoded:
+            text = self._text.read(self._chunk_size)
+            if not text:
+                return 0
+            self._encoded = memoryview(text.encode(UTF_8))
+        size = min(len(buffer), len(self._encoded))
+        buffer[:size] = self._encoded[:size]
+        self._encoded = self._encoded[size:]
+        return size
+
+    def close(self) -> None:
+        self._text.close()
+        super().close()
@@ -7,3 +7,15 @@ class S3ObjectMoveException(Exception):
 
 class ObjectValidationException(Exception):
     """Exception for validation issues"""
+
+
+class ValidationProblemsException(ObjectValidationException):
+    """Exception for validation issues collected into a report, rather than only the first"""
+
+    def __init__(self, reason: str, problems: list[dict]) -> None:
+        super().__init__(reason)
+        self.problems = problems
+
+
+class NotificationException(Exception):
+    """Exception for issues sending notifications to users"""
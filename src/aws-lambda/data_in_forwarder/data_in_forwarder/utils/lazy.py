@@ -0,0 +1,40 @@
+"""Module to hold a helper for deferring expensive initialisation until first use"""
+
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+from aws_lambda_powertools.logging import Logger
+
+
+class Lazy:
+    """Proxy that creates its target on first attribute access and then reuses it
+
+    This keeps clients and templates out of the cold start for invocations that never
+    use them. Creation is locked as objects may be processed on several threads, and
+    the time it takes is logged so init duration can be tracked.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Any], logger: Logger) -> None:
+        self._name = name
+        self._factory = factory
+        self._logger = logger
+        self._target: Optional[Any] = None
+        self._lock = Lock()
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self.target, attribute)
+
+    @property
+    def target(self) -> Any:
+        """The proxied object, created on the first call"""
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    start = perf_counter()
+                    self._target = self._factory()
+                    self._logger.info(
+                        f"Initialised {self._name}",
+                        init_duration_ms=round((perf_counter() - start) * 1000, 3),
+                    )
+        return self._target
@@ -0,0 +1,28 @@
+"""Module to hold the notifications sent to users about their imported files"""
+
+import json
+from dataclasses import asdict, dataclass, field
+from typing import Any, Optional, Union
+
+# Key of the notification in queued messages, to tell them apart from S3 event notifications
+NOTIFICATION_MESSAGE_KEY = "notification"
+
+
+@dataclass
+class Notification:
+    """An email to a user about the outcome of processing one of their files"""
+
+    template: str  # Name of the template in templates/, without the .html extension
+    destination: list[Union[str, None]]
+    subject: str
+    template_data: dict[str, Any] = field(default_factory=dict)
+
+    def to_message(self) -> str:
+        """Serialise the notification as the body of a queued message"""
+        return json.dumps({NOTIFICATION_MESSAGE_KEY: asdict(self)})
+
+    @classmethod
+    def from_message(cls, message: dict) -> Optional["Notification"]:
+        """The notification from the parsed body of a queued message, if it holds one"""
+        notification = message.get(NOTIFICATION_MESSAGE_KEY)
+        return cls(**notification) if notification is not None else None
@@ -0,0 +1,166 @@
+"""Module to hold the conversion of validated CSV rows to Parquet"""
+
+import re
+from typing import Any, BinaryIO, Iterable, Optional
+
+from utils.exceptions import ObjectValidationException
+from utils.schema import AgreementSchema, ColumnSchema
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for Parquet conversion, e.g. from a layer
+    pa = None
+
+# Types inferred for columns without a schema, tried in order. The values in the first
+# batch of rows decide the type, and later batches must match it
+INFERRED_COLUMN_TYPES = ("integer", "decimal", "boolean", "date")
+# Numbers written with a leading zero or plus sign, e.g. phone numbers or codes, would
+# lose it as numbers, so columns with any are only inferred to be text
+FORMATTED_NUMBER_PATTERN = re.compile(r"\+|-?0[0-9]")
+NUMERIC_COLUMN_TYPES = ("integer", "decimal")
+# Rows buffered into each row group, as row groups of a single batch would be too small
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+
+
+def parquet_available() -> bool:
+    """Whether pyarrow is installed, so rows can be converted to Parquet"""
+    return pa is not None
+
+
+def _arrow_type(column_type: str) -> Any:
+    return {
+        "integer": pa.int64(),
+        "decimal": pa.float64(),
+        "boolean": pa.bool_(),
+        "date": pa.date32(),
+        # Timestamps are kept as text, as their offsets and precision vary by file
+        "datetime": pa.string(),
+        "string": pa.string(),
+    }[column_type]
+
+
+class ParquetConverter:
+    """Converts batches of validated CSV rows to a Parquet file as they're validated
+
+    Column types come from the agreement's schema, or are inferred from the first batch
+    of rows otherwise. If a later batch doesn't match the inferred types, conversion is
+    abandoned, as the file is still forwarded as CSV.
+    """
+
+    def __init__(self, file: BinaryIO, schema: Optional[AgreementSchema]) -> None:
+        self._file = file
+        self._schema = schema
+        self._header: list[str] = []
+        self._column_schema: Optional[AgreementSchema] = None
+        self._arrow_schema: Optional[Any] = None
+        self._writer: Optional[Any] = None
+        self._tables: list[Any] = []
+        self._buffered_rows = 0
+        self.abandoned = False
+
+    def add_rows(self, first_line: int, rows: list[list[str]]) -> None:
+        """Add a batch of validated rows, from the line of the first row"""
+        if first_line == 1:
+            # The first batch starts with the header row
+            self._header = rows[0]
+            first_line, rows = 2, rows[1:]
+        if self.abandoned or not rows:
+            return
+        header = self._header
+        if self._column_schema is None:
+            self._column_schema = self._schema or _infer_schema(header, rows)
+            self._arrow_schema = pa.schema(
+                [
+                    (column.name, _arrow_type(column.type))
+                    for column in self._column_schema.columns
+                ]
+            )
+        elif self._schema is None:
+            try:
+                self._column_schema.check_rows(header, first_line, rows)
+            except ObjectValidationException:
+                self.abandoned = True
+                return
+            if any(
+                _has_formatted_numbers(row[header.index(column.name)] for row in rows)
+                for column in self._column_schema.columns
+                if column.type in NUMERIC_COLUMN_TYPES
+            ):
+                self.abandoned = True
+                return
+
+        columns = list(zip(*rows))
+        try:
+            arrays = [
+                _to_arrow(columns[header.index(column.name)], column.type)
+                for column in self._column_schema.columns
+            ]
+        except pa.ArrowInvalid:
+            # A value matched its type's pattern, but Arrow can't parse it
+            self.abandoned = True
+            return
+        self._tables.append(pa.Table.from_arrays(arrays, schema=self._arrow_schema))
+        self._buffered_rows += len(rows)
+        if self._buffered_rows >= PARQUET_ROW_GROUP_SIZE:
+            self._write_row_group()
+
+    def finish(self) -> Optional[BinaryIO]:
+        """Write any buffered rows, returning the Parquet file if it holds every row"""
+        if not self.abandoned and self._tables:
+            self._write_row_group()
+        if self._writer is not None:
+            self._writer.close()
+        if self.abandoned or self._writer is None:
+            self._file.close()
+            return None
+        self._file.seek(0)
+        return self._file
+
+    def close(self) -> None:
+        """Abandon the conversion, e.g. when the file fails validation, closing the file"""
+        self.abandoned = True
+        if self._writer is not None:
+            self._writer.close()
+        self._file.close()
+
+    def _write_row_group(self) -> None:
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(
+                self._file, self._arrow_schema, compression="snappy"
+            )
+        self._writer.write_table(pa.concat_tables(self._tables))
+        self._tables = []
+        self._buffered_rows = 0
+
+
+def _infer_schema(header: list[str], rows: list[list[str]]) -> AgreementSchema:
+    columns = []
+    for index, name in enumerate(header):
+        values = [row[index] for row in rows]
+        column_type = "string"
+        if any(values):
+            for candidate in INFERRED_COLUMN_TYPES:
+                if candidate in NUMERIC_COLUMN_TYPES and _has_formatted_numbers(values):
+                    continue
+                column = ColumnSchema.from_dict({"name": name, "type": candidate})
+                if column.batch_pattern and column.batch_pattern.fullmatch(
+                    "\n".join(values)
+                ):
+                    column_type = candidate
+                    break
+        columns.append(ColumnSchema.from_dict({"name": name, "type": column_type}))
+    return AgreementSchema(columns)
+
+
+def _has_formatted_numbers(values: Iterable[str]) -> bool:
+    return any(FORMATTED_NUMBER_PATTERN.match(value) for value in values)
+
+
+def _to_arrow(values: tuple[str, ...], column_type: str) -> Any:
+    # Empty values are nulls, as in the schema
+    array = pa.array([value if value else None for value in values], pa.string())
+    if column_type == "boolean":
+        array = pc.utf8_lower(array)
+    return pc.cast(array, _arrow_type(column_type))
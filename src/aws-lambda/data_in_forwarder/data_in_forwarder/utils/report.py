@@ -0,0 +1,29 @@
+"""Module to hold the reports of the problems found validating imported files"""
+
+import csv
+import io
+import json
+
+# Content types of the formats reports can be written in
+REPORT_CONTENT_TYPES = {"json": "application/json", "csv": "text/csv"}
+REPORT_COLUMNS = ("line", "rule", "message")
+
+
+def format_validation_report(
+    file: str, problems: list[dict], truncated: bool, report_format: str
+) -> bytes:
+    """Format the problems found with a file as a JSON or CSV report
+
+    CSV reports have a row per problem. JSON reports also record whether collecting
+    stopped at the limit on problems, in which case the file may have more.
+    """
+    if report_format == "csv":
+        output = io.StringIO()
+        writer = csv.DictWriter(output, REPORT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(problems)
+        return output.getvalue().encode("utf-8")
+    return json.dumps(
+        {"file": file, "truncated": truncated, "problems": problems},
+        separators=(",", ":"),
+    ).encode("utf-8")
@@ -0,0 +1,144 @@
+"""Module to hold the validation rule registry"""
+
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from enum import IntEnum
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+from utils.data import S3ObjectInfo
+from utils.exceptions import ObjectValidationException, ValidationProblemsException
+from utils.schema import AgreementSchema
+
+
+class RuleStage(IntEnum):
+    """The stages validation rules run in, from cheapest to most expensive"""
+
+    OBJECT = 1  # Object metadata, before any of the body is read
+    HEADER = 2  # The header row, once the first data row has been read
+    ROW = 3  # Every row, in batches as they are streamed from the body
+    SUMMARY = 4  # Once the whole body has been read
+
+
+@dataclass
+class ValidationProblem:
+    """A problem found with a file, for the validation report"""
+
+    message: str
+    line: Optional[int] = None  # The line the problem is on, for row level problems
+    rule: Optional[str] = None  # The rule that found it, unless it stopped parsing
+
+
+@dataclass
+class ValidationContext:
+    """State shared by the validation rules for a single object"""
+
+    s3_object_info: S3ObjectInfo
+    header: list[str] = field(default_factory=list)
+    rows_in_file: int = 0
+    s3_requests: int = 0
+    encoding: str = "utf-8"
+    # csv.reader format parameters, if the file isn't in the default excel dialect
+    csv_format: dict[str, Any] = field(default_factory=dict)
+    # Columns expected for the agreement, if it has a schema
+    schema: Optional[AgreementSchema] = None
+    rule_timings: dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    # Problems are collected up to this many, rather than stopping at the first, if set
+    max_problems: int = 0
+    problems: list[ValidationProblem] = field(default_factory=list)
+
+    @property
+    def rule_timings_ms(self) -> dict[str, float]:
+        """The wall time spent in each rule in milliseconds, for logging"""
+        return {name: round(secs * 1000, 3) for name, secs in self.rule_timings.items()}
+
+    def add_problem(self, problem: ValidationProblem) -> None:
+        """Record a problem, stopping validation once max_problems have been found"""
+        self.problems.append(problem)
+        if len(self.problems) >= self.max_problems:
+            raise self.problems_found()
+
+    def problems_found(self) -> ValidationProblemsException:
+        """The exception failing validation with the problems that were found"""
+        reason = self.problems[0].message
+        if len(self.problems) > 1:
+            at_least = "at least " if len(self.problems) >= self.max_problems else ""
+            reason += (
+                f"\n\nThis is the first of {at_least}{len(self.problems)} problems found "
+                "with the file."
+            )
+        return ValidationProblemsException(
+            reason, [asdict(problem) for problem in self.problems]
+        )
+
+
+@dataclass(frozen=True)
+class ValidationRule:
+    """A single named validation check"""
+
+    name: str
+    stage: RuleStage
+    cost: int
+    check: Callable[..., None]
+
+
+class RuleRegistry:
+    """Registry of validation rules, run in cost order within each stage
+
+    Rules raise ObjectValidationException to fail validation, which short-circuits any
+    remaining rules. When the context collects problems, failures after the OBJECT stage
+    are recorded instead, and failing batches of rows are checked row by row to find
+    every failing row.
+    """
+
+    def __init__(self) -> None:
+        self._rules: dict[RuleStage, list[ValidationRule]] = defaultdict(list)
+
+    def register(
+        self, name: str, stage: RuleStage, cost: int = 0
+    ) -> Callable[[Callable[..., None]], Callable[..., None]]:
+        """Decorator to register a function as a validation rule"""
+
+        def decorator(check: Callable[..., None]) -> Callable[..., None]:
+            rules = self._rules[stage]
+            rules.append(ValidationRule(name, stage, cost, check))
+            rules.sort(key=lambda rule: rule.cost)
+            return check
+
+        return decorator
+
+    def rules(self, stage: RuleStage) -> list[ValidationRule]:
+        """The rules registered for a stage, cheapest first"""
+        return self._rules[stage]
+
+    def run(self, stage: RuleStage, context: ValidationContext, *args) -> None:
+        """Run every rule for a stage, recording the wall time spent in each"""
+        for rule in self._rules[stage]:
+            start = perf_counter()
+            try:
+                rule.check(context, *args)
+            except ObjectValidationException as err:
+                if not context.max_problems or stage == RuleStage.OBJECT:
+                    raise
+                self._collect_problems(rule, context, err, *args)
+            finally:
+                context.rule_timings[rule.name] += perf_counter() - start
+
+    @staticmethod
+    def _collect_problems(
+        rule: ValidationRule,
+        context: ValidationContext,
+        err: ObjectValidationException,
+        *args,
+    ) -> None:
+        if rule.stage != RuleStage.ROW:
+            context.add_problem(ValidationProblem(err.args[0], rule=rule.name))
+            return
+        first_line, rows = args
+        for line_number, row_data in enumerate(rows, start=first_line):
+            try:
+                rule.check(context, line_number, [row_data])
+            except ObjectValidationException as row_err:
+                context.add_problem(
+                    ValidationProblem(row_err.args[0], line_number, rule.name)
+                )
@@ -0,0 +1,75 @@
+"""Module to hold a file-like reader for S3 objects"""
+
+import io
+from typing import Any, Optional
+
+from botocore.exceptions import ClientError
+
+
+class S3ObjectReader(io.RawIOBase):
+    """Read-only, file-like view of an S3 object fetched with HTTP range requests
+
+    The first request only fetches a sample from the start of the object, so checks on
+    the header and first rows can reject a file without downloading all of it. The rest
+    of the object is streamed by a single further request, made only if it is read.
+    """
+
+    def __init__(self, client: Any, bucket: str, key: str, sample_size: int) -> None:
+        super().__init__()
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._sample_size = sample_size
+        self._position = 0
+        self._body: Optional[Any] = None
+        self._range_end: Optional[int] = None
+        self._at_end = False
+        self.requests_made = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._at_end:
+            if self._body is None:
+                self._open_next_range()
+                continue
+            data = self._body.read(len(buffer))
+            if data:
+                buffer[: len(data)] = data
+                self._position += len(data)
+                return len(data)
+            # The current range is exhausted, so either the object ended early or
+            # the remainder needs to be fetched
+            self._body.close()
+            self._body = None
+            if self._range_end is None or self._position <= self._range_end:
+                self._at_end = True
+        return 0
+
+    def close(self) -> None:
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+        super().close()
+
+    def _open_next_range(self) -> None:
+        if self._position == 0:
+            self._range_end = self._sample_size - 1
+            range_header = f"bytes=0-{self._range_end}"
+        else:
+            self._range_end = None
+            range_header = f"bytes={self._position}-"
+        try:
+            response = self._client.get_object(
+                Bucket=self._bucket, Key=self._key, Range=range_header
+            )
+        except ClientError as err:
+            # The sample was exactly the size of the object, so there is nothing left
+            if err.response.get("Error", {}).get("Code") == "InvalidRange":
+                self._at_end = True
+                return
+            raise
+        finally:
+            self.requests_made += 1
+        self._body = response["Body"]
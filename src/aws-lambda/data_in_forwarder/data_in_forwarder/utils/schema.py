@@ -0,0 +1,182 @@
+"""Module to hold the schemas of the columns expected in each agreement's files"""
+
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from typing import Any, Optional
+
+from botocore.exceptions import ClientError
+from utils.exceptions import ObjectValidationException
+
+# Patterns values of each type must match. Empty values are nulls
+COLUMN_TYPE_PATTERNS = {
+    "string": None,
+    "integer": r"[+-]?[0-9]+",
+    "decimal": r"[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?",
+    "boolean": r"(?i:true|false)",
+    "date": r"[0-9]{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12][0-9]|3[01])",
+    "datetime": (
+        r"[0-9]{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12][0-9]|3[01])"
+        r"[T ](?:[01][0-9]|2[0-3]):[0-5][0-9](?::[0-5][0-9](?:\.[0-9]+)?)?"
+        r"(?:Z|[+-][0-9]{2}:?[0-9]{2})?"
+    ),
+}
+# Error codes from get_object meaning the agreement has no schema
+SCHEMA_NOT_FOUND_ERROR_CODES = {"404", "NoSuchKey", "NotFound"}
+MAX_VALUE_LENGTH_IN_MESSAGES = 50
+
+
+@dataclass(frozen=True)
+class ColumnSchema:
+    """A column expected in an agreement's files, compiled for checking its values"""
+
+    name: str
+    type: str
+    nullable: bool
+    # Matches a batch of the column's values joined by newlines, or None if any will do
+    batch_pattern: Optional[re.Pattern]
+    value_pattern: Optional[re.Pattern]
+
+    @classmethod
+    def from_dict(cls, column: dict[str, Any]) -> "ColumnSchema":
+        """Compile a column from its schema, e.g. {"name": "id", "type": "integer"}"""
+        column_type = column.get("type", "string")
+        if column_type not in COLUMN_TYPE_PATTERNS:
+            raise ValueError(f"Unknown type {column_type} for column {column['name']}")
+        nullable = column.get("nullable", True)
+        pattern = COLUMN_TYPE_PATTERNS[column_type]
+        if pattern is None:
+            pattern = "[^\n]+" if not nullable else None
+        if pattern is not None and nullable:
+            pattern = f"(?:{pattern})?"
+        return cls(
+            name=column["name"],
+            type=column_type,
+            nullable=nullable,
+            batch_pattern=(
+                re.compile(f"{pattern}(?:\n{pattern})*", re.ASCII) if pattern else None
+            ),
+            value_pattern=re.compile(pattern, re.ASCII) if pattern else None,
+        )
+
+    def check_values(self, first_line: int, values: list[str]) -> None:
+        """Check a batch of the column's values, from the line of the first value"""
+        # A single match over the joined values avoids a Python level loop over them,
+        # which is only needed to find the first bad value
+        if self.batch_pattern is None or self.batch_pattern.fullmatch(
+            "\n".join(values)
+        ):
+            return
+        for line_number, value in enumerate(values, start=first_line):
+            if self.value_pattern and not self.value_pattern.fullmatch(value):
+                raise ObjectValidationException(self._problem(line_number, value))
+
+    def _problem(self, line_number: int, value: str) -> str:
+        if not value:
+            return (
+                f"Line {line_number} has no value for the required column {self.name}"
+            )
+        if len(value) > MAX_VALUE_LENGTH_IN_MESSAGES:
+            value = f"{value[:MAX_VALUE_LENGTH_IN_MESSAGES]}..."
+        return (
+            f"Line {line_number} has the value '{value}' for column {self.name}, "
+            f"which isn't a valid {self.type}"
+        )
+
+
+class AgreementSchema:
+    """The columns expected in the files imported for an agreement
+
+    Schemas are JSON objects like {"columns": [{"name": "id", "type": "integer",
+    "nullable": false}]}. Columns are strings and nullable unless they say otherwise.
+    """
+
+    def __init__(
+        self, columns: list[ColumnSchema], digest: Optional[str] = None
+    ) -> None:
+        self.columns = columns
+        # SHA-256 hash of the schema's JSON object, which changes when the schema does
+        self.digest = digest
+
+    @classmethod
+    def from_dict(cls, schema: dict[str, Any]) -> "AgreementSchema":
+        """Compile a schema from its JSON object"""
+        digest = hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+        return cls(
+            [ColumnSchema.from_dict(column) for column in schema["columns"]], digest
+        )
+
+    def check_header(self, header: list[str]) -> None:
+        """Check a file has the columns in the schema, in any order"""
+        expected = [column.name for column in self.columns]
+        missing = [name for name in expected if name not in header]
+        unexpected = [name for name in header if name not in expected]
+        problems = []
+        if missing:
+            problems.append(f"is missing the columns {', '.join(missing)}")
+        if unexpected:
+            problems.append(f"has the unexpected columns {', '.join(unexpected)}")
+        if problems:
+            raise ObjectValidationException(
+                f"The file {' and '.join(problems)} for the agreement's schema."
+            )
+
+    def check_rows(
+        self, header: list[str], first_line: int, rows: list[list[str]]
+    ) -> None:
+        """Check the values in a batch of rows, a column at a time"""
+        for column in self.columns:
+            if column.batch_pattern is None or column.name not in header:
+                continue
+            index = header.index(column.name)
+            # Rows without the column are reported by the column count check
+            column.check_values(
+                first_line, [row[index] if index < len(row) else "" for row in rows]
+            )
+
+
+class SchemaRegistry:
+    """The schema for each agreement, loaded from <agreement>.json in an S3 bucket
+
+    Compiled schemas are cached in memory for ttl_seconds, as are agreements without a
+    schema, so warm invocations don't fetch them again.
+    """
+
+    def __init__(self, client: Any, bucket: str, ttl_seconds: int) -> None:
+        self._client = client
+        self._bucket = bucket
+        self._ttl_seconds = ttl_seconds
+        self._schemas: dict[str, tuple[float, Optional[AgreementSchema]]] = {}
+        self._lock = Lock()
+
+    def get(self, agreement: str) -> Optional[AgreementSchema]:
+        """The schema for an agreement, or None if it doesn't have one"""
+        with self._lock:
+            cached = self._schemas.get(agreement)
+        if cached is not None and cached[0] > monotonic():
+            return cached[1]
+        schema = self._load(agreement)
+        with self._lock:
+            self._schemas[agreement] = (monotonic() + self._ttl_seconds, schema)
+        return schema
+
+    def _load(self, agreement: str) -> Optional[AgreementSchema]:
+        try:
+            response = self._client.get_object(
+                Bucket=self._bucket, Key=f"{agreement}.json"
+            )
+        except ClientError as err:
+            if (
+                err.response.get("Error", {}).get("Code")
+                in SCHEMA_NOT_FOUND_ERROR_CODES
+            ):
+                return None
+            raise
+        body = response["Body"]
+        try:
+            return AgreementSchema.from_dict(json.loads(body.read()))
+        finally:
+            body.close()
@@ -0,0 +1,102 @@
+"""Module to hold the key-value stores used to keep state between invocations"""
+
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from threading import Lock
+from time import time
+from typing import Any, Optional
+
+SQLITE_LOCATION_PREFIX = "sqlite://"
+
+
+class StateStore(ABC):
+    """Key-value store of JSON serialisable items, which expire after an optional TTL"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[dict]:
+        """The item stored under a key, or None if there isn't one or it has expired"""
+
+    @abstractmethod
+    def put(self, key: str, item: dict, ttl_seconds: Optional[int] = None) -> None:
+        """Store an item under a key, replacing any existing item"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Remove the item stored under a key, if there is one"""
+
+
+class DynamoDBStateStore(StateStore):
+    """State store backed by a DynamoDB table
+
+    The table needs a string partition key named "pk", and should have TTL enabled on the
+    "expires_at" attribute. Expired items are ignored, as DynamoDB can take a while to
+    remove them.
+    """
+
+    def __init__(self, client: Any, table_name: str) -> None:
+        self._client = client
+        self._table_name = table_name
+
+    def get(self, key: str) -> Optional[dict]:
+        response = self._client.get_item(
+            TableName=self._table_name, Key={"pk": {"S": key}}, ConsistentRead=True
+        )
+        stored_item = response.get("Item")
+        if not stored_item:
+            return None
+        expires_at = stored_item.get("expires_at", {}).get("N")
+        if expires_at is not None and int(expires_at) <= time():
+            return None
+        return json.loads(stored_item["data"]["S"])
+
+    def put(self, key: str, item: dict, ttl_seconds: Optional[int] = None) -> None:
+        stored_item = {"pk": {"S": key}, "data": {"S": json.dumps(item)}}
+        if ttl_seconds is not None:
+            stored_item["expires_at"] = {"N": str(int(time()) + ttl_seconds)}
+        self._client.put_item(TableName=self._table_name, Item=stored_item)
+
+    def delete(self, key: str) -> None:
+        self._client.delete_item(TableName=self._table_name, Key={"pk": {"S": key}})
+
+
+class SQLiteStateStore(StateStore):
+    """State store backed by a SQLite database, as a local stand-in for DynamoDB"""
+
+    def __init__(self, path: str) -> None:
+        # Objects are processed on several threads, so access to the connection is locked
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS state "
+                "(pk TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at INTEGER)"
+            )
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM state WHERE pk = ? "
+                "AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, item: dict, ttl_seconds: Optional[int] = None) -> None:
+        expires_at = int(time()) + ttl_seconds if ttl_seconds is not None else None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO state (pk, data, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(item), expires_at),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM state WHERE pk = ?", (key,))
+
+
+def create_state_store(location: str, dynamodb_client: Any) -> StateStore:
+    """Create the store for a location, either sqlite://<path> or a DynamoDB table name"""
+    if location.startswith(SQLITE_LOCATION_PREFIX):
+        return SQLiteStateStore(location[len(SQLITE_LOCATION_PREFIX) :])
+    return DynamoDBStateStore(dynamodb_client, location)
@@ -0,0 +1,166 @@
+"""Module to hold the streaming validation of CSV data"""
+
+import csv
+import re
+from time import perf_counter
+from typing import Callable, Iterable, Optional
+
+from utils.exceptions import ObjectValidationException
+from utils.rules import RuleRegistry, RuleStage, ValidationContext
+
+# Rows are checked in batches, so each check makes a few C level passes rather than
+# looping over every cell in Python
+ROW_BATCH_SIZE = 1000
+INVALID_HEADER_CHARACTERS = re.compile(r"[^a-zA-Z0-9_]")
+# Called with the line of the first row of each batch of rows passing the checks
+RowsCallback = Callable[[int, list[list[str]]], None]
+
+validation_rules = RuleRegistry()
+
+
+def validate_csv_rows(
+    csv_rows: Iterable[list[str]],
+    context: ValidationContext,
+    registry: RuleRegistry = validation_rules,
+    on_valid_rows: Optional[RowsCallback] = None,
+    first_batch_size: int = ROW_BATCH_SIZE,
+) -> int:
+    """Validate CSV rows in a single pass, stopping at the first failure
+
+    Rows are consumed lazily and checked in batches, so only the header and the current
+    batch are held in memory. Returns the number of non-empty rows in the file. If the
+    context collects problems, validation instead fails once every row has been checked,
+    or once it has collected as many problems as it can. Each batch of rows that passes
+    the checks is passed to on_valid_rows, with the line of its first row. The first
+    batch can be smaller, e.g. the rows in a sample, so they're checked before the rest
+    of the file is read.
+    """
+    start = perf_counter()
+    batch: list[list[str]] = []
+    batch_first_line = 1
+    batch_size = max(1, min(first_batch_size, ROW_BATCH_SIZE))
+    try:
+        for row_data in csv_rows:
+            if not row_data:
+                continue
+            context.rows_in_file += 1
+            if context.rows_in_file == 1:
+                context.header = row_data
+            elif context.rows_in_file == 2:
+                # Header checks wait for the first data row, so a file with too few rows
+                # is reported as such rather than as a header problem
+                registry.run(RuleStage.HEADER, context)
+            batch.append(row_data)
+            if len(batch) == batch_size:
+                _check_rows(context, registry, batch_first_line, batch, on_valid_rows)
+                batch_first_line += len(batch)
+                batch = []
+                batch_size = ROW_BATCH_SIZE
+        if batch and context.rows_in_file > 1:
+            _check_rows(context, registry, batch_first_line, batch, on_valid_rows)
+    except (csv.Error, UnicodeDecodeError) as err:
+        if context.max_problems and batch and context.rows_in_file > 1:
+            # The rows read before the error are checked, so their problems are reported
+            registry.run(RuleStage.ROW, context, batch_first_line, batch)
+        raise ObjectValidationException("File is not a valid CSV file") from err
+    finally:
+        # Time spent reading and parsing is whatever the rules themselves did not use
+        rules_time = sum(
+            context.rule_timings[rule.name]
+            for stage in (RuleStage.HEADER, RuleStage.ROW)
+            for rule in registry.rules(stage)
+        )
+        context.rule_timings["csv_parse"] += perf_counter() - start - rules_time
+
+    registry.run(RuleStage.SUMMARY, context)
+    if context.problems:
+        raise context.problems_found()
+    return context.rows_in_file
+
+
+def _check_rows(
+    context: ValidationContext,
+    registry: RuleRegistry,
+    first_line: int,
+    rows: list[list[str]],
+    on_valid_rows: Optional[RowsCallback],
+) -> None:
+    registry.run(RuleStage.ROW, context, first_line, rows)
+    # Once a problem has been collected the file will be rejected, so rows aren't passed on
+    if on_valid_rows is not None and not context.problems:
+        on_valid_rows(first_line, rows)
+
+
+@validation_rules.register("header_naming", RuleStage.HEADER, cost=10)
+def _check_header_naming(context: ValidationContext) -> None:
+    """Validate headers match naming convention for dbx"""
+    # Joining the headers lets a single search cover every column
+    if INVALID_HEADER_CHARACTERS.search("".join(context.header)):
+        raise ObjectValidationException(
+            "Headers within the file contain spaces or special characters."
+        )
+
+
+@validation_rules.register("empty_header", RuleStage.HEADER, cost=20)
+def _check_empty_header(context: ValidationContext) -> None:
+    """Validate there are no empty headers"""
+    for header_index, column_name in enumerate(context.header, start=1):
+        if column_name == "":
+            raise ObjectValidationException(
+                f"There are {len(context.header)} headers, but the header at column {header_index} is empty."
+            )
+
+
+@validation_rules.register("schema_columns", RuleStage.HEADER, cost=30)
+def _check_schema_columns(context: ValidationContext) -> None:
+    """Validate the headers are the columns in the agreement's schema, if it has one"""
+    if context.schema is not None:
+        context.schema.check_header(context.header)
+
+
+@validation_rules.register("column_count", RuleStage.ROW, cost=10)
+def _check_column_count(
+    context: ValidationContext, first_line: int, rows: list[list[str]]
+) -> None:
+    """Check each row in a batch has the right amount of columns"""
+    num_header_cols = len(context.header)
+    if set(map(len, rows)) == {num_header_cols}:
+        return
+    for line_number, row_data in enumerate(rows, start=first_line):
+        cols = len(row_data)
+        if cols != num_header_cols:
+            raise ObjectValidationException(
+                f"Line {line_number} has {cols} columns, but the header row has {num_header_cols}"
+            )
+
+
+@validation_rules.register("line_breaks", RuleStage.ROW, cost=20)
+def _check_line_breaks(
+    context: ValidationContext, first_line: int, rows: list[list[str]]
+) -> None:
+    """Check for line breaks in the data of a batch of rows"""
+    # A single search over the joined cells avoids a Python level loop over every cell
+    if "\n" in "".join(map("".join, rows)):
+        raise ObjectValidationException("Data within the file contains line break")
+
+
+@validation_rules.register("column_types", RuleStage.ROW, cost=30)
+def _check_column_types(
+    context: ValidationContext, first_line: int, rows: list[list[str]]
+) -> None:
+    """Check the values in a batch of rows have the types in the agreement's schema"""
+    if context.schema is None:
+        return
+    if first_line == 1:
+        # The first batch starts with the header row
+        first_line, rows = 2, rows[1:]
+    context.schema.check_rows(context.header, first_line, rows)
+
+
+@validation_rules.register("row_count", RuleStage.SUMMARY, cost=10)
+def _check_row_count(context: ValidationContext) -> None:
+    """Check number of rows (expect more than 1)"""
+    if context.rows_in_file < 2:
+        raise ObjectValidationException(
+            f"File has too few rows ({context.rows_in_file})"
+        )
@@ -0,0 +1,49 @@
+"""Module to hold the cache of validation verdicts for imported objects"""
+
+from dataclasses import asdict, dataclass, field
+from typing import Any, Optional
+
+
+@dataclass
+class CachedVerdict:
+    """The outcome of validating a version of an object"""
+
+    accepted: bool
+    reason: Optional[str] = None  # Why the object was rejected
+    content_hash: Optional[str] = None
+    schema_digest: Optional[str] = None
+    duplicate_of: Optional[str] = None
+    encoding: Optional[str] = None
+    csv_format: dict[str, Any] = field(default_factory=dict)
+    # Problems collected for the validation report, when the object was rejected
+    problems: list[dict] = field(default_factory=list)
+
+
+class VerdictCache:
+    """Cache of validation verdicts by bucket, key and ETag
+
+    Events are redelivered when processing fails after validation, e.g. while moving the
+    object or sending the notification. Caching the verdict lets the retry go straight
+    to the step that failed, rather than downloading and validating the object again.
+    The ETag changes whenever the object is overwritten, so a new upload under the same
+    key is always validated.
+    """
+
+    def __init__(self, store: Any, ttl_seconds: int) -> None:
+        self._store = store
+        self._ttl_seconds = ttl_seconds
+
+    def get(self, bucket: str, key: str, etag: str) -> Optional[CachedVerdict]:
+        """The verdict cached for a version of an object, if there is one"""
+        item = self._store.get(self._key(bucket, key, etag))
+        return CachedVerdict(**item) if item is not None else None
+
+    def put(self, bucket: str, key: str, etag: str, verdict: CachedVerdict) -> None:
+        """Cache the verdict for a version of an object"""
+        self._store.put(
+            self._key(bucket, key, etag), asdict(verdict), self._ttl_seconds
+        )
+
+    @staticmethod
+    def _key(bucket: str, key: str, etag: str) -> str:
+        return f"verdict#{bucket}#{key}#{etag}"
@@ -0,0 +1,35 @@
+import pytest
+
+import data_in_forwarder.data_in_forwarder as main
+from benchmarks.benchmark_validation import Scenario, run_scenario
+
+
+@pytest.fixture(autouse=True)
+def forwarder_globals(monkeypatch):
+    # Scenarios point the forwarder at the benchmark's files, which is undone afterwards
+    for name in ("s3", "IMPORT_DATA_PENDING_BUCKET_NAME", "MAX_DATA_SIZE_IN_BYTES"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    log_level = main.logger.log_level
+    yield
+    main.logger.setLevel(log_level)
+
+
+def test_small_scenario_is_accepted():
+    result = run_scenario(Scenario(rows=100, cols=5, encoding="utf-8", fail_at=None))
+
+    assert result.accepted, result.reason
+    assert result.rows_per_second > 0
+
+
+def test_failing_scenario_is_rejected():
+    result = run_scenario(Scenario(rows=100, cols=5, encoding="utf-8", fail_at=0.5))
+
+    assert not result.accepted
+    assert result.reason == "Line 52 has 4 columns, but the header row has 5"
+
+
+def test_errors_other_than_rejections_are_raised(monkeypatch):
+    monkeypatch.setattr(main, "_validate_imported_object", lambda *_: 1 / 0)
+
+    with pytest.raises(ZeroDivisionError):
+        run_scenario(Scenario(rows=10, cols=2, encoding="utf-8", fail_at=None))
@@ -1,13 +1,17 @@
+import gzip
 import json
+import zipfile
 from dataclasses import dataclass
 from http import HTTPStatus
 from io import BytesIO
 from typing import Union
-from unittest.mock import Mock
+from unittest.mock import ANY, Mock
 
 import pytest
 from botocore.exceptions import ClientError
 from botocore.response import StreamingBody
+from jinja2 import ModuleLoader
+from moto import mock_dynamodb
 from data_in_forwarder.utils.data import S3ObjectInfo
 
 IMPORT_DATA_PENDING_BUCKET_NAME = "pending-data-bucket"
@@ -16,6 +20,9 @@ SOURCE_EMAIL_ADDRESS = "noreply@email.com"
 MAX_DATA_SIZE_IN_BYTES = 100
 AWS_REGION = "eu-west-2"
 CHARSET = "UTF-8"
+NOTIFICATION_QUEUE_URL = (
+    "https://sqs.eu-west-2.amazonaws.com/123456789012/notifications"
+)
 
 
 @pytest.fixture
@@ -65,6 +72,11 @@ def mock_ses(monkeypatch) -> Mock:
     return mock
 
 
+@pytest.fixture(autouse=True)
+def mock_sqs(monkeypatch) -> Mock:
+    return set_up_mock(monkeypatch, "data_in_forwarder.data_in_forwarder.sqs")
+
+
 def test_no_bucket_in_event_returns_bad_request(lambda_context):
     event = {"Records": [{"s3": {"object": {"key": "test"}}}]}
     import data_in_forwarder.data_in_forwarder as main
@@ -182,7 +194,7 @@ def test_object_size_gt_limit_returns_validation_error(
 def test_object_key_no_csv_ext_returns_validation_error(
     lambda_context, mock_ses, mock_s3
 ):
-    event, object_info = _build_trigger_event(file_name="test.zip")
+    event, object_info = _build_trigger_event(file_name="test.xlsx")
 
     import data_in_forwarder.data_in_forwarder as main
 
@@ -199,7 +211,7 @@ def test_object_key_no_csv_ext_returns_validation_error(
             html_message=main.validation_failure_template.render(
                 agreement=object_info.agreement,
                 file=object_info.file,
-                reason="File doesn't have required '.csv' extension (.zip)",
+                reason="File doesn't have required '.csv' extension (.xlsx)",
             ),
             source=SOURCE_EMAIL_ADDRESS,
         )
@@ -276,6 +288,9 @@ def test_object_exists_in_pending_returns_validation_error(
             source=SOURCE_EMAIL_ADDRESS,
         )
     )
+    mock_s3.list_objects_v2.assert_called_once_with(
+        Bucket=IMPORT_DATA_PENDING_BUCKET_NAME, Prefix=object_info.key, MaxKeys=1
+    )
     mock_s3.copy_object.assert_called_once_with(
         Bucket=IMPORT_DATA_REJECTED_BUCKET_NAME,
         Key=object_info.key,
@@ -637,6 +652,7 @@ def test_send_success_email_failure_returns_error(lambda_context, mock_ses, mock
     assert resp["body"] == json.dumps(
         {"message": "Failed to send validation success notification email to user."}
     )
+    assert resp["retryable"] is False
     mock_ses.send_email.assert_called_once_with(
         **_build_email_request(
             destination=object_info.user,
@@ -709,43 +725,1796 @@ def test_valid_file_returns_success(lambda_context, mock_ses, mock_s3):
     )
 
 
-def _build_trigger_event(
-    bucket: str = "test",
-    agreement: str = "dsa-000000-test",
-    user_id: str = "user@email.com",
-    file_name: str = "test.csv",
-    size: int = int(MAX_DATA_SIZE_IN_BYTES),
-) -> tuple[dict, S3ObjectInfo]:
-    key = f"{agreement}/{user_id}/{file_name}"
-    return (
-        {
-            "Records": [
-                {
-                    "s3": {
-                        "bucket": {"name": bucket},
-                        "object": {"key": key, "size": size},
-                    }
-                }
+def test_validation_stops_at_first_failure(lambda_context, mock_ses, mock_s3):
+    event, object_info = _build_trigger_event()
+
+    # The invalid UTF-8 well after the bad row is never decoded as the stream stops early
+    data = (
+        b"col1,col2\ndata1,data2\ndata1\n"
+        + b"data1,data2\n" * 100000
+        + b"\xff\xfe" * 1000
+    )
+    mock_s3.get_object.return_value = {"Body": StreamingBody(BytesIO(data), len(data))}
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    mock_ses.send_email.assert_called_once_with(
+        **_build_email_request(
+            destination=object_info.user,
+            subject=f"There is a technical error with your reference data file {object_info.file}",
+            html_message=main.validation_failure_template.render(
+                agreement=object_info.agreement,
+                file=object_info.file,
+                reason="Line 3 has 1 columns, but the header row has 2",
+            ),
+            source=SOURCE_EMAIL_ADDRESS,
+        )
+    )
+
+
+def test_validation_short_circuits_and_logs_rule_timings(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event(file_name="test.xlsx")
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    mock_logger_info = set_up_mock(
+        monkeypatch, "data_in_forwarder.data_in_forwarder.logger.info"
+    )
+    main.lambda_handler(event, lambda_context)
+
+    # The cheaper extension rule fails so the pending bucket and body are never read
+    mock_s3.list_objects_v2.assert_not_called()
+    mock_s3.get_object.assert_not_called()
+    timings_log = _find_log(mock_logger_info, "Validation rule timings")
+    assert set(timings_log["rule_timings_ms"]) == {"file_size", "file_extension"}
+
+
+def test_valid_file_logs_timings_for_every_rule(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    mock_logger_info = set_up_mock(
+        monkeypatch, "data_in_forwarder.data_in_forwarder.logger.info"
+    )
+    main.lambda_handler(event, lambda_context)
+
+    timings_log = _find_log(mock_logger_info, "Validation rule timings")
+    assert timings_log["rows_in_file"] == 3
+    assert set(timings_log["rule_timings_ms"]) == {
+        "file_size",
+        "file_extension",
+        "pending_duplicate",
+        "agreement_schema",
+        "csv_parse",
+        "header_naming",
+        "empty_header",
+        "schema_columns",
+        "column_count",
+        "line_breaks",
+        "column_types",
+        "row_count",
+    }
+
+
+def test_large_file_is_moved_with_parallel_multipart_copy(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MULTIPART_COPY_THRESHOLD_IN_BYTES", 50)
+    monkeypatch.setattr(main, "MULTIPART_COPY_PART_SIZE_IN_BYTES", 40)
+    mock_s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    mock_s3.upload_part_copy.side_effect = lambda **kwargs: {
+        "CopyPartResult": {"ETag": f"etag-{kwargs['PartNumber']}"}
+    }
+    mock_s3.complete_multipart_upload.return_value = {"ETag": "etag"}
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    mock_s3.copy_object.assert_not_called()
+    mock_s3.create_multipart_upload.assert_called_once_with(
+        Bucket=IMPORT_DATA_PENDING_BUCKET_NAME,
+        Key=object_info.key,
+        ACL="bucket-owner-full-control",
+    )
+    copied_ranges = sorted(
+        (call.kwargs["PartNumber"], call.kwargs["CopySourceRange"])
+        for call in mock_s3.upload_part_copy.call_args_list
+    )
+    assert copied_ranges == [(1, "bytes=0-39"), (2, "bytes=40-79"), (3, "bytes=80-99")]
+    mock_s3.complete_multipart_upload.assert_called_once_with(
+        Bucket=IMPORT_DATA_PENDING_BUCKET_NAME,
+        Key=object_info.key,
+        UploadId="upload-id",
+        MultipartUpload={
+            "Parts": [
+                {"ETag": "etag-1", "PartNumber": 1},
+                {"ETag": "etag-2", "PartNumber": 2},
+                {"ETag": "etag-3", "PartNumber": 3},
             ]
         },
-        S3ObjectInfo(bucket, key, size),
+    )
+    mock_s3.delete_object.assert_called_once_with(
+        Bucket=object_info.bucket, Key=object_info.key
     )
 
 
-def _build_email_request(
-    destination: Union[str, None], html_message: str, source: str, subject: str
-) -> dict:
-    return {
-        "Destination": {"ToAddresses": [destination]},
-        "Message": {
-            "Body": {"Html": {"Charset": CHARSET, "Data": html_message}},
-            "Subject": {"Charset": CHARSET, "Data": subject},
-        },
-        "Source": source,
+def test_failed_multipart_copy_is_aborted_and_source_kept(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MULTIPART_COPY_THRESHOLD_IN_BYTES", 50)
+    monkeypatch.setattr(main, "MULTIPART_COPY_PART_SIZE_IN_BYTES", 40)
+    mock_s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    mock_s3.upload_part_copy.side_effect = ClientError({}, {})
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert resp["body"] == json.dumps(
+        {
+            "message": f"Failed to move data object {object_info.s3_uri} to pending bucket"
+        }
+    )
+    mock_s3.complete_multipart_upload.assert_not_called()
+    mock_s3.abort_multipart_upload.assert_called_once_with(
+        Bucket=IMPORT_DATA_PENDING_BUCKET_NAME,
+        Key=object_info.key,
+        UploadId="upload-id",
+    )
+    mock_s3.delete_object.assert_not_called()
+
+
+def test_failed_multipart_abort_raises_copy_error(mock_s3, monkeypatch):
+    _, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MULTIPART_COPY_PART_SIZE_IN_BYTES", 40)
+    mock_s3.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    mock_s3.upload_part_copy.side_effect = ClientError(
+        {"Error": {"Code": "InternalError"}}, "UploadPartCopy"
+    )
+    mock_s3.abort_multipart_upload.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "AbortMultipartUpload"
+    )
+
+    with pytest.raises(ClientError) as err:
+        main._multipart_copy_s3_object(object_info, IMPORT_DATA_PENDING_BUCKET_NAME)
+
+    assert err.value.response["Error"]["Code"] == "InternalError"
+    mock_s3.abort_multipart_upload.assert_called_once()
+
+
+def test_every_record_in_event_is_processed(lambda_context, mock_ses, mock_s3):
+    valid_event, valid_object_info = _build_trigger_event()
+    invalid_event, invalid_object_info = _build_trigger_event(file_name="test.zip")
+    event = {"Records": valid_event["Records"] + invalid_event["Records"]}
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("valid.csv")
     }
 
+    import data_in_forwarder.data_in_forwarder as main
 
-def create_s3_object_body(test_file: str) -> StreamingBody:
-    with open(f"tests/test_data/{test_file}", "rb") as f:
-        data = f.read()
-    return StreamingBody(BytesIO(data), len(data))
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.MULTI_STATUS
+    assert resp["body"] == "Processed 2 objects, 1 failed"
+    assert [result["statusCode"] for result in resp["results"]] == [
+        HTTPStatus.OK,
+        HTTPStatus.INTERNAL_SERVER_ERROR,
+    ]
+    assert resp["results"][1]["body"] == json.dumps(
+        {"message": f"Imported data {invalid_object_info.s3_uri} failed validation"}
+    )
+    assert sorted(
+        call.kwargs["Bucket"] for call in mock_s3.copy_object.call_args_list
+    ) == [IMPORT_DATA_PENDING_BUCKET_NAME, IMPORT_DATA_REJECTED_BUCKET_NAME]
+    assert mock_ses.send_email.call_count == 2
+
+
+def test_sqs_batch_reports_failed_messages(lambda_context, mock_ses, mock_s3):
+    valid_event, _ = _build_trigger_event()
+    failing_event, failing_object_info = _build_trigger_event(file_name="fail.csv")
+    rejected_event, _ = _build_trigger_event(file_name="test.zip")
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("valid.csv")
+    }
+
+    def copy_object(**kwargs):
+        if kwargs["Key"] == failing_object_info.key:
+            raise ClientError({}, {})
+        return {"CopyObjectResult": {"ETag": "etag"}}
+
+    mock_s3.copy_object.side_effect = copy_object
+    event = {
+        "Records": [
+            _build_sqs_record("message-1", valid_event),
+            _build_sqs_record("message-2", failing_event),
+            _build_sqs_record("message-3", {"Event": "s3:TestEvent"}),
+            _build_sqs_record("message-4", rejected_event),
+        ]
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    # The rejected upload has been fully handled, so only the failed move is retried
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "message-2"}]}
+    assert mock_s3.copy_object.call_count == 3
+
+
+def test_bad_header_is_rejected_from_sample_without_reading_rest_of_file(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "HEADER_SAMPLE_SIZE_IN_BYTES", 256)
+    data = b"col 1,col2\n" + b"data1,data2\n" * 100
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    mock_s3.get_object.assert_called_once_with(
+        Bucket=object_info.bucket, Key=object_info.key, Range="bytes=0-255"
+    )
+
+
+def test_bad_row_is_rejected_from_sample_without_reading_rest_of_file(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "HEADER_SAMPLE_SIZE_IN_BYTES", 256)
+    data = b"col1,col2\ndata1,data2\ndata1\n" + b"data1,data2\n" * 100
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert "Line 3 has 1 columns, but the header row has 2" in (
+        mock_ses.send_email.call_args.kwargs["Message"]["Body"]["Html"]["Data"]
+    )
+    mock_s3.get_object.assert_called_once_with(
+        Bucket=object_info.bucket, Key=object_info.key, Range="bytes=0-255"
+    )
+
+
+@pytest.mark.parametrize(
+    "bad_row, reason",
+    [
+        (b"data1\n", "Line 8 has 1 columns, but the header row has 2"),
+        (b'data1,"data\n2"\n', "Data within the file contains line break"),
+        (b"", None),
+    ],
+)
+def test_rows_are_checked_in_batches(
+    lambda_context, mock_ses, mock_s3, monkeypatch, bad_row, reason
+):
+    data = b"col1,col2\n" + b"data1,data2\n" * 6 + bad_row + b"data1,data2\n" * 3
+    event, _ = _build_trigger_event(size=len(data))
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MAX_DATA_SIZE_IN_BYTES", 1000)
+    monkeypatch.setattr("utils.validation.ROW_BATCH_SIZE", 3)
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    if reason is None:
+        assert resp["statusCode"] == HTTPStatus.OK
+    else:
+        assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+        assert reason in (
+            mock_ses.send_email.call_args.kwargs["Message"]["Body"]["Html"]["Data"]
+        )
+
+
+def test_rest_of_file_is_streamed_after_sample_passes(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "HEADER_SAMPLE_SIZE_IN_BYTES", 256)
+    data = b"col1,col2\n" + b"data1,data2\n" * 100 + b"data1\n"
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert resp["body"] == json.dumps(
+        {"message": f"Imported data {object_info.s3_uri} failed validation"}
+    )
+    assert [call.kwargs["Range"] for call in mock_s3.get_object.call_args_list] == [
+        "bytes=0-255",
+        "bytes=256-",
+    ]
+
+
+def test_file_the_same_size_as_sample_is_read_in_full(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    data = b"col1,col2\ndata1,data2\n"
+    monkeypatch.setattr(main, "HEADER_SAMPLE_SIZE_IN_BYTES", len(data))
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+
+
+def test_clients_and_templates_are_created_once_on_first_use():
+    from data_in_forwarder.utils.lazy import Lazy
+
+    factory = Mock(return_value=Mock(value="created"))
+    lazy = Lazy("test", factory, Mock())
+
+    factory.assert_not_called()
+    assert lazy.value == "created"
+    assert lazy.value == "created"
+    factory.assert_called_once()
+
+
+def test_precompiled_templates_are_used_when_present(monkeypatch, tmp_path):
+    import data_in_forwarder.data_in_forwarder as main
+
+    main._create_template_environment().compile_templates(str(tmp_path), zip=None)
+    monkeypatch.setattr(main, "COMPILED_TEMPLATES_DIR", tmp_path)
+
+    env = main._create_template_environment()
+
+    assert isinstance(env.loader, ModuleLoader)
+    assert env.get_template("failure.html").render(
+        agreement="agreement", file="file.csv", reason="<reason>"
+    ) == main.validation_failure_template.render(
+        agreement="agreement", file="file.csv", reason="<reason>"
+    )
+    assert "&lt;reason&gt;" in env.get_template("failure.html").render(
+        reason="<reason>"
+    )
+
+
+def test_notification_is_queued_instead_of_sent_when_queue_configured(
+    lambda_context, mock_ses, mock_s3, mock_sqs, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "NOTIFICATION_QUEUE_URL", NOTIFICATION_QUEUE_URL)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    mock_ses.send_email.assert_not_called()
+    mock_sqs.send_message.assert_called_once()
+    assert mock_sqs.send_message.call_args.kwargs["QueueUrl"] == NOTIFICATION_QUEUE_URL
+    assert json.loads(mock_sqs.send_message.call_args.kwargs["MessageBody"]) == {
+        "notification": {
+            "template": "success",
+            "destination": [object_info.user],
+            "subject": f"We have received your reference data file {object_info.file}",
+            "template_data": {
+                "agreement": object_info.agreement,
+                "file": object_info.file,
+            },
+        }
+    }
+
+
+def test_failure_to_queue_notification_after_move_is_not_retried(
+    lambda_context, mock_ses, mock_s3, mock_sqs, monkeypatch
+):
+    event, _ = _build_trigger_event()
+    mock_sqs.send_message.side_effect = ClientError({}, {})
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "NOTIFICATION_QUEUE_URL", NOTIFICATION_QUEUE_URL)
+
+    resp = main.lambda_handler(
+        {"Records": [_build_sqs_record("message-1", event)]}, lambda_context
+    )
+
+    assert resp == {"batchItemFailures": []}
+    mock_s3.delete_object.assert_called_once()
+
+
+def test_queued_notifications_are_sent(lambda_context, mock_ses, mock_s3, mock_sqs):
+    _, object_info = _build_trigger_event()
+    notification = _build_notification_message(object_info, reason="File is too small")
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    resp = main.lambda_handler(
+        {"Records": [_build_sqs_record("message-1", notification)]}, lambda_context
+    )
+
+    assert resp == {"batchItemFailures": []}
+    mock_ses.send_email.assert_called_once_with(
+        **_build_email_request(
+            destination=object_info.user,
+            subject=f"There is a technical error with your reference data file {object_info.file}",
+            html_message=main.validation_failure_template.render(
+                agreement=object_info.agreement,
+                file=object_info.file,
+                reason="File is too small",
+            ),
+            source=SOURCE_EMAIL_ADDRESS,
+        )
+    )
+    mock_s3.copy_object.assert_not_called()
+    mock_sqs.change_message_visibility.assert_not_called()
+
+
+def test_failed_queued_notifications_are_retried_with_backoff(
+    lambda_context, mock_ses, mock_sqs, monkeypatch
+):
+    _, object_info = _build_trigger_event()
+    notification = _build_notification_message(object_info, reason="reason")
+
+    def send_email(Destination: dict, **_) -> None:
+        if Destination["ToAddresses"] == ["throttled@email.com"]:
+            raise ClientError({"Error": {"Code": "Throttling"}}, "SendEmail")
+        if Destination["ToAddresses"] == ["invalid"]:
+            raise ClientError({"Error": {"Code": "MessageRejected"}}, "SendEmail")
+
+    mock_ses.send_email.side_effect = send_email
+    throttled = json.loads(json.dumps(notification))
+    throttled["notification"]["destination"] = ["throttled@email.com"]
+    rejected = json.loads(json.dumps(notification))
+    rejected["notification"]["destination"] = ["invalid"]
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "NOTIFICATION_QUEUE_URL", NOTIFICATION_QUEUE_URL)
+
+    resp = main.lambda_handler(
+        {
+            "Records": [
+                _build_sqs_record("message-1", notification),
+                _build_sqs_record("message-2", throttled, receive_count=3),
+                _build_sqs_record("message-3", rejected),
+            ]
+        },
+        lambda_context,
+    )
+
+    # Rejected addresses won't be accepted on a retry, so only the throttled one is retried
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "message-2"}]}
+    assert mock_ses.send_email.call_count == 3
+    mock_sqs.change_message_visibility.assert_called_once_with(
+        QueueUrl=NOTIFICATION_QUEUE_URL,
+        ReceiptHandle="message-2-receipt-handle",
+        VisibilityTimeout=120,
+    )
+
+
+def test_notifications_are_sent_in_bulk_with_ses_templates(
+    lambda_context, mock_ses, mock_sqs, monkeypatch
+):
+    _, object_info = _build_trigger_event()
+    failure = _build_notification_message(object_info, reason="reason")
+    success = {
+        "notification": {
+            "template": "success",
+            "destination": [object_info.user],
+            "subject": "We have received your reference data file <test>.csv",
+            "template_data": {"agreement": object_info.agreement, "file": "test.csv"},
+        }
+    }
+    records = [_build_sqs_record(f"success-{i}", success) for i in range(60)]
+    records.append(_build_sqs_record("failure", failure))
+
+    def send_bulk_templated_email(Destinations: list, **_) -> dict:
+        return {"Status": [{"Status": "Success"} for _ in Destinations]}
+
+    mock_ses.send_bulk_templated_email.side_effect = send_bulk_templated_email
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "SES_TEMPLATE_PREFIX", "test-")
+    monkeypatch.setattr(main, "ses_template_names", {})
+
+    resp = main.lambda_handler({"Records": records}, lambda_context)
+
+    assert resp == {"batchItemFailures": []}
+    mock_ses.send_email.assert_not_called()
+    bulk_calls = mock_ses.send_bulk_templated_email.call_args_list
+    assert [len(call.kwargs["Destinations"]) for call in bulk_calls] == [50, 10, 1]
+    assert bulk_calls[0].kwargs["Template"].startswith("test-success-")
+    assert bulk_calls[2].kwargs["Template"].startswith("test-failure-")
+    assert bulk_calls[2].kwargs["Destinations"] == [
+        {
+            "Destination": {"ToAddresses": [object_info.user]},
+            "ReplacementTemplateData": json.dumps(
+                {
+                    "agreement": object_info.agreement,
+                    "file": object_info.file,
+                    "reason": "reason",
+                    "subject": f"There is a technical error with your reference data file {object_info.file}",
+                }
+            ),
+        }
+    ]
+
+    # Each template is created once, from the Jinja template with Handlebars placeholders
+    assert mock_ses.create_template.call_count == 2
+    ses_template = mock_ses.create_template.call_args_list[1].kwargs["Template"]
+    assert ses_template["TemplateName"] == bulk_calls[2].kwargs["Template"]
+    assert ses_template["SubjectPart"] == "{{{subject}}}"
+    assert ses_template["HtmlPart"].replace("{{agreement}}", "agreement").replace(
+        "{{file}}", "file.csv"
+    ).replace("{{reason}}", "reason") == main.validation_failure_template.render(
+        agreement="agreement", file="file.csv", reason="reason"
+    )
+
+
+def test_failed_bulk_notifications_are_retried(
+    lambda_context, mock_ses, mock_sqs, monkeypatch
+):
+    _, object_info = _build_trigger_event()
+    notification = _build_notification_message(object_info, reason="reason")
+    mock_ses.send_bulk_templated_email.return_value = {
+        "Status": [
+            {"Status": "Success"},
+            {"Status": "AccountThrottled"},
+            {"Status": "MessageRejected"},
+        ]
+    }
+    mock_ses.create_template.side_effect = ClientError(
+        {"Error": {"Code": "AlreadyExists"}}, "CreateTemplate"
+    )
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "SES_TEMPLATE_PREFIX", "test-")
+    monkeypatch.setattr(main, "ses_template_names", {})
+
+    resp = main.lambda_handler(
+        {
+            "Records": [
+                _build_sqs_record(f"message-{i}", notification) for i in range(3)
+            ]
+        },
+        lambda_context,
+    )
+
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+    mock_ses.send_bulk_templated_email.assert_called_once()
+
+
+def test_bulk_notification_failure_without_queue_returns_error(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, _ = _build_trigger_event()
+    mock_ses.send_bulk_templated_email.return_value = {
+        "Status": [{"Status": "AccountThrottled"}]
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "SES_TEMPLATE_PREFIX", "test-")
+    monkeypatch.setattr(main, "ses_template_names", {})
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert resp["body"] == json.dumps(
+        {"message": "Failed to send validation success notification email to user."}
+    )
+    mock_ses.send_email.assert_not_called()
+
+
+@pytest.fixture
+def content_index(monkeypatch):
+    from data_in_forwarder.utils.content_index import ContentIndex
+    from data_in_forwarder.utils.store import SQLiteStateStore
+    from data_in_forwarder.utils.verdict_cache import VerdictCache
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    state_store = SQLiteStateStore(":memory:")
+    index = ContentIndex(state_store, ttl_seconds=60)
+    monkeypatch.setattr(main, "STATE_TABLE_NAME", "sqlite://:memory:")
+    monkeypatch.setattr(main, "state_store", state_store)
+    monkeypatch.setattr(main, "content_index", index)
+    monkeypatch.setattr(main, "verdict_cache", VerdictCache(state_store, 60))
+    return index
+
+
+def test_identical_reupload_of_accepted_content_is_not_forwarded_again(
+    lambda_context, mock_ses, mock_s3, content_index
+):
+    first_event, first_object_info = _build_trigger_event(file_name="first.csv")
+    event, object_info = _build_trigger_event(file_name="second.csv")
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("valid.csv")
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    main.lambda_handler(first_event, lambda_context)
+    mock_s3.list_objects_v2.side_effect = lambda Prefix, **_: {
+        "Contents": [{"Key": Prefix}] if Prefix == first_object_info.key else []
+    }
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    assert resp["body"] == (
+        f"Object {object_info.s3_uri} is a duplicate of "
+        f"s3://{IMPORT_DATA_PENDING_BUCKET_NAME}/{first_object_info.key}"
+    )
+    mock_s3.copy_object.assert_called_once_with(
+        Bucket=IMPORT_DATA_PENDING_BUCKET_NAME,
+        Key=first_object_info.key,
+        CopySource=first_object_info.object_location,
+        ACL="bucket-owner-full-control",
+    )
+    mock_s3.delete_object.assert_called_with(
+        Bucket=object_info.bucket, Key=object_info.key
+    )
+    assert mock_ses.send_email.call_count == 2
+    mock_ses.send_email.assert_called_with(
+        **_build_email_request(
+            destination=object_info.user,
+            subject=f"Your reference data file {object_info.file} is a duplicate",
+            html_message=main.validation_duplicate_template.render(
+                agreement=object_info.agreement,
+                file=object_info.file,
+                original_file=first_object_info.file,
+            ),
+            source=SOURCE_EMAIL_ADDRESS,
+        )
+    )
+
+
+def test_identical_reupload_is_forwarded_again_once_original_is_gone(
+    lambda_context, mock_ses, mock_s3, content_index
+):
+    first_event, _ = _build_trigger_event(file_name="first.csv")
+    event, object_info = _build_trigger_event(file_name="second.csv")
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("valid.csv")
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    main.lambda_handler(first_event, lambda_context)
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["body"] == f"Object {object_info.s3_uri} forwarded successfully"
+    assert mock_s3.copy_object.call_count == 2
+    mock_s3.copy_object.assert_called_with(
+        Bucket=IMPORT_DATA_PENDING_BUCKET_NAME,
+        Key=object_info.key,
+        CopySource=object_info.object_location,
+        ACL="bucket-owner-full-control",
+    )
+
+
+def test_identical_reupload_of_rejected_content_reuses_verdict(
+    lambda_context, mock_ses, mock_s3, content_index, monkeypatch
+):
+    first_event, _ = _build_trigger_event(file_name="first.csv")
+    event, object_info = _build_trigger_event(file_name="second.csv")
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("not_enough_rows.csv")
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    main.lambda_handler(first_event, lambda_context)
+    mock_validate_csv_rows = set_up_mock(
+        monkeypatch, "data_in_forwarder.data_in_forwarder.validate_csv_rows"
+    )
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    mock_validate_csv_rows.assert_not_called()
+    mock_ses.send_email.assert_called_with(
+        **_build_email_request(
+            destination=object_info.user,
+            subject=f"There is a technical error with your reference data file {object_info.file}",
+            html_message=main.validation_failure_template.render(
+                agreement=object_info.agreement,
+                file=object_info.file,
+                reason="File has too few rows (1)",
+            ),
+            source=SOURCE_EMAIL_ADDRESS,
+        )
+    )
+    assert mock_s3.copy_object.call_args.kwargs["Bucket"] == (
+        IMPORT_DATA_REJECTED_BUCKET_NAME
+    )
+
+
+def test_identical_content_for_another_agreement_is_forwarded(
+    lambda_context, mock_ses, mock_s3, content_index
+):
+    first_event, _ = _build_trigger_event(agreement="dsa-000000-first")
+    event, object_info = _build_trigger_event(agreement="dsa-000000-second")
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("valid.csv")
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    main.lambda_handler(first_event, lambda_context)
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["body"] == f"Object {object_info.s3_uri} forwarded successfully"
+    assert mock_s3.copy_object.call_count == 2
+
+
+def test_retry_after_failed_move_reuses_cached_verdict(
+    lambda_context, mock_ses, mock_s3, content_index
+):
+    event, object_info = _build_trigger_event()
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("valid.csv")
+    }
+    mock_s3.delete_object.side_effect = [ClientError({}, {}), {}]
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    first_resp = main.lambda_handler(event, lambda_context)
+    # The copy to pending succeeded, so the same name check would now reject the object
+    mock_s3.list_objects_v2.return_value = {"Contents": [{"Key": object_info.key}]}
+    retry_resp = main.lambda_handler(event, lambda_context)
+
+    assert first_resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert retry_resp["statusCode"] == HTTPStatus.OK
+    assert retry_resp["body"] == f"Object {object_info.s3_uri} forwarded successfully"
+    mock_s3.get_object.assert_called_once()
+    mock_s3.list_objects_v2.assert_called_once()
+
+
+def test_new_version_of_object_is_validated_again(
+    lambda_context, mock_ses, mock_s3, content_index
+):
+    first_event, _ = _build_trigger_event(etag="version-1")
+    event, _ = _build_trigger_event(etag="version-2")
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("not_enough_rows.csv")
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    main.lambda_handler(first_event, lambda_context)
+    main.lambda_handler(first_event, lambda_context)
+    main.lambda_handler(event, lambda_context)
+
+    # The redelivered event reuses its verdict, but the new version is checked again
+    assert mock_s3.list_objects_v2.call_count == 2
+    assert mock_s3.get_object.call_count == 2
+    # The redelivered event had already been handled, so the user isn't emailed again
+    assert mock_ses.send_email.call_count == 2
+
+
+def test_retry_after_failed_delete_does_not_copy_again(
+    lambda_context, mock_ses, mock_s3, content_index
+):
+    event, _ = _build_trigger_event()
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("valid.csv")
+    }
+    mock_s3.delete_object.side_effect = [ClientError({}, {}), {}]
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    main.lambda_handler(event, lambda_context)
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    mock_s3.copy_object.assert_called_once()
+    assert mock_s3.delete_object.call_count == 2
+    mock_ses.send_email.assert_called_once()
+
+
+def test_failed_success_email_is_retried_without_moving_again(
+    lambda_context, mock_ses, mock_s3, content_index
+):
+    event, _ = _build_trigger_event()
+    sqs_event = {"Records": [_build_sqs_record("message-1", event)]}
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": create_s3_object_body("valid.csv")
+    }
+    mock_ses.send_email.side_effect = [ClientError({}, {}), {}]
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    first_resp = main.lambda_handler(sqs_event, lambda_context)
+    retry_resp = main.lambda_handler(sqs_event, lambda_context)
+
+    # Completed steps are checkpointed, so the event can be redelivered to resume
+    assert first_resp == {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+    assert retry_resp == {"batchItemFailures": []}
+    mock_s3.copy_object.assert_called_once()
+    mock_s3.delete_object.assert_called_once()
+    assert mock_ses.send_email.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "data, encoding",
+    [
+        (b"col1,col2\r\ndata1,data2\r\n", "utf-8"),
+        ("col1,col2\r\ncafé,data2\r\n".encode("utf-8-sig"), "utf-8-sig"),
+        ("col1,col2\r\ncafé,data2\r\n".encode("utf-16"), "utf-16"),
+        ("col1,col2\r\ncafé,data2\r\n".encode("utf-16-le"), "utf-16-le"),
+        ("col1,col2\r\ncafé,data2\r\n".encode("utf-16-be"), "utf-16-be"),
+        ("col1,col2\r\ncafé,“data”\r\n".encode("cp1252"), "cp1252"),
+        (b"col1,col2\r\ncaf\x81,data2\r\n", "latin-1"),
+        # Part of a multi-byte character at the end of the sample is still UTF-8
+        ("col1,col2\r\ncafé".encode("utf-8")[:-1], "utf-8"),
+        # Stray NULs in ASCII text don't make it UTF-16
+        (b"a,b\n1,\x002\n", "utf-8"),
+        pytest.param(b"a,b\n" + b"1,2\n" * 1000 + b"\x00", "utf-8", id="even-nul"),
+        pytest.param(b"a,b\n" + b"1,2\n" * 1000 + b"3\x00", "utf-8", id="odd-nul"),
+    ],
+)
+def test_encoding_is_detected_from_sample(data, encoding):
+    from data_in_forwarder.utils.encoding import detect_encoding
+
+    assert detect_encoding(data) == encoding
+
+
+def test_utf8_file_with_bom_is_forwarded_without_it(lambda_context, mock_ses, mock_s3):
+    event, _ = _build_trigger_event()
+    data = "col1,col2\r\ncafé,data2\r\n".encode("utf-8-sig")
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+    uploaded = []
+    mock_s3.upload_fileobj.side_effect = lambda fileobj, *_, **__: uploaded.append(
+        fileobj.read()
+    )
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    assert uploaded == ["col1,col2\r\ncafé,data2\r\n".encode("utf-8")]
+
+
+@pytest.mark.parametrize("encoding", ["cp1252", "utf-16"])
+def test_non_utf8_file_is_forwarded_as_utf8(
+    lambda_context, mock_ses, mock_s3, monkeypatch, encoding
+):
+    event, object_info = _build_trigger_event()
+    text = "col1,col2\r\n" + "café,data2\r\n" * 100
+    mock_s3.get_object.side_effect = _ranged_get_object(text.encode(encoding))
+    uploaded = []
+    mock_s3.upload_fileobj.side_effect = lambda fileobj, *_, **__: uploaded.append(
+        fileobj.read()
+    )
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MAX_DATA_SIZE_IN_BYTES", 10000)
+    monkeypatch.setattr(main, "HEADER_SAMPLE_SIZE_IN_BYTES", 256)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    assert uploaded == [text.encode("utf-8")]
+    assert mock_s3.upload_fileobj.call_args.args[1:] == (
+        IMPORT_DATA_PENDING_BUCKET_NAME,
+        object_info.key,
+    )
+    assert mock_s3.upload_fileobj.call_args.kwargs == {
+        "ExtraArgs": {"ACL": "bucket-owner-full-control"}
+    }
+    mock_s3.copy_object.assert_not_called()
+    mock_s3.delete_object.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "sample, csv_format",
+    [
+        ("col1,col2\r\ndata1,data2\r\n", {}),
+        ("col1;col2\r\n1,5;2,5\r\n3,5;4,5\r\n", {"delimiter": ";"}),
+        ("col1\tcol2\r\ndata 1\tdata 2\r\n", {"delimiter": "\t"}),
+        ("col1|col2\r\ndata1|data2\r\n", {"delimiter": "|"}),
+        ('col1;col2\r\n"a;b";"c"\r\n"d";"e"\r\n', {"delimiter": ";"}),
+        # Single quotes are kept as part of a cell
+        ("id,name,status\n1,'x',ok\n2,\"Doe, Jane\",ok\n", {}),
+        ("col1;col2\r\n'a';b\r\nc;'d'\r\n", {"delimiter": ";"}),
+        # Single columns can't be sniffed, and the incomplete last line isn't sniffed
+        ("col1\r\ndata1\r\n", {}),
+        ("col1;col2\r\ndata1;data2\r\ndata1,data", {"delimiter": ";"}),
+    ],
+)
+def test_csv_format_is_detected_from_sample(sample, csv_format):
+    from data_in_forwarder.utils.dialect import detect_csv_format
+
+    assert detect_csv_format(sample) == csv_format
+
+
+def test_file_with_single_quoted_cell_is_accepted(lambda_context, mock_ses, mock_s3):
+    data = b"id,name,status\n1,'x',ok\n2,\"Doe, Jane\",ok\n"
+    event, _ = _build_trigger_event(size=len(data))
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    mock_s3.copy_object.assert_called_once()
+
+
+def test_semicolon_separated_file_is_validated_with_its_delimiter(
+    lambda_context, mock_ses, mock_s3
+):
+    event, _ = _build_trigger_event()
+    data = b"col1;col2\r\n" + b"1,5;2,5\r\n" * 10 + b"3,5\r\n"
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    mock_ses.send_email.assert_called_once()
+    assert "Line 12 has 1 columns, but the header row has 2" in (
+        mock_ses.send_email.call_args.kwargs["Message"]["Body"]["Html"]["Data"]
+    )
+
+
+@pytest.mark.parametrize("normalise", [False, True])
+def test_semicolon_separated_file_is_normalised_when_enabled(
+    lambda_context, mock_ses, mock_s3, monkeypatch, normalise
+):
+    event, _ = _build_trigger_event()
+    data = b'col1;col2\r\n1,5;"say ""hi"""\r\n' + b"3,5;4,5\r\n" * 1500
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+    uploaded = []
+    mock_s3.upload_fileobj.side_effect = lambda fileobj, *_, **__: uploaded.append(
+        fileobj.read()
+    )
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MAX_DATA_SIZE_IN_BYTES", len(data))
+    monkeypatch.setattr(main, "NORMALISE_CSV", normalise)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    if normalise:
+        mock_s3.copy_object.assert_not_called()
+        assert uploaded == [
+            b'col1,col2\r\n"1,5","say ""hi"""\r\n' + b'"3,5","4,5"\r\n' * 1500
+        ]
+    else:
+        mock_s3.copy_object.assert_called_once()
+        mock_s3.upload_fileobj.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "file_name, compress",
+    [
+        ("test.csv.gz", lambda data: gzip.compress(data)),
+        (
+            "test.csv.gz",
+            lambda data: gzip.compress(data[:40]) + gzip.compress(data[40:]),
+        ),
+        ("test.zip", lambda data: _zip({"test.csv": data})),
+        ("test.zip", lambda data: _zip({"test.csv": data}, streamed=True)),
+        ("test.zip", lambda data: _zip({"test.csv": data}, zipfile.ZIP_STORED)),
+    ],
+)
+def test_compressed_file_is_validated_and_forwarded_as_uploaded(
+    lambda_context, mock_ses, mock_s3, file_name, compress, monkeypatch
+):
+    data = "col1,col2\r\ncafé,data2\r\n".encode("cp1252") * 3
+    compressed = compress(data)
+    event, object_info = _build_trigger_event(file_name=file_name, size=len(compressed))
+    mock_s3.get_object.side_effect = _ranged_get_object(compressed)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MAX_DATA_SIZE_IN_BYTES", 10000)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    # The compressed original is copied, rather than being converted to UTF-8
+    mock_s3.upload_fileobj.assert_not_called()
+    mock_s3.copy_object.assert_called_once_with(
+        Bucket=IMPORT_DATA_PENDING_BUCKET_NAME,
+        Key=object_info.key,
+        CopySource=object_info.object_location,
+        ACL="bucket-owner-full-control",
+    )
+
+
+def test_compressed_file_is_validated_from_downloaded_copy(
+    lambda_context, mock_ses, mock_s3, content_index, monkeypatch
+):
+    compressed = gzip.compress(b"col1,col2\ndata1\n")
+    event, _ = _build_trigger_event(file_name="test.csv.gz", size=len(compressed))
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": StreamingBody(BytesIO(compressed), len(compressed))
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MAX_DATA_SIZE_IN_BYTES", 10000)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert "Line 2 has 1 columns, but the header row has 2" in (
+        mock_ses.send_email.call_args.kwargs["Message"]["Body"]["Html"]["Data"]
+    )
+
+
+@pytest.mark.parametrize(
+    "file_name, build_file, reason",
+    [
+        (
+            "test.csv.gz",
+            lambda: gzip.compress(b"col1,col2\n" + b"\0" * 1024 * 1024),
+            "File is too large once decompressed",
+        ),
+        (
+            "test.zip",
+            lambda: _zip({"test.csv": b"col1,col2\n" + b"\0" * 1024 * 1024}),
+            "File is too large once decompressed",
+        ),
+        (
+            "test.csv.gz",
+            lambda: gzip.compress(b"col1,col2\ndata1,data2\n")[:-6],
+            "File is not a valid gzip file",
+        ),
+        (
+            "test.csv.gz",
+            lambda: b"col1,col2\ndata1,data2\n",
+            "File is not a valid gzip file",
+        ),
+        (
+            "test.zip",
+            lambda: _zip({"test.csv": b"col1,col2\n", "other.csv": b"col1,col2\n"}),
+            "Zip file must contain a single &#39;.csv&#39; file",
+        ),
+        (
+            "test.zip",
+            lambda: _zip({"test.xlsx": b"col1,col2\ndata1,data2\n"}),
+            "Zip file must contain a single &#39;.csv&#39; file (test.xlsx)",
+        ),
+    ],
+)
+def test_invalid_compressed_file_returns_validation_error(
+    lambda_context, mock_ses, mock_s3, file_name, build_file, reason, monkeypatch
+):
+    compressed = build_file()
+    event, object_info = _build_trigger_event(file_name=file_name, size=len(compressed))
+    mock_s3.get_object.side_effect = _ranged_get_object(compressed)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MAX_DATA_SIZE_IN_BYTES", 10000)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert reason in (
+        mock_ses.send_email.call_args.kwargs["Message"]["Body"]["Html"]["Data"]
+    )
+    mock_s3.copy_object.assert_called_once_with(
+        Bucket=IMPORT_DATA_REJECTED_BUCKET_NAME,
+        Key=object_info.key,
+        CopySource=object_info.object_location,
+        ACL="bucket-owner-full-control",
+    )
+
+
+INVALID_ROWS_DATA = (
+    b"col 1,col2\n"
+    b"data1,data2\n"
+    b"data1\n"
+    b'data1,"data\n2"\n'
+    b"data1,data2,data3\n"
+    b"data1,data2\n"
+)
+
+
+def test_validation_report_lists_every_problem(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+    mock_s3.get_object.side_effect = _ranged_get_object(INVALID_ROWS_DATA)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "VALIDATION_REPORT_MAX_PROBLEMS", 10)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    report_key = f"{object_info.key}.report.json"
+    mock_s3.put_object.assert_called_once_with(
+        Bucket=IMPORT_DATA_REJECTED_BUCKET_NAME,
+        Key=report_key,
+        Body=ANY,
+        ContentType="application/json",
+        ACL="bucket-owner-full-control",
+    )
+    assert json.loads(mock_s3.put_object.call_args.kwargs["Body"]) == {
+        "file": object_info.file,
+        "truncated": False,
+        "problems": [
+            {
+                "message": "Headers within the file contain spaces or special characters.",
+                "line": None,
+                "rule": "header_naming",
+            },
+            {
+                "message": "Line 3 has 1 columns, but the header row has 2",
+                "line": 3,
+                "rule": "column_count",
+            },
+            {
+                "message": "Line 5 has 3 columns, but the header row has 2",
+                "line": 5,
+                "rule": "column_count",
+            },
+            {
+                "message": "Data within the file contains line break",
+                "line": 4,
+                "rule": "line_breaks",
+            },
+        ],
+    }
+    mock_s3.generate_presigned_url.assert_not_called()
+    mock_ses.send_email.assert_called_once_with(
+        **_build_email_request(
+            destination=object_info.user,
+            subject=f"There is a technical error with your reference data file {object_info.file}",
+            html_message=main.validation_failure_report_template.render(
+                agreement=object_info.agreement,
+                file=object_info.file,
+                reason="Headers within the file contain spaces or special characters."
+                "\n\nThis is the first of 4 problems found with the file.",
+                report_name=f"{object_info.file}.report.json",
+            ),
+            source=SOURCE_EMAIL_ADDRESS,
+        )
+    )
+    mock_s3.copy_object.assert_called_once()
+
+
+def test_validation_report_stops_at_max_problems(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+    mock_s3.get_object.side_effect = _ranged_get_object(INVALID_ROWS_DATA)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "VALIDATION_REPORT_MAX_PROBLEMS", 2)
+    monkeypatch.setattr(main, "VALIDATION_REPORT_FORMAT", "csv")
+
+    main.lambda_handler(event, lambda_context)
+
+    mock_s3.put_object.assert_called_once()
+    assert mock_s3.put_object.call_args.kwargs["Key"] == (
+        f"{object_info.key}.report.csv"
+    )
+    assert mock_s3.put_object.call_args.kwargs["Body"].decode().splitlines() == [
+        "line,rule,message",
+        ",header_naming,Headers within the file contain spaces or special characters.",
+        '3,column_count,"Line 3 has 1 columns, but the header row has 2"',
+    ]
+    assert (
+        "This is the first of at least 2 problems found with the file."
+        in mock_ses.send_email.call_args.kwargs["Message"]["Body"]["Html"]["Data"]
+    )
+
+
+def test_validation_report_ends_with_error_that_stopped_parsing(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+    data = b"col1,col2\ndata1\n" + b"data1,data2\n" * 1000 + b"\xff\n"
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "MAX_DATA_SIZE_IN_BYTES", len(data))
+    monkeypatch.setattr(main, "VALIDATION_REPORT_MAX_PROBLEMS", 10)
+
+    main.lambda_handler(event, lambda_context)
+
+    assert json.loads(mock_s3.put_object.call_args.kwargs["Body"])["problems"] == [
+        {
+            "message": "Line 2 has 1 columns, but the header row has 2",
+            "line": 2,
+            "rule": "column_count",
+        },
+        {"message": "File is not a valid CSV file", "line": None, "rule": None},
+    ]
+
+
+def test_failed_validation_report_falls_back_to_failure_email(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, object_info = _build_trigger_event()
+    mock_s3.get_object.side_effect = _ranged_get_object(INVALID_ROWS_DATA)
+    mock_s3.put_object.side_effect = ClientError({}, "PutObject")
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "VALIDATION_REPORT_MAX_PROBLEMS", 10)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    mock_ses.send_email.assert_called_once_with(
+        **_build_email_request(
+            destination=object_info.user,
+            subject=f"There is a technical error with your reference data file {object_info.file}",
+            html_message=main.validation_failure_template.render(
+                agreement=object_info.agreement,
+                file=object_info.file,
+                reason="Headers within the file contain spaces or special characters."
+                "\n\nThis is the first of 4 problems found with the file.",
+            ),
+            source=SOURCE_EMAIL_ADDRESS,
+        )
+    )
+    mock_s3.copy_object.assert_called_once()
+
+
+AGREEMENT_SCHEMA = {
+    "columns": [
+        {"name": "id", "type": "integer", "nullable": False},
+        {"name": "name"},
+        {"name": "score", "type": "decimal"},
+        {"name": "born", "type": "date"},
+        {"name": "active", "type": "boolean"},
+    ]
+}
+
+
+@pytest.fixture
+def schema_registry(monkeypatch) -> Mock:
+    from data_in_forwarder.utils.schema import SchemaRegistry
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    client = Mock()
+    client.get_object.side_effect = lambda **_: {
+        "Body": StreamingBody(
+            BytesIO(json.dumps(AGREEMENT_SCHEMA).encode()),
+            len(json.dumps(AGREEMENT_SCHEMA)),
+        )
+    }
+    monkeypatch.setattr(main, "SCHEMA_BUCKET_NAME", "schemas")
+    monkeypatch.setattr(main, "schema_registry", SchemaRegistry(client, "schemas", 60))
+    return client
+
+
+@pytest.mark.parametrize(
+    "data, reason",
+    [
+        (
+            b"id,name,score,born,active\n1,a,1.5,2001-02-03,true\n2,,,,\n",
+            None,
+        ),
+        (
+            b"name,id,active,born,score\na,1,FALSE,2001-02-03,-2e3\n",
+            None,
+        ),
+        (
+            b"id,name,score,born,active\n1,a,1.5,2001-02-03,true\n1.0,b,,,\n",
+            "Line 3 has the value &#39;1.0&#39; for column id, which isn&#39;t a valid "
+            "integer",
+        ),
+        (
+            b"id,name,score,born,active\n,a,1.5,2001-02-03,true\n",
+            "Line 2 has no value for the required column id",
+        ),
+        (
+            b"id,name,score,born,active\n1,a,1.5,03/02/2001,true\n",
+            "Line 2 has the value &#39;03/02/2001&#39; for column born, which isn&#39;t "
+            "a valid date",
+        ),
+        (
+            b"id,name,born,extra\n1,a,2001-02-03,x\n",
+            "The file is missing the columns score, active and has the unexpected "
+            "columns extra for the agreement&#39;s schema.",
+        ),
+    ],
+)
+def test_file_is_validated_against_agreement_schema(
+    lambda_context, mock_ses, mock_s3, schema_registry, data, reason
+):
+    event, object_info = _build_trigger_event()
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    schema_registry.get_object.assert_called_once_with(
+        Bucket="schemas", Key=f"{object_info.agreement}.json"
+    )
+    if reason is None:
+        assert resp["statusCode"] == HTTPStatus.OK
+    else:
+        assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+        assert reason in (
+            mock_ses.send_email.call_args.kwargs["Message"]["Body"]["Html"]["Data"]
+        )
+
+
+def test_content_rejected_by_old_schema_is_validated_against_new_schema(
+    lambda_context, mock_ses, mock_s3, schema_registry, content_index, monkeypatch
+):
+    from data_in_forwarder.utils.schema import SchemaRegistry
+
+    data = b"id,name,born,extra\n1,a,2001-02-03,x\n"
+    first_event, _ = _build_trigger_event(file_name="first.csv")
+    event, object_info = _build_trigger_event(file_name="second.csv")
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": StreamingBody(BytesIO(data), len(data))
+    }
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    first_resp = main.lambda_handler(first_event, lambda_context)
+    new_schema = json.dumps(
+        {"columns": [{"name": name} for name in ("id", "name", "born", "extra")]}
+    ).encode()
+    client = Mock()
+    client.get_object.side_effect = lambda **_: {
+        "Body": StreamingBody(BytesIO(new_schema), len(new_schema))
+    }
+    monkeypatch.setattr(main, "schema_registry", SchemaRegistry(client, "schemas", 60))
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert first_resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert resp["body"] == f"Object {object_info.s3_uri} forwarded successfully"
+
+
+def test_agreement_schemas_are_cached_across_invocations(
+    lambda_context, mock_ses, mock_s3, schema_registry
+):
+    event, _ = _build_trigger_event()
+    other_event, _ = _build_trigger_event(agreement="dsa-000001-other")
+    schema_registry.get_object.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+    )
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    for _ in range(2):
+        mock_s3.get_object.return_value = {"Body": create_s3_object_body("valid.csv")}
+        assert main.lambda_handler(event, lambda_context)["statusCode"] == HTTPStatus.OK
+    mock_s3.get_object.return_value = {"Body": create_s3_object_body("valid.csv")}
+    main.lambda_handler(other_event, lambda_context)
+
+    # Agreements without a schema are cached too, so each is only looked up once
+    assert schema_registry.get_object.call_count == 2
+
+
+def test_failure_to_load_agreement_schema_returns_validation_error(
+    lambda_context, mock_ses, mock_s3, schema_registry
+):
+    event, _ = _build_trigger_event()
+    schema_registry.get_object.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "GetObject"
+    )
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert "Unable to load the schema for the agreement" in (
+        mock_ses.send_email.call_args.kwargs["Message"]["Body"]["Html"]["Data"]
+    )
+    mock_s3.get_object.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "key, parquet_key",
+    [
+        ("dsa-000000-test/data.csv", "dsa-000000-test/data.parquet"),
+        ("dsa-000000-test/data.csv.gz", "dsa-000000-test/data.parquet"),
+        ("dsa-000000-test/data.zip", "dsa-000000-test/data.parquet"),
+    ],
+)
+def test_parquet_key_replaces_extension(key, parquet_key):
+    import data_in_forwarder.data_in_forwarder as main
+
+    assert main._parquet_key(key) == parquet_key
+
+
+def test_accepted_file_is_converted_to_parquet_when_enabled(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    data = b"id,name\n1,a\n2,b\n"
+    event, _ = _build_trigger_event(size=len(data))
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    converter = Mock()
+    converter.finish.return_value = BytesIO(b"PAR1")
+    monkeypatch.setattr(main, "CONVERT_TO_PARQUET", True)
+    monkeypatch.setattr(main, "parquet_available", lambda: True)
+    monkeypatch.setattr(main, "ParquetConverter", Mock(return_value=converter))
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    converter.add_rows.assert_called_once_with(
+        1, [["id", "name"], ["1", "a"], ["2", "b"]]
+    )
+    mock_s3.upload_fileobj.assert_called_once_with(
+        converter.finish.return_value,
+        IMPORT_DATA_PENDING_BUCKET_NAME,
+        "dsa-000000-test/user@email.com/test.parquet",
+        ExtraArgs={"ACL": "bucket-owner-full-control"},
+    )
+    assert converter.finish.return_value.closed
+    mock_s3.copy_object.assert_called_once()
+
+
+def test_parquet_conversion_is_closed_when_validation_fails(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    data = b"id,name\n1,a\n2\n"
+    event, _ = _build_trigger_event(size=len(data))
+    mock_s3.get_object.side_effect = _ranged_get_object(data)
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    converter = Mock()
+    monkeypatch.setattr(main, "CONVERT_TO_PARQUET", True)
+    monkeypatch.setattr(main, "parquet_available", lambda: True)
+    monkeypatch.setattr(main, "ParquetConverter", Mock(return_value=converter))
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    converter.close.assert_called_once()
+    converter.finish.assert_not_called()
+    mock_s3.upload_fileobj.assert_not_called()
+
+
+def test_retry_after_failed_parquet_upload_converts_again(
+    lambda_context, mock_ses, mock_s3, monkeypatch, content_index
+):
+    data = b"id,name\n1,a\n2,b\n"
+    event, _ = _build_trigger_event(size=len(data))
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": StreamingBody(BytesIO(data), len(data))
+    }
+    mock_s3.upload_fileobj.side_effect = [ClientError({}, "PutObject"), None]
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    converters = [Mock(), Mock()]
+    for converter in converters:
+        converter.finish.return_value = BytesIO(b"PAR1")
+    monkeypatch.setattr(main, "CONVERT_TO_PARQUET", True)
+    monkeypatch.setattr(main, "parquet_available", lambda: True)
+    monkeypatch.setattr(main, "ParquetConverter", Mock(side_effect=converters))
+
+    first_resp = main.lambda_handler(event, lambda_context)
+    retry_resp = main.lambda_handler(event, lambda_context)
+
+    assert first_resp["statusCode"] == HTTPStatus.INTERNAL_SERVER_ERROR
+    assert retry_resp["statusCode"] == HTTPStatus.OK
+    converters[1].add_rows.assert_called_once_with(
+        1, [["id", "name"], ["1", "a"], ["2", "b"]]
+    )
+    mock_s3.upload_fileobj.assert_called_with(
+        converters[1].finish.return_value,
+        IMPORT_DATA_PENDING_BUCKET_NAME,
+        "dsa-000000-test/user@email.com/test.parquet",
+        ExtraArgs={"ACL": "bucket-owner-full-control"},
+    )
+    mock_s3.copy_object.assert_called_once()
+
+
+def test_retry_after_copy_does_not_convert_again(
+    lambda_context, mock_ses, mock_s3, monkeypatch, content_index
+):
+    data = b"id,name\n1,a\n2,b\n"
+    event, object_info = _build_trigger_event(size=len(data))
+    mock_s3.get_object.side_effect = lambda **_: {
+        "Body": StreamingBody(BytesIO(data), len(data))
+    }
+    mock_s3.delete_object.side_effect = [ClientError({}, {}), {}]
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    converter = Mock()
+    converter.finish.return_value = BytesIO(b"PAR1")
+    monkeypatch.setattr(main, "CONVERT_TO_PARQUET", True)
+    monkeypatch.setattr(main, "parquet_available", lambda: True)
+    monkeypatch.setattr(main, "ParquetConverter", Mock(return_value=converter))
+
+    main.lambda_handler(event, lambda_context)
+    mock_s3.list_objects_v2.return_value = {"Contents": [{"Key": object_info.key}]}
+    retry_resp = main.lambda_handler(event, lambda_context)
+
+    assert retry_resp["statusCode"] == HTTPStatus.OK
+    main.ParquetConverter.assert_called_once()
+    mock_s3.upload_fileobj.assert_called_once()
+
+
+def test_parquet_conversion_is_skipped_without_pyarrow(
+    lambda_context, mock_ses, mock_s3, monkeypatch
+):
+    event, _ = _build_trigger_event()
+    mock_s3.get_object.return_value = {"Body": create_s3_object_body("valid.csv")}
+
+    import data_in_forwarder.data_in_forwarder as main
+
+    monkeypatch.setattr(main, "CONVERT_TO_PARQUET", True)
+    monkeypatch.setattr(main, "parquet_available", lambda: False)
+
+    resp = main.lambda_handler(event, lambda_context)
+
+    assert resp["statusCode"] == HTTPStatus.OK
+    mock_s3.upload_fileobj.assert_not_called()
+    mock_s3.copy_object.assert_called_once()
+
+
+def test_parquet_converter_infers_column_types():
+    pq = pytest.importorskip("pyarrow.parquet")
+    from data_in_forwarder.utils.parquet import ParquetConverter
+
+    converter = ParquetConverter(BytesIO(), None)
+    converter.add_rows(
+        1, [["id", "score", "active", "name"], ["1", "1.5", "TRUE", "a"]]
+    )
+    converter.add_rows(3, [["2", "", "false", ""]])
+    table = pq.read_table(converter.finish())
+
+    assert [str(field.type) for field in table.schema] == [
+        "int64",
+        "double",
+        "bool",
+        "string",
+    ]
+    assert table.to_pydict() == {
+        "id": [1, 2],
+        "score": [1.5, None],
+        "active": [True, False],
+        "name": ["a", None],
+    }
+
+
+def test_parquet_converter_keeps_numbers_with_leading_zeros_as_text():
+    pq = pytest.importorskip("pyarrow.parquet")
+    from data_in_forwarder.utils.parquet import ParquetConverter
+
+    converter = ParquetConverter(BytesIO(), None)
+    converter.add_rows(
+        1,
+        [
+            ["code", "phone", "amount", "ratio"],
+            ["01234", "07700900123", "+5", "0.5"],
+            ["5678", "07700900456", "6", "0"],
+        ],
+    )
+    table = pq.read_table(converter.finish())
+
+    assert [str(field.type) for field in table.schema] == [
+        "string",
+        "string",
+        "string",
+        "double",
+    ]
+    assert table.to_pydict()["code"] == ["01234", "5678"]
+
+
+def test_parquet_conversion_is_abandoned_when_later_numbers_have_leading_zeros():
+    pytest.importorskip("pyarrow")
+    from data_in_forwarder.utils.parquet import ParquetConverter
+
+    converter = ParquetConverter(BytesIO(), None)
+    converter.add_rows(1, [["id"], ["1234"]])
+    converter.add_rows(3, [["01234"]])
+
+    assert converter.finish() is None
+
+
+def test_closed_parquet_conversion_closes_its_file():
+    pytest.importorskip("pyarrow")
+    from data_in_forwarder.utils.parquet import ParquetConverter
+
+    file = BytesIO()
+    converter = ParquetConverter(file, None)
+    converter.add_rows(1, [["id"], ["1"]])
+    converter.close()
+
+    assert converter.abandoned
+    assert file.closed
+
+
+def test_parquet_conversion_is_abandoned_when_types_change():
+    pytest.importorskip("pyarrow")
+    from data_in_forwarder.utils.parquet import ParquetConverter
+
+    file = BytesIO()
+    converter = ParquetConverter(file, None)
+    converter.add_rows(1, [["id"], ["1"]])
+    converter.add_rows(3, [["x"]])
+
+    assert converter.finish() is None
+    assert file.closed
+
+
+@mock_dynamodb
+def test_dynamodb_state_store_ignores_expired_items(monkeypatch):
+    import boto3
+    from data_in_forwarder.utils import store
+    from data_in_forwarder.utils.store import DynamoDBStateStore
+
+    client = boto3.client("dynamodb", region_name=AWS_REGION)
+    client.create_table(
+        TableName="state",
+        KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    state_store = DynamoDBStateStore(client, "state")
+
+    state_store.put("key", {"value": 1}, ttl_seconds=60)
+    state_store.put("no-ttl", {"value": 2})
+    assert state_store.get("key") == {"value": 1}
+    assert state_store.get("missing") is None
+
+    monkeypatch.setattr(store, "time", lambda: 2**40)
+    assert state_store.get("key") is None
+    assert state_store.get("no-ttl") == {"value": 2}
+
+    state_store.delete("no-ttl")
+    assert state_store.get("no-ttl") is None
+
+
+def _build_trigger_event(
+    bucket: str = "test",
+    agreement: str = "dsa-000000-test",
+    user_id: str = "user@email.com",
+    file_name: str = "test.csv",
+    size: int = int(MAX_DATA_SIZE_IN_BYTES),
+    etag: str = "etag",
+) -> tuple[dict, S3ObjectInfo]:
+    key = f"{agreement}/{user_id}/{file_name}"
+    return (
+        {
+            "Records": [
+                {
+                    "s3": {
+                        "bucket": {"name": bucket},
+                        "object": {"key": key, "size": size, "eTag": etag},
+                    }
+                }
+            ]
+        },
+        S3ObjectInfo(bucket, key, size, etag),
+    )
+
+
+def _build_sqs_record(message_id: str, body: dict, receive_count: int = 1) -> dict:
+    return {
+        "messageId": message_id,
+        "receiptHandle": f"{message_id}-receipt-handle",
+        "body": json.dumps(body),
+        "attributes": {"ApproximateReceiveCount": str(receive_count)},
+        "eventSource": "aws:sqs",
+    }
+
+
+def _build_notification_message(object_info: S3ObjectInfo, reason: str) -> dict:
+    return {
+        "notification": {
+            "template": "failure",
+            "destination": [object_info.user],
+            "subject": f"There is a technical error with your reference data file {object_info.file}",
+            "template_data": {
+                "agreement": object_info.agreement,
+                "file": object_info.file,
+                "reason": reason,
+            },
+        }
+    }
+
+
+def _build_email_request(
+    destination: Union[str, None], html_message: str, source: str, subject: str
+) -> dict:
+    return {
+        "Destination": {"ToAddresses": [destination]},
+        "Message": {
+            "Body": {"Html": {"Charset": CHARSET, "Data": html_message}},
+            "Subject": {"Charset": CHARSET, "Data": subject},
+        },
+        "Source": source,
+    }
+
+
+def create_s3_object_body(test_file: str) -> StreamingBody:
+    with open(f"tests/test_data/{test_file}", "rb") as f:
+        data = f.read()
+    return StreamingBody(BytesIO(data), len(data))
+
+
+def _find_log(mock_logger_info: Mock, message: str) -> dict:
+    return next(
+        call.kwargs
+        for call in mock_logger_info.call_args_list
+        if call.args == (message,)
+    )
+
+
+def _zip(
+    entries: dict[str, bytes],
+    compression: int = zipfile.ZIP_DEFLATED,
+    streamed: bool = False,
+) -> bytes:
+    buffer = BytesIO()
+
+    class WriteOnlyStream:
+        """Stream that zipfile can't seek, so it writes data descriptors"""
+
+        def write(self, data: bytes) -> int:
+            return buffer.write(data)
+
+        def flush(self) -> None:
+            pass
+
+    with zipfile.ZipFile(
+        WriteOnlyStream() if streamed else buffer, "w", compression
+    ) as zip_file:
+        for name, data in entries.items():
+            zip_file.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _ranged_get_object(data: bytes):
+    def get_object(Range: str, **_) -> dict:
+        first_byte, _, last_byte = Range.removeprefix("bytes=").partition("-")
+        if int(first_byte) >= len(data):
+            raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+        end = int(last_byte) + 1 if last_byte else len(data)
+        body = data[int(first_byte) : end]
+        return {"Body": StreamingBody(BytesIO(body), len(body))}
+
+    return get_object
@@ -1,25 +1,377 @@
 import json
 import os
+from abc import ABC, abstractmethod
+from collections import deque
 from datetime import timedelta, datetime
 from json import JSONDecodeError
-from typing import Dict, Any
+from threading import Lock
+from time import monotonic, sleep, time
+from typing import Deque, Dict, Any, Iterable, List, Optional, Tuple
 
 import boto3
 import urllib3
-from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+from aws_lambda_powertools.utilities.batch import BatchProcessor, EventType
 from aws_lambda_powertools.utilities.data_classes import event_source, SNSEvent
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
 from aws_lambda_powertools.utilities.typing import LambdaContext
+from botocore.exceptions import ClientError
 
 INITIAL_MESSAGE = "Successfully validated SNS topic for Amazon SES event publishing."
 
 SLACK_HOOK_URL = os.getenv("SLACK_HOOK_URL")
 AWS_REGION = os.getenv("AWS_REGION", "eu-west-2")
 ERROR_EVENT_TIME_WINDOW = 30
+MAX_ERROR_EVENTS = 3
+# The time window is searched for log events in slices of this many seconds, newest first
+ERROR_EVENT_SLICE_SECONDS = int(os.getenv("ERROR_EVENT_SLICE_SECONDS", "10"))
+# Searching stops once this many bytes of log events have been read
+ERROR_EVENT_MAX_BYTES_SCANNED = int(
+    os.getenv("ERROR_EVENT_MAX_BYTES_SCANNED", str(1024 * 1024))
+)
+# Searching stops once this share of the lambda's remaining time has been used, leaving
+# the rest for posting to Slack
+ERROR_EVENT_TIME_BUDGET_RATIO = float(os.getenv("ERROR_EVENT_TIME_BUDGET_RATIO", "0.5"))
 MAX_SLACK_CONTENT_BLOCKS = 50
+SLACK_CONNECT_TIMEOUT_SECONDS = float(os.getenv("SLACK_CONNECT_TIMEOUT_SECONDS", "3"))
+SLACK_READ_TIMEOUT_SECONDS = float(os.getenv("SLACK_READ_TIMEOUT_SECONDS", "5"))
+SLACK_MAX_ATTEMPTS = int(os.getenv("SLACK_MAX_ATTEMPTS", "4"))
+# Delay before the first retry, doubled for each one after, unless Slack says otherwise
+SLACK_RETRY_BASE_DELAY_SECONDS = float(os.getenv("SLACK_RETRY_BASE_DELAY_SECONDS", "1"))
+SLACK_RETRY_MAX_DELAY_SECONDS = 30
+# Rate limited and server errors are retried. None is a connection error or timeout
+SLACK_RETRYABLE_STATUSES = {None, 429, 500, 502, 503, 504}
+# Metric filters rarely change, so they're cached across warm invocations for this long
+METRIC_FILTER_CACHE_TTL = int(os.getenv("METRIC_FILTER_CACHE_TTL_IN_SECONDS", "300"))
+# Pages of metric filters read for a snapshot of all of them, before falling back to
+# looking them up one metric at a time
+METRIC_FILTER_SNAPSHOT_MAX_PAGES = int(
+    os.getenv("METRIC_FILTER_SNAPSHOT_MAX_PAGES", "5")
+)
+# Alerts with the same alarm name and state, or ECS group, are aggregated for this many
+# seconds after one is posted, and counted in a digest once the window closes, or in the
+# next one posted. 0 posts every alert
+ALERT_AGGREGATION_WINDOW_SECONDS = int(
+    os.getenv("ALERT_AGGREGATION_WINDOW_SECONDS", "0")
+)
+# DynamoDB table holding the aggregation windows, shared by every instance of the lambda.
+# Without one, each instance aggregates the alerts it handles in memory
+ALERT_STATE_TABLE_NAME = os.getenv("ALERT_STATE_TABLE_NAME")
+# How long the count of a closed window is kept for, to be posted in a digest
+ALERT_STATE_RETENTION_SECONDS = 7 * 24 * 60 * 60
 
 logger = Logger()
-http = urllib3.PoolManager()
+metrics = Metrics(namespace=os.getenv("POWERTOOLS_METRICS_NAMESPACE", "slack_alert"))
+# Connections to Slack are kept open across warm invocations. Retries are handled by
+# post_to_slack, so they can follow Slack's Retry-After
+http = urllib3.PoolManager(
+    timeout=urllib3.Timeout(
+        connect=SLACK_CONNECT_TIMEOUT_SECONDS, read=SLACK_READ_TIMEOUT_SECONDS
+    ),
+    retries=False,
+)
 cloudwatch = boto3.client("logs", region_name="eu-west-2")
+sqs_processor = BatchProcessor(event_type=EventType.SQS)
+
+
+class MetricFilterCache:
+    """Metric filters by namespace and metric name, kept across warm invocations
+
+    The first lookup takes a snapshot of every metric filter, if there are few enough to
+    list in METRIC_FILTER_SNAPSHOT_MAX_PAGES pages, so later alarms don't call
+    describe_metric_filters until it expires. Otherwise each metric's filters are looked
+    up and cached separately. Metrics without filters are cached too.
+    """
+
+    def __init__(self, ttl_seconds: int, snapshot_max_pages: int) -> None:
+        self._ttl_seconds = ttl_seconds
+        self._snapshot_max_pages = snapshot_max_pages
+        self._filters: Dict[Tuple[str, str], Tuple[float, List[dict]]] = {}
+        self._snapshot: Dict[Tuple[str, str], List[dict]] = {}
+        # When the snapshot expires, or when to try taking one again if it was too big
+        self._snapshot_expiry = 0.0
+        self._snapshot_complete = False
+        self._lock = Lock()
+
+    def get(self, namespace: str, metric_name: str) -> List[dict]:
+        """The metric filters for a metric, which may be none"""
+        key = (namespace, metric_name)
+        with self._lock:
+            if self._snapshot_expiry <= monotonic():
+                self._take_snapshot()
+            if self._snapshot_complete:
+                return self._snapshot.get(key, [])
+            cached = self._filters.get(key)
+            if cached is not None and cached[0] > monotonic():
+                return cached[1]
+
+        metric_filters = cloudwatch.describe_metric_filters(
+            metricNamespace=namespace, metricName=metric_name
+        ).get("metricFilters", [])
+        with self._lock:
+            self._filters[key] = (monotonic() + self._ttl_seconds, metric_filters)
+        return metric_filters
+
+    def prefetch(self, keys: Iterable[Tuple[str, str]]) -> None:
+        """Look up the metric filters for several metrics at once, e.g. for a batch"""
+        for namespace, metric_name in set(keys):
+            try:
+                self.get(namespace, metric_name)
+            except Exception:
+                logger.exception(
+                    "Error looking up metric filters, continuing for now..."
+                )
+
+    def clear(self) -> None:
+        """Forget every cached metric filter"""
+        with self._lock:
+            self._filters = {}
+            self._snapshot = {}
+            self._snapshot_expiry = 0.0
+            self._snapshot_complete = False
+
+    def _take_snapshot(self) -> None:
+        self._snapshot_expiry = monotonic() + self._ttl_seconds
+        self._snapshot = {}
+        self._snapshot_complete = False
+        if not self._snapshot_max_pages:
+            return
+        try:
+            pages = cloudwatch.get_paginator("describe_metric_filters").paginate()
+            snapshot: Dict[Tuple[str, str], List[dict]] = {}
+            for page_number, page in enumerate(pages, start=1):
+                for metric_filter in page.get("metricFilters", []):
+                    for transformation in metric_filter.get(
+                        "metricTransformations", []
+                    ):
+                        key = (
+                            transformation.get("metricNamespace"),
+                            transformation.get("metricName"),
+                        )
+                        snapshot.setdefault(key, []).append(metric_filter)
+                if page_number >= self._snapshot_max_pages and page.get("nextToken"):
+                    logger.info("Too many metric filters to snapshot")
+                    return
+        except Exception:
+            logger.exception("Error taking a snapshot of the metric filters")
+            return
+        self._snapshot = snapshot
+        self._snapshot_complete = True
+
+
+metric_filter_cache = MetricFilterCache(
+    METRIC_FILTER_CACHE_TTL, METRIC_FILTER_SNAPSHOT_MAX_PAGES
+)
+
+
+class AlertWindowStore(ABC):
+    """The aggregation window of the alerts for each key, and how many it has aggregated"""
+
+    @abstractmethod
+    def record(self, key: str, window_seconds: int) -> Optional[int]:
+        """Record an alert, returning None if it falls in an open window, so is aggregated
+
+        Otherwise a new window is opened, and the number of alerts aggregated in the last
+        one is returned.
+        """
+
+    @abstractmethod
+    def release(self, key: str, aggregated: int) -> None:
+        """Close the window opened for an alert that couldn't be posted
+
+        The aggregated count returned when it was opened is added back, so the alert's
+        retry opens a new window and is posted with it.
+        """
+
+    @abstractmethod
+    def closed(self) -> List[Tuple[str, int]]:
+        """The keys of closed windows with alerts aggregated into them, and how many"""
+
+    @abstractmethod
+    def claim(self, key: str, aggregated: int) -> bool:
+        """Take the count of a closed window to post it in a digest
+
+        Returns False if a new window has been opened, or the count has already been
+        taken, so it's only ever posted once.
+        """
+
+    @abstractmethod
+    def restore(self, key: str, aggregated: int) -> None:
+        """Add back a count taken for a digest that couldn't be posted"""
+
+
+class DynamoDBAlertWindowStore(AlertWindowStore):
+    """Alert windows held in a DynamoDB table, so they're shared by every instance
+
+    The table needs a string partition key named "pk", and should have TTL enabled on the
+    "expires_at" attribute.
+    """
+
+    def __init__(self, client: Any, table_name: str) -> None:
+        self._client = client
+        self._table_name = table_name
+
+    def record(self, key: str, window_seconds: int) -> Optional[int]:
+        now = int(time())
+        # Concurrent alerts race to open a new window, and the losers join it
+        for _ in range(2):
+            try:
+                self._client.update_item(
+                    TableName=self._table_name,
+                    Key={"pk": {"S": key}},
+                    UpdateExpression="ADD aggregated :one",
+                    ConditionExpression="window_end > :now",
+                    ExpressionAttributeValues={
+                        ":one": {"N": "1"},
+                        ":now": {"N": str(now)},
+                    },
+                )
+                return None
+            except ClientError as err:
+                if not _is_conditional_check_failure(err):
+                    raise
+            try:
+                response = self._client.put_item(
+                    TableName=self._table_name,
+                    Item={
+                        "pk": {"S": key},
+                        "window_end": {"N": str(now + window_seconds)},
+                        "aggregated": {"N": "0"},
+                        "expires_at": {
+                            "N": str(
+                                now + window_seconds + ALERT_STATE_RETENTION_SECONDS
+                            )
+                        },
+                    },
+                    ConditionExpression="attribute_not_exists(pk) OR window_end <= :now",
+                    ExpressionAttributeValues={":now": {"N": str(now)}},
+                    ReturnValues="ALL_OLD",
+                )
+            except ClientError as err:
+                if not _is_conditional_check_failure(err):
+                    raise
+                continue
+            return int(response.get("Attributes", {}).get("aggregated", {}).get("N", 0))
+        return None
+
+    def release(self, key: str, aggregated: int) -> None:
+        self._client.update_item(
+            TableName=self._table_name,
+            Key={"pk": {"S": key}},
+            UpdateExpression="SET window_end = :now ADD aggregated :aggregated",
+            ExpressionAttributeValues={
+                ":now": {"N": str(int(time()))},
+                ":aggregated": {"N": str(aggregated)},
+            },
+        )
+
+    def closed(self) -> List[Tuple[str, int]]:
+        # There's an item for each key, so the table stays small enough to scan
+        pages = self._client.get_paginator("scan").paginate(
+            TableName=self._table_name,
+            FilterExpression="window_end <= :now AND aggregated > :zero",
+            ExpressionAttributeValues={
+                ":now": {"N": str(int(time()))},
+                ":zero": {"N": "0"},
+            },
+        )
+        return [
+            (item["pk"]["S"], int(item["aggregated"]["N"]))
+            for page in pages
+            for item in page.get("Items", [])
+        ]
+
+    def claim(self, key: str, aggregated: int) -> bool:
+        try:
+            self._client.update_item(
+                TableName=self._table_name,
+                Key={"pk": {"S": key}},
+                UpdateExpression="SET aggregated = :zero",
+                ConditionExpression="window_end <= :now AND aggregated = :aggregated",
+                ExpressionAttributeValues={
+                    ":zero": {"N": "0"},
+                    ":now": {"N": str(int(time()))},
+                    ":aggregated": {"N": str(aggregated)},
+                },
+            )
+        except ClientError as err:
+            if not _is_conditional_check_failure(err):
+                raise
+            return False
+        return True
+
+    def restore(self, key: str, aggregated: int) -> None:
+        self._client.update_item(
+            TableName=self._table_name,
+            Key={"pk": {"S": key}},
+            UpdateExpression="ADD aggregated :aggregated",
+            ExpressionAttributeValues={":aggregated": {"N": str(aggregated)}},
+        )
+
+
+class MemoryAlertWindowStore(AlertWindowStore):
+    """Alert windows held in memory, as a local stand-in for DynamoDB
+
+    Windows last across warm invocations, but aren't shared between instances.
+    """
+
+    def __init__(self) -> None:
+        # The end of each key's window, and how many alerts it has aggregated
+        self._windows: Dict[str, Tuple[float, int]] = {}
+        self._lock = Lock()
+
+    def record(self, key: str, window_seconds: int) -> Optional[int]:
+        now = time()
+        with self._lock:
+            window_end, aggregated = self._windows.get(key, (0.0, 0))
+            if window_end > now:
+                self._windows[key] = (window_end, aggregated + 1)
+                return None
+            self._windows[key] = (now + window_seconds, 0)
+            return aggregated
+
+    def release(self, key: str, aggregated: int) -> None:
+        with self._lock:
+            _, window_aggregated = self._windows.get(key, (0.0, 0))
+            self._windows[key] = (0.0, window_aggregated + aggregated)
+
+    def closed(self) -> List[Tuple[str, int]]:
+        now = time()
+        with self._lock:
+            return [
+                (key, aggregated)
+                for key, (window_end, aggregated) in self._windows.items()
+                if window_end <= now and aggregated
+            ]
+
+    def claim(self, key: str, aggregated: int) -> bool:
+        with self._lock:
+            window_end, window_aggregated = self._windows.get(key, (0.0, 0))
+            if window_end > time() or window_aggregated != aggregated:
+                return False
+            self._windows[key] = (window_end, 0)
+            return True
+
+    def restore(self, key: str, aggregated: int) -> None:
+        with self._lock:
+            window_end, window_aggregated = self._windows.get(key, (0.0, 0))
+            self._windows[key] = (window_end, window_aggregated + aggregated)
+
+
+def _is_conditional_check_failure(err: ClientError) -> bool:
+    return err.response.get("Error", {}).get("Code") == (
+        "ConditionalCheckFailedException"
+    )
+
+
+alert_windows: AlertWindowStore = (
+    DynamoDBAlertWindowStore(
+        boto3.client("dynamodb", region_name="eu-west-2"), ALERT_STATE_TABLE_NAME
+    )
+    if ALERT_STATE_TABLE_NAME
+    else MemoryAlertWindowStore()
+)
 
 
 def create_markdown_text_section(markdown_text: str):
@@ -28,17 +380,119 @@ def create_markdown_text_section(markdown_text: str):
 
 @event_source(data_class=SNSEvent)
 @logger.inject_lambda_context(clear_state=True)
+@metrics.log_metrics
 def lambda_handler(event: SNSEvent, context: LambdaContext) -> Dict[str, Any]:
     sns_message = json.loads(event.sns_message)
     logger.append_keys(sns_message=sns_message)
 
+    search_seconds = (
+        context.get_remaining_time_in_millis() / 1000 * ERROR_EVENT_TIME_BUDGET_RATIO
+    )
+    return handle_alert(sns_message, context, search_seconds)
+
+
+@logger.inject_lambda_context(clear_state=True)
+@metrics.log_metrics
+def sqs_handler(event: Dict[str, Any], context: LambdaContext) -> Dict[str, Any]:
+    """Handle a batch of SNS alerts buffered in an SQS queue
+
+    The metric filters for the whole batch are looked up before the alerts are handled
+    in turn, each with a share of the time for searching log events. Alerts that can't
+    be posted are reported as batch item failures, so only they are retried.
+    """
+    records = event.get("Records", [])
+    sns_messages = {}
+    for record in records:
+        try:
+            sns_messages[record["messageId"]] = _sns_message_from_sqs_body(
+                record["body"]
+            )
+        except (JSONDecodeError, KeyError, TypeError):
+            continue  # Reported as a failure when the record is handled
+    triggers = [
+        sns_message.get("Trigger")
+        for sns_message in sns_messages.values()
+        if isinstance(sns_message, dict)
+    ]
+    metric_filter_cache.prefetch(
+        (trigger.get("Namespace"), trigger.get("MetricName"))
+        for trigger in triggers
+        if trigger
+    )
+
+    unhandled = [len(records)]
+
+    def record_handler(record: SQSRecord) -> Dict[str, Any]:
+        unhandled[0] -= 1
+        sns_message = sns_messages.get(record.message_id)
+        if sns_message is None:
+            sns_message = _sns_message_from_sqs_body(record.body)
+        logger.append_keys(sns_message=sns_message)
+        search_seconds = (
+            context.get_remaining_time_in_millis()
+            / 1000
+            * ERROR_EVENT_TIME_BUDGET_RATIO
+            / (unhandled[0] + 1)
+        )
+        return handle_alert(sns_message, context, search_seconds)
+
+    with sqs_processor(records=records, handler=record_handler):
+        sqs_processor.process()
+    return sqs_processor.response()
+
+
+def _sns_message_from_sqs_body(body: str) -> Any:
+    """The alert in the body of an SQS message, with or without its SNS envelope"""
+    sqs_body = json.loads(body)
+    if isinstance(sqs_body, dict) and sqs_body.get("Type") == "Notification":
+        return json.loads(sqs_body["Message"])
+    return sqs_body
+
+
+def handle_alert(
+    sns_message: Any, context: LambdaContext, search_seconds: float
+) -> Dict[str, Any]:
+    """Post an alert to Slack, searching for its log events for up to search_seconds"""
     if sns_message == INITIAL_MESSAGE:
         logger.info("Sns validation event, no action required.")
         return {"message": "Sns validation event, no action required."}
 
+    alert_key = create_alert_key(sns_message)
+    if not ALERT_AGGREGATION_WINDOW_SECONDS or alert_key is None:
+        return _post_alert(sns_message, context, search_seconds)
+
+    try:
+        aggregated = alert_windows.record(alert_key, ALERT_AGGREGATION_WINDOW_SECONDS)
+    except Exception:
+        logger.exception("Error recording alert, posting it anyway...")
+        return _post_alert(sns_message, context, search_seconds)
+    if aggregated is None:
+        logger.info(f"Aggregated alert for {alert_key} into the open window")
+        return {"message": "Alert aggregated into the open window."}
+
+    try:
+        return _post_alert(sns_message, context, search_seconds, alert_key, aggregated)
+    except Exception:
+        # Otherwise the retry would fall in the window, and the alert never be posted
+        try:
+            alert_windows.release(alert_key, aggregated)
+        except Exception:
+            logger.exception(f"Error releasing the window for {alert_key}")
+        raise
+
+
+def _post_alert(
+    sns_message: Any,
+    context: LambdaContext,
+    search_seconds: float,
+    alert_key: Optional[str] = None,
+    aggregated: int = 0,
+) -> Dict[str, Any]:
     logger.info("Sending error details to slack")
 
-    content = create_message_content(sns_message)
+    content = create_message_content(sns_message, monotonic() + search_seconds)
+    if aggregated:
+        content.insert(0, create_aggregated_alerts_section(str(alert_key), aggregated))
     if len(content) > MAX_SLACK_CONTENT_BLOCKS:
         max_minus_one = MAX_SLACK_CONTENT_BLOCKS - 1
         content = content[:max_minus_one]
@@ -47,32 +501,133 @@ def lambda_handler(event: SNSEvent, context: LambdaContext) -> Dict[str, Any]:
     post_content = {"blocks": content}
     logger.info("Posting message to Slack")
 
-    response = http.request(
-        method="POST", url=SLACK_HOOK_URL, body=json.dumps(post_content)
+    status = post_to_slack(
+        post_content, monotonic() + context.get_remaining_time_in_millis() / 1000
     )
-    logger.append_keys(slack_response_status=response.status)
-
-    if response.status != 200:
-        logger.info("Unexpected response from slack, bailing")
-        raise Exception("Post to slack failed")
 
     logger.info("Successfully notified slack")
 
-    return {"status": response.status}
+    return {"status": status}
+
+
+@logger.inject_lambda_context(clear_state=True)
+@metrics.log_metrics
+def flush_handler(event: Dict[str, Any], context: LambdaContext) -> Dict[str, Any]:
+    """Post a digest of the alerts aggregated into each window that has closed
+
+    Run on a schedule, so the count of a window is posted soon after it closes rather
+    than waiting for the next alert with the same key. Digests that can't be posted are
+    left for the next run.
+    """
+    digests = 0
+    for alert_key, aggregated in alert_windows.closed():
+        if not alert_windows.claim(alert_key, aggregated):
+            continue  # Posted with an alert that opened a new window
+        post_content = {
+            "blocks": [create_aggregated_alerts_section(alert_key, aggregated)]
+        }
+        try:
+            post_to_slack(
+                post_content,
+                monotonic() + context.get_remaining_time_in_millis() / 1000,
+            )
+        except Exception:
+            logger.exception(f"Error posting the digest for {alert_key}")
+            alert_windows.restore(alert_key, aggregated)
+            continue
+        digests += 1
+    return {"digests_posted": digests}
 
 
-def create_message_content(sns_message):
+def create_aggregated_alerts_section(alert_key: str, aggregated: int):
+    return create_markdown_text_section(
+        f"*{aggregated} more alerts for {alert_key} in the "
+        f"{ALERT_AGGREGATION_WINDOW_SECONDS} seconds after the last one posted*"
+    )
+
+
+def post_to_slack(post_content: dict, deadline: Optional[float] = None) -> int:
+    """Post a message to Slack, retrying rate limited and failed posts
+
+    Rate limited posts are retried after Slack's Retry-After, and others with
+    exponential backoff, up to SLACK_MAX_ATTEMPTS attempts, as long as the retry can
+    finish before the deadline. The latency of each attempt is recorded as a metric.
+    """
+    body = json.dumps(post_content)
+    for attempt in range(1, SLACK_MAX_ATTEMPTS + 1):
+        start = monotonic()
+        response = None
+        try:
+            response = http.request(method="POST", url=SLACK_HOOK_URL, body=body)
+        except urllib3.exceptions.HTTPError:
+            logger.exception("Error posting to slack")
+        metrics.add_metric(
+            name="SlackDeliveryLatency",
+            unit=MetricUnit.Milliseconds,
+            value=(monotonic() - start) * 1000,
+        )
+        status = response.status if response is not None else None
+        logger.append_keys(slack_response_status=status, slack_attempts=attempt)
+        if status == 200:
+            return status
+
+        if attempt == SLACK_MAX_ATTEMPTS or status not in SLACK_RETRYABLE_STATUSES:
+            break
+        delay = _slack_retry_delay(response, attempt)
+        if deadline is not None and (
+            monotonic()
+            + delay
+            + SLACK_CONNECT_TIMEOUT_SECONDS
+            + SLACK_READ_TIMEOUT_SECONDS
+            > deadline
+        ):
+            logger.info("Not enough time left to retry posting to slack")
+            break
+        logger.info(f"Retrying post to slack in {delay} seconds")
+        metrics.add_metric(name="SlackDeliveryRetries", unit=MetricUnit.Count, value=1)
+        sleep(delay)
+
+    logger.info("Unexpected response from slack, bailing")
+    metrics.add_metric(name="SlackDeliveryFailures", unit=MetricUnit.Count, value=1)
+    raise Exception("Post to slack failed")
+
+
+def _slack_retry_delay(response: Optional[urllib3.HTTPResponse], attempt: int) -> float:
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after is not None:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+    return min(
+        SLACK_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1),
+        SLACK_RETRY_MAX_DELAY_SECONDS,
+    )
+
+
+def create_alert_key(sns_message) -> Optional[str]:
+    """The key alerts are aggregated by, the ECS group or the alarm name and state
+
+    Each state of an alarm has its own key, so it recovering isn't aggregated into the
+    window of its alerts. Other messages aren't aggregated, so None is returned.
+    """
+    if sns_message.get("detail-type") == "ECS Task State Change":
+        return f"ecs:{sns_message['detail']['group']}"
+    if sns_message.get("AlarmName"):
+        return f"alarm:{sns_message['AlarmName']}:{sns_message.get('NewStateValue')}"
+    return None
+
+
+def create_message_content(sns_message, deadline: Optional[float] = None):
     if sns_message.get("detail-type") == "ECS Task State Change":
         return create_ecs_state_change_message(sns_message)
 
     logger.info("Getting metric filter details")
     trigger = sns_message.get("Trigger", {})
     try:
-        metric_filter_descriptions = cloudwatch.describe_metric_filters(
-            metricNamespace=trigger.get("Namespace"),
-            metricName=trigger.get("MetricName"),
+        metric_filters = metric_filter_cache.get(
+            trigger.get("Namespace"), trigger.get("MetricName")
         )
-        metric_filters = metric_filter_descriptions.get("metricFilters")
     except Exception:
         logger.info("Found no metric filters, continuing for now...")
         metric_filters = []
@@ -121,13 +676,9 @@ def create_message_content(sns_message):
         f"Getting matching events from {log_group_name} for the last {ERROR_EVENT_TIME_WINDOW} seconds"
     )
     try:
-        log_events = cloudwatch.filter_log_events(
-            logGroupName=log_group_name,
-            filterPattern=filter_pattern,
-            startTime=int(start_time.timestamp() * 1000),
-            endTime=int(end_time.timestamp() * 1000),
+        events = get_latest_log_events(
+            log_group_name, filter_pattern, start_time, end_time, deadline
         )
-        events = log_events.get("events", [])
     except Exception:
         logger.exception("Error getting log entries, continuing for now...")
         events = []
@@ -144,7 +695,7 @@ def create_message_content(sns_message):
             f"*Matching events from the last {ERROR_EVENT_TIME_WINDOW} seconds*"
         )
     ]
-    for event in events[::-1][:3]:  # Get the latest 3 events
+    for event in events:
         timestamp = event.get("timestamp")
         timestamp = datetime.utcfromtimestamp(timestamp / 1000).isoformat()
         content += [
@@ -163,6 +714,54 @@ def create_message_content(sns_message):
     return content
 
 
+def get_latest_log_events(
+    log_group_name: str,
+    filter_pattern: str,
+    start_time: datetime,
+    end_time: datetime,
+    deadline: Optional[float] = None,
+) -> List[dict]:
+    """Get the latest MAX_ERROR_EVENTS matching log events, newest first
+
+    filter_log_events pages through events oldest first, so the time window is searched
+    a slice at a time from its end, stopping once enough events have been found, and
+    only the latest events of each slice are kept. Searching also stops once
+    ERROR_EVENT_MAX_BYTES_SCANNED bytes of events have been read, or at the deadline,
+    with the latest events found so far.
+    """
+    latest_events: List[dict] = []
+    window_start = int(start_time.timestamp() * 1000)
+    slice_end = int(end_time.timestamp() * 1000)
+    bytes_scanned = 0
+    while slice_end >= window_start and len(latest_events) < MAX_ERROR_EVENTS:
+        # Both ends of the range are inclusive, so slices don't overlap
+        slice_start = max(
+            window_start, slice_end - ERROR_EVENT_SLICE_SECONDS * 1000 + 1
+        )
+        slice_events: Deque[dict] = deque(maxlen=MAX_ERROR_EVENTS - len(latest_events))
+        pages = cloudwatch.get_paginator("filter_log_events").paginate(
+            logGroupName=log_group_name,
+            filterPattern=filter_pattern,
+            startTime=slice_start,
+            endTime=slice_end,
+        )
+        for page in pages:
+            events = page.get("events", [])
+            slice_events.extend(events)
+            bytes_scanned += sum(len(event.get("message", "")) for event in events)
+            if bytes_scanned >= ERROR_EVENT_MAX_BYTES_SCANNED or (
+                deadline is not None and monotonic() >= deadline
+            ):
+                logger.info(
+                    "Stopped searching for log events early",
+                    extra={"bytes_scanned": bytes_scanned},
+                )
+                return latest_events + list(reversed(slice_events))
+        latest_events += reversed(slice_events)
+        slice_end = slice_start - 1
+    return latest_events
+
+
 def create_ecs_state_change_message(sns_message):
     detail_type = sns_message["detail-type"]
     group = sns_message["detail"]["group"]
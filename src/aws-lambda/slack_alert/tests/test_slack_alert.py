@@ -6,7 +6,7 @@ from unittest.mock import Mock
 
 import pytest
 from aws_lambda_powertools.utilities.data_classes import SNSEvent
-from moto import mock_logs
+from moto import mock_dynamodb, mock_logs
 from urllib3 import HTTPResponse
 
 AWS_REGION = os.getenv("AWS_REGION", "eu-west-2")
@@ -78,9 +78,26 @@ def lambda_context():
         invoked_function_arn: str = function_arn
         aws_request_id: str = request_id
 
+        def get_remaining_time_in_millis(self) -> int:
+            return 60000
+
     return LambdaContext()
 
 
+@pytest.fixture(autouse=True)
+def metric_filter_cache(monkeypatch):
+    monkeypatch.setenv("SLACK_HOOK_URL", test_slack_hook_url)
+    # The CloudWatch client is created on import, outside the moto mocks
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    import slack_alert.slack_alert as main
+
+    # Each test has its own mocked metric filters
+    main.metric_filter_cache.clear()
+    yield main.metric_filter_cache
+    main.metrics.clear_metrics()
+
+
 @mock_logs
 def test_do_nothing_for_sns_setup_message(monkeypatch, lambda_context):
     monkeypatch.setenv("SLACK_HOOK_URL", test_slack_hook_url)
@@ -860,3 +877,473 @@ def test_message_does_not_get_events_outside_range(monkeypatch, lambda_context):
             }
         ),
     )
+
+
+def _metric_filter(name: str, namespace: str, metric: str):
+    return {
+        "filterName": name,
+        "logGroupName": f"{name}_log_group",
+        "metricTransformations": [
+            {"metricName": metric, "metricNamespace": namespace, "metricValue": "1"}
+        ],
+    }
+
+
+def test_metric_filters_are_looked_up_from_a_snapshot(monkeypatch):
+    import slack_alert.slack_alert as main
+
+    mock_cloudwatch = Mock()
+    mock_cloudwatch.get_paginator.return_value.paginate.return_value = [
+        {"metricFilters": [_metric_filter("a", metric_namespace, metric_name)]},
+        {"metricFilters": [_metric_filter("b", metric_namespace, "other")]},
+    ]
+    monkeypatch.setattr(main, "cloudwatch", mock_cloudwatch)
+    cache = main.MetricFilterCache(ttl_seconds=60, snapshot_max_pages=5)
+
+    assert cache.get(metric_namespace, metric_name) == [
+        _metric_filter("a", metric_namespace, metric_name)
+    ]
+    assert cache.get(metric_namespace, "other") == [
+        _metric_filter("b", metric_namespace, "other")
+    ]
+    assert cache.get(metric_namespace, "missing") == []
+
+    mock_cloudwatch.get_paginator.assert_called_once_with("describe_metric_filters")
+    mock_cloudwatch.describe_metric_filters.assert_not_called()
+
+
+def test_metric_filters_are_looked_up_per_metric_when_too_many_to_snapshot(
+    monkeypatch,
+):
+    import slack_alert.slack_alert as main
+
+    mock_cloudwatch = Mock()
+    mock_cloudwatch.get_paginator.return_value.paginate.return_value = [
+        {"metricFilters": [], "nextToken": "page2"},
+    ]
+    mock_cloudwatch.describe_metric_filters.return_value = {
+        "metricFilters": [_metric_filter("a", metric_namespace, metric_name)]
+    }
+    monkeypatch.setattr(main, "cloudwatch", mock_cloudwatch)
+    cache = main.MetricFilterCache(ttl_seconds=60, snapshot_max_pages=1)
+
+    for _ in range(3):
+        assert cache.get(metric_namespace, metric_name) == [
+            _metric_filter("a", metric_namespace, metric_name)
+        ]
+
+    # Neither the snapshot nor the lookup is repeated until they expire
+    mock_cloudwatch.get_paginator.assert_called_once()
+    mock_cloudwatch.describe_metric_filters.assert_called_once_with(
+        metricNamespace=metric_namespace, metricName=metric_name
+    )
+
+
+def test_metric_filters_are_looked_up_again_once_expired(monkeypatch):
+    import slack_alert.slack_alert as main
+
+    mock_cloudwatch = Mock()
+    mock_cloudwatch.get_paginator.return_value.paginate.return_value = [
+        {"metricFilters": [_metric_filter("a", metric_namespace, metric_name)]},
+    ]
+    monkeypatch.setattr(main, "cloudwatch", mock_cloudwatch)
+    cache = main.MetricFilterCache(ttl_seconds=0, snapshot_max_pages=5)
+
+    cache.get(metric_namespace, metric_name)
+    cache.get(metric_namespace, metric_name)
+
+    assert mock_cloudwatch.get_paginator.call_count == 2
+
+
+def _paginate_log_events(events):
+    def paginate(startTime, endTime, **_):
+        matching = [e for e in events if startTime <= e["timestamp"] <= endTime]
+        # Two events a page, oldest first, as filter_log_events returns them
+        return [{"events": matching[i : i + 2]} for i in range(0, len(matching), 2)]
+
+    return paginate
+
+
+def test_latest_log_events_are_searched_newest_first(monkeypatch):
+    import slack_alert.slack_alert as main
+
+    events = [
+        {"timestamp": log_event_timestamp(offset), "message": f"blah{-offset}"}
+        for offset in (-25, -8, -6, -4, -2)
+    ]
+    mock_cloudwatch = Mock()
+    paginate = Mock(side_effect=_paginate_log_events(events))
+    mock_cloudwatch.get_paginator.return_value.paginate = paginate
+    monkeypatch.setattr(main, "cloudwatch", mock_cloudwatch)
+    end_time = datetime.strptime(sns_message_time, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+    latest = main.get_latest_log_events(
+        "log_group", "", end_time - timedelta(seconds=30), end_time
+    )
+
+    assert [event["message"] for event in latest] == ["blah2", "blah4", "blah6"]
+    # The latest events were all in the newest slice, so the older ones aren't searched
+    paginate.assert_called_once()
+
+
+def test_latest_log_events_stop_at_bytes_scanned(monkeypatch):
+    import slack_alert.slack_alert as main
+
+    events = [
+        {"timestamp": log_event_timestamp(offset), "message": "x" * 10}
+        for offset in (-25, -15, -5)
+    ]
+    mock_cloudwatch = Mock()
+    paginate = Mock(side_effect=_paginate_log_events(events))
+    mock_cloudwatch.get_paginator.return_value.paginate = paginate
+    monkeypatch.setattr(main, "cloudwatch", mock_cloudwatch)
+    monkeypatch.setattr(main, "ERROR_EVENT_MAX_BYTES_SCANNED", 20)
+    end_time = datetime.strptime(sns_message_time, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+    latest = main.get_latest_log_events(
+        "log_group", "", end_time - timedelta(seconds=30), end_time
+    )
+
+    assert [event["timestamp"] for event in latest] == [
+        log_event_timestamp(-5),
+        log_event_timestamp(-15),
+    ]
+    assert paginate.call_count == 2
+
+
+ecs_task_stopped_message = {
+    "detail-type": "ECS Task State Change",
+    "detail": {
+        "desiredStatus": "STOPPED",
+        "group": "service:keycloak",
+        "stoppedReason": "Essential container in task exited",
+    },
+}
+
+
+@mock_logs
+def test_alerts_are_aggregated_within_window(monkeypatch, lambda_context):
+    import slack_alert.slack_alert as main
+
+    now = [1000.0]
+    mock_http = Mock()
+    mock_http.request.return_value = HTTPResponse(status=200)
+    monkeypatch.setattr(main, "http", mock_http)
+    monkeypatch.setattr(main, "time", lambda: now[0])
+    monkeypatch.setattr(main, "ALERT_AGGREGATION_WINDOW_SECONDS", 60)
+    monkeypatch.setattr(main, "alert_windows", main.MemoryAlertWindowStore())
+    event = {"Records": [{"Sns": {"Message": json.dumps(ecs_task_stopped_message)}}]}
+
+    results = [main.lambda_handler(SNSEvent(event), lambda_context) for _ in range(3)]
+    now[0] += 60
+    results.append(main.lambda_handler(SNSEvent(event), lambda_context))
+
+    assert results == [
+        {"status": 200},
+        {"message": "Alert aggregated into the open window."},
+        {"message": "Alert aggregated into the open window."},
+        {"status": 200},
+    ]
+    assert mock_http.request.call_count == 2
+    first_block = json.loads(mock_http.request.call_args.kwargs["body"])["blocks"][0]
+    assert first_block["text"]["text"] == (
+        "*2 more alerts for ecs:service:keycloak in the 60 seconds after the last one "
+        "posted*"
+    )
+
+
+@mock_logs
+def test_alert_that_fails_to_post_is_posted_when_retried(monkeypatch, lambda_context):
+    import slack_alert.slack_alert as main
+
+    now = [1000.0]
+    mock_http = Mock()
+    mock_http.request.side_effect = [
+        HTTPResponse(status=200),
+        HTTPResponse(status=400),
+        HTTPResponse(status=200),
+    ]
+    monkeypatch.setattr(main, "http", mock_http)
+    monkeypatch.setattr(main, "time", lambda: now[0])
+    monkeypatch.setattr(main, "ALERT_AGGREGATION_WINDOW_SECONDS", 60)
+    monkeypatch.setattr(main, "alert_windows", main.MemoryAlertWindowStore())
+    event = {"Records": [{"Sns": {"Message": json.dumps(ecs_task_stopped_message)}}]}
+
+    main.lambda_handler(SNSEvent(event), lambda_context)
+    main.lambda_handler(SNSEvent(event), lambda_context)
+    now[0] += 60
+    with pytest.raises(Exception, match="Post to slack failed"):
+        main.lambda_handler(SNSEvent(event), lambda_context)
+    result = main.lambda_handler(SNSEvent(event), lambda_context)
+
+    assert result == {"status": 200}
+    assert mock_http.request.call_count == 3
+    first_block = json.loads(mock_http.request.call_args.kwargs["body"])["blocks"][0]
+    assert first_block["text"]["text"] == (
+        "*1 more alerts for ecs:service:keycloak in the 60 seconds after the last one "
+        "posted*"
+    )
+
+
+@mock_dynamodb
+def test_dynamodb_alert_windows_are_shared(monkeypatch):
+    import boto3
+    import slack_alert.slack_alert as main
+
+    now = [1000.0]
+    monkeypatch.setattr(main, "time", lambda: now[0])
+    client = boto3.client("dynamodb", region_name=AWS_REGION)
+    client.create_table(
+        TableName="alerts",
+        KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    stores = [main.DynamoDBAlertWindowStore(client, "alerts") for _ in range(2)]
+
+    assert stores[0].record("alarm:a", 60) == 0
+    assert stores[1].record("alarm:a", 60) is None
+    assert stores[1].record("alarm:b", 60) == 0
+    assert stores[0].record("alarm:a", 60) is None
+    now[0] += 60
+    assert stores[1].record("alarm:a", 60) == 2
+    assert stores[0].record("alarm:a", 60) is None
+    stores[1].release("alarm:a", 2)
+    assert stores[0].record("alarm:a", 60) == 3
+
+
+@mock_dynamodb
+def test_dynamodb_closed_windows_are_claimed_once(monkeypatch):
+    import boto3
+    import slack_alert.slack_alert as main
+
+    now = [1000.0]
+    monkeypatch.setattr(main, "time", lambda: now[0])
+    client = boto3.client("dynamodb", region_name=AWS_REGION)
+    client.create_table(
+        TableName="alerts",
+        KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    stores = [main.DynamoDBAlertWindowStore(client, "alerts") for _ in range(2)]
+    for key in ["alarm:a", "alarm:a", "alarm:a", "alarm:b"]:
+        stores[0].record(key, 60)
+
+    assert stores[0].closed() == []
+    now[0] += 60
+    assert stores[0].closed() == [("alarm:a", 2)]
+    assert stores[0].claim("alarm:a", 2)
+    assert not stores[1].claim("alarm:a", 2)
+    assert stores[1].closed() == []
+    stores[0].restore("alarm:a", 2)
+    assert stores[1].closed() == [("alarm:a", 2)]
+    assert stores[1].record("alarm:a", 60) == 2
+    assert not stores[0].claim("alarm:a", 2)
+
+
+@mock_logs
+def test_digest_is_posted_when_window_closes(monkeypatch, lambda_context):
+    import slack_alert.slack_alert as main
+
+    now = [1000.0]
+    mock_http = Mock()
+    mock_http.request.return_value = HTTPResponse(status=200)
+    monkeypatch.setattr(main, "http", mock_http)
+    monkeypatch.setattr(main, "time", lambda: now[0])
+    monkeypatch.setattr(main, "ALERT_AGGREGATION_WINDOW_SECONDS", 60)
+    monkeypatch.setattr(main, "alert_windows", main.MemoryAlertWindowStore())
+    event = {"Records": [{"Sns": {"Message": json.dumps(ecs_task_stopped_message)}}]}
+
+    for _ in range(3):
+        main.lambda_handler(SNSEvent(event), lambda_context)
+    assert main.flush_handler({}, lambda_context) == {"digests_posted": 0}
+    now[0] += 60
+    assert main.flush_handler({}, lambda_context) == {"digests_posted": 1}
+    assert main.flush_handler({}, lambda_context) == {"digests_posted": 0}
+    digest = json.loads(mock_http.request.call_args.kwargs["body"])
+    main.lambda_handler(SNSEvent(event), lambda_context)
+
+    assert mock_http.request.call_count == 3
+    assert digest["blocks"] == [
+        main.create_aggregated_alerts_section("ecs:service:keycloak", 2)
+    ]
+    first_block = json.loads(mock_http.request.call_args.kwargs["body"])["blocks"][0]
+    assert "more alerts" not in first_block["text"]["text"]
+
+
+@mock_logs
+def test_digest_that_fails_to_post_is_posted_by_next_flush(monkeypatch, lambda_context):
+    import slack_alert.slack_alert as main
+
+    now = [1000.0]
+    mock_http = Mock()
+    mock_http.request.side_effect = [
+        HTTPResponse(status=200),
+        HTTPResponse(status=400),
+        HTTPResponse(status=200),
+    ]
+    monkeypatch.setattr(main, "http", mock_http)
+    monkeypatch.setattr(main, "time", lambda: now[0])
+    monkeypatch.setattr(main, "ALERT_AGGREGATION_WINDOW_SECONDS", 60)
+    monkeypatch.setattr(main, "alert_windows", main.MemoryAlertWindowStore())
+    event = {"Records": [{"Sns": {"Message": json.dumps(ecs_task_stopped_message)}}]}
+
+    main.lambda_handler(SNSEvent(event), lambda_context)
+    main.lambda_handler(SNSEvent(event), lambda_context)
+    now[0] += 60
+
+    assert main.flush_handler({}, lambda_context) == {"digests_posted": 0}
+    assert main.flush_handler({}, lambda_context) == {"digests_posted": 1}
+
+
+def test_alerts_are_keyed_by_alarm_state():
+    import slack_alert.slack_alert as main
+
+    alarm = _alarm_message("a", "metric")
+
+    assert main.create_alert_key({**alarm, "NewStateValue": "ALARM"}) == "alarm:a:ALARM"
+    assert main.create_alert_key({**alarm, "NewStateValue": "OK"}) == "alarm:a:OK"
+    assert main.create_alert_key(ecs_task_stopped_message) == "ecs:service:keycloak"
+
+
+@mock_logs
+def test_messages_without_an_alarm_name_are_not_aggregated(monkeypatch, lambda_context):
+    import slack_alert.slack_alert as main
+
+    mock_http = Mock()
+    mock_http.request.return_value = HTTPResponse(status=200)
+    monkeypatch.setattr(main, "http", mock_http)
+    monkeypatch.setattr(main, "ALERT_AGGREGATION_WINDOW_SECONDS", 60)
+    monkeypatch.setattr(main, "alert_windows", main.MemoryAlertWindowStore())
+    message = {"AlarmDescription": "Something happened"}
+    event = {"Records": [{"Sns": {"Message": json.dumps(message)}}]}
+
+    results = [main.lambda_handler(SNSEvent(event), lambda_context) for _ in range(2)]
+
+    assert main.create_alert_key(message) is None
+    assert results == [{"status": 200}, {"status": 200}]
+
+
+@mock_logs
+def test_rate_limited_post_is_retried_after_retry_after(monkeypatch, lambda_context):
+    import slack_alert.slack_alert as main
+
+    mock_http = Mock()
+    mock_http.request.side_effect = [
+        HTTPResponse(status=429, headers={"Retry-After": "7"}),
+        HTTPResponse(status=200),
+    ]
+    mock_sleep = Mock()
+    monkeypatch.setattr(main, "http", mock_http)
+    monkeypatch.setattr(main, "sleep", mock_sleep)
+    event = {"Records": [{"Sns": {"Message": json.dumps(ecs_task_stopped_message)}}]}
+
+    result = main.lambda_handler(SNSEvent(event), lambda_context)
+
+    assert result == {"status": 200}
+    mock_sleep.assert_called_once_with(7.0)
+    assert mock_http.request.call_count == 2
+    assert mock_http.request.call_args_list[0] == mock_http.request.call_args_list[1]
+
+
+@pytest.mark.parametrize(
+    "responses, remaining_millis, attempts",
+    [
+        # Server errors are retried with backoff until the attempts run out
+        ([HTTPResponse(status=503)] * 4, 60000, 4),
+        # Client errors aren't retried
+        ([HTTPResponse(status=400)], 60000, 1),
+        # Nor is anything once there isn't time to finish the retry
+        ([HTTPResponse(status=429, headers={"Retry-After": "30"})], 20000, 1),
+    ],
+)
+def test_failed_post_to_slack_raises(
+    monkeypatch, lambda_context, responses, remaining_millis, attempts
+):
+    import slack_alert.slack_alert as main
+
+    mock_http = Mock()
+    mock_http.request.side_effect = responses
+    mock_sleep = Mock()
+    monkeypatch.setattr(main, "http", mock_http)
+    monkeypatch.setattr(main, "sleep", mock_sleep)
+
+    with pytest.raises(Exception, match="Post to slack failed"):
+        main.post_to_slack({"blocks": []}, main.monotonic() + remaining_millis / 1000)
+
+    assert mock_http.request.call_count == attempts
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [1, 2, 4][
+        : attempts - 1
+    ]
+
+
+def _sqs_record(message_id: str, body: str):
+    return {
+        "messageId": message_id,
+        "receiptHandle": message_id,
+        "body": body,
+        "attributes": {},
+        "messageAttributes": {},
+        "eventSource": "aws:sqs",
+    }
+
+
+def _alarm_message(name: str, metric: str):
+    return {
+        "Trigger": {
+            "MetricName": metric,
+            "Namespace": metric_namespace,
+            "Dimensions": [{"value": dimension_value, "name": dimension_name}],
+        },
+        "AlarmName": name,
+        "AlarmDescription": alarm_description,
+        "StateChangeTime": time,
+        "NewStateReason": reason,
+    }
+
+
+def test_sqs_batch_reports_failed_alerts(monkeypatch, lambda_context):
+    import slack_alert.slack_alert as main
+
+    mock_cloudwatch = Mock()
+    mock_cloudwatch.get_paginator.return_value.paginate.return_value = [
+        {"metricFilters": []}
+    ]
+    monkeypatch.setattr(main, "cloudwatch", mock_cloudwatch)
+    mock_http = Mock()
+    mock_http.request.side_effect = lambda body, **_: HTTPResponse(
+        status=400 if "failing_alarm" in body else 200
+    )
+    monkeypatch.setattr(main, "http", mock_http)
+    event = {
+        "Records": [
+            _sqs_record(
+                "ecs",
+                json.dumps(
+                    {
+                        "Type": "Notification",
+                        "Message": json.dumps(ecs_task_stopped_message),
+                    }
+                ),
+            ),
+            _sqs_record("alarm", json.dumps(_alarm_message(alarm_name, metric_name))),
+            _sqs_record(
+                "failing", json.dumps(_alarm_message("failing_alarm", "other_metric"))
+            ),
+            _sqs_record("invalid", "not json"),
+        ]
+    }
+
+    result = main.sqs_handler(event, lambda_context)
+
+    assert result == {
+        "batchItemFailures": [
+            {"itemIdentifier": "failing"},
+            {"itemIdentifier": "invalid"},
+        ]
+    }
+    assert mock_http.request.call_count == 3
+    # The metric filters for every alarm in the batch come from a single snapshot
+    mock_cloudwatch.get_paginator.assert_called_once_with("describe_metric_filters")
+    mock_cloudwatch.describe_metric_filters.assert_not_called()
@@ -28,7 +28,8 @@ data "aws_iam_policy_document" "data_in_forwarder_policy" {
     actions = [
       "s3:ListBucket",
       "s3:PutObject",
-      "s3:PutObjectAcl"
+      "s3:PutObjectAcl",
+      "s3:AbortMultipartUpload"
     ]
     #trivy:ignore:aws-iam-no-policy-wildcards
     resources = [
@@ -54,7 +55,8 @@ data "aws_iam_policy_document" "data_in_forwarder_policy" {
     actions = [
       "s3:ListBucket",
       "s3:PutObject",
-      "s3:PutObjectAcl"
+      "s3:PutObjectAcl",
+      "s3:AbortMultipartUpload"
     ]
     #trivy:ignore:aws-iam-no-policy-wildcards
     resources = [